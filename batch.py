@@ -0,0 +1,159 @@
+"""
+Runs many MiniLang jobs across a pool of worker processes.
+
+From Python, run_batch(jobs) yields a JobResult per job as each one
+finishes. From the command line:
+
+    python batch.py [-j PROCESSES] [--engine ENGINE] [-O LEVEL] [--cache-dir DIR] SCRIPT...
+"""
+import argparse
+import io
+import multiprocessing
+import sys
+
+import lang
+
+
+class Job:
+    """
+    A script to run: the file at path, or source text. inputs maps global
+    names to Python values (numbers, strings and lists of them) that are
+    set before the script runs.
+    """
+    __slots__ = ('path', 'source', 'inputs', 'name')
+
+    def __init__(self, path=None, source=None, inputs=None, name=None):
+        if (path is None) == (source is None):
+            raise ValueError('A job needs exactly one of path and source')
+        self.path = path
+        self.source = source
+        self.inputs = inputs or {}
+        if name is None:
+            # Jobs with different source get different parse cache entries
+            name = path if path is not None else f'<job {lang.ParseCache.digest(source)[:16]}>'
+        self.name = name
+
+
+class JobResult:
+    """
+    What a job produced: value is the script's result as plain Python
+    values (see from_value), error the text of its error if it failed,
+    and output everything it printed. index is the job's position in the
+    list given to run_batch().
+    """
+    __slots__ = ('index', 'name', 'value', 'error', 'output')
+
+    def __init__(self, index, name, value, error, output):
+        self.index = index
+        self.name = name
+        self.value = value
+        self.error = error
+        self.output = output
+
+
+def to_job(job):
+    """Job for a Job, a script path, or a (source, inputs) pair."""
+    if isinstance(job, Job):
+        return job
+    if isinstance(job, str):
+        return Job(path=job)
+    source, inputs = job
+    return Job(source=source, inputs=inputs)
+
+
+def to_value(obj):
+    if isinstance(obj, lang.Value):
+        return obj
+    if isinstance(obj, bool):
+        return lang.Number.true if obj else lang.Number.false
+    if isinstance(obj, (int, float)):
+        return lang.make_number(obj)
+    if isinstance(obj, str):
+        return lang.String(obj)
+    if isinstance(obj, (list, tuple)):
+        return lang.List([to_value(item) for item in obj])
+    raise TypeError(f"Cannot pass a value of type '{type(obj).__name__}' to a MiniLang script")
+
+
+def from_value(value):
+    """Value as numbers, strings and lists, which can be sent between processes; anything else as its text."""
+    if isinstance(value, lang.Number):
+        return value.val
+    if isinstance(value, lang.String):
+        return value.val
+    if isinstance(value, lang.List):
+        return [from_value(element) for element in value]
+    return None if value is None else str(value)
+
+
+# State of a worker process, set up by init_worker()
+worker_parse_cache = None
+worker_options = None
+
+
+def init_worker(engine, opt_level, cache_dir):
+    global worker_parse_cache, worker_options
+    worker_parse_cache = lang.ParseCache(cache_dir=cache_dir)
+    worker_options = (engine, opt_level)
+
+
+def run_job(indexed_job):
+    index, job = indexed_job
+    engine, opt_level = worker_options
+    # Every job gets fresh globals; parsed programs stay warm in the worker
+    runtime = lang.Runtime(parse_cache=worker_parse_cache)
+    output = lang.OutputSink(io.StringIO())
+    value = error = None
+    try:
+        for name, obj in job.inputs.items():
+            runtime.symbol_table.set(name, to_value(obj))
+        if job.path is not None:
+            result, rt_error = runtime.run_file(job.path, engine, opt_level, output)
+        else:
+            result, rt_error = runtime.run(job.name, job.source, engine, opt_level, output)
+        if rt_error:
+            error = rt_error.to_string()
+        else:
+            value = from_value(result)
+    except (OSError, TypeError) as e:
+        error = str(e)
+    except Exception as e:
+        # Such as RecursionError from a deeply recursive program: it fails
+        # this job, not the whole batch
+        error = f'{type(e).__name__}: {e}'
+    return JobResult(index, job.name, value, error, output.target.getvalue())
+
+
+def run_batch(jobs, processes=None, engine='tree', opt_level=0, cache_dir=None, chunksize=1):
+    """
+    Runs jobs (see to_job) on a pool of processes, os.cpu_count() of them
+    by default, and yields their JobResults in the order they finish.
+    With a cache_dir, workers share parsed programs on disk across runs.
+    """
+    lang.check_options(engine, opt_level)
+    jobs = [to_job(job) for job in jobs]
+    with multiprocessing.Pool(processes, init_worker, (engine, opt_level, cache_dir)) as pool:
+        yield from pool.imap_unordered(run_job, enumerate(jobs), chunksize)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run MiniLang scripts in parallel.')
+    parser.add_argument('scripts', nargs='+', help='script files to run')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--engine', choices=lang.ENGINES, default='tree')
+    parser.add_argument('-O', '--opt-level', type=int, choices=lang.OPT_LEVELS, default=0)
+    parser.add_argument('--cache-dir', default=None, help='directory to keep parsed scripts in')
+    args = parser.parse_args(argv)
+    failed = 0
+    for result in run_batch(args.scripts, args.processes, args.engine, args.opt_level, args.cache_dir):
+        sys.stdout.write(result.output)
+        if result.error:
+            failed += 1
+            print(f'{result.name}: error\n{result.error}')
+        else:
+            print(f'{result.name}: {result.value!r}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,787 @@
+"""
+Micro-benchmarks for the MiniLang toolchain.
+
+Run all benchmarks with `python benchmark.py`, or pick some by name:
+`python benchmark.py engines`.
+"""
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import lang
+
+LOOP_PROGRAM = '''
+VAR total = 0
+FOR i = 0 TO 50000 THEN
+    VAR total = total + i * 2
+END
+total
+'''
+
+CALL_PROGRAM = '''
+FUN fib(n)
+    IF n < 2 THEN RETURN n
+    RETURN fib(n - 1) + fib(n - 2)
+END
+fib(18)
+'''
+
+FIB_25_PROGRAM = CALL_PROGRAM.replace('fib(18)', 'fib(25)')
+
+ARITHMETIC_PROGRAM = '''
+FOR i = 0 TO 10000 THEN
+    VAR x = (i * 3 + 7) % 11 - i / 4 + 2 ^ 3 * (i - 1) >= 0 AND NOT i == 5
+END
+'''
+
+VAR_READ_PROGRAM = '''
+VAR x = 5
+FOR i = 0 TO 10000 THEN
+    x
+    x
+    x
+    x
+    0
+END
+'''
+
+VAR_READ_BASELINE_PROGRAM = '''
+VAR x = 5
+FOR i = 0 TO 10000 THEN
+    0
+END
+'''
+
+OPTIMIZER_PROGRAM = '''
+VAR a = 3
+VAR b = 4
+VAR total = 0
+FOR i = 0 TO 20000 THEN
+    VAR total = total + 2 * MATH_PI * 10 + (a * b + 3) * i
+    IF TRUE THEN VAR total = total - 1
+END
+total
+'''
+
+LOOP_RESULT_ITERATIONS = 300000
+
+ACCUMULATE_PROGRAM = f'''
+VAR x = 0
+FOR i = 0 TO {LOOP_RESULT_ITERATIONS} THEN VAR x = x + i
+'''
+
+DOUBLES_PROGRAM = f'''
+VAR doubles = FOR i = 0 TO {LOOP_RESULT_ITERATIONS} THEN i * 2
+0
+'''
+
+COUNTED_LOOP_ITERATIONS = 10 ** 7
+
+EMPTY_LOOP_PROGRAM = f'''
+FOR i = 0 TO {COUNTED_LOOP_ITERATIONS} THEN 0
+0
+'''
+
+ACCUMULATOR_LOOP_PROGRAM = f'''
+VAR total = 0
+FOR i = 0 TO {COUNTED_LOOP_ITERATIONS} THEN VAR total = total + i
+total
+'''
+
+LIST_BUILDING_SIZES = (10 ** 4, 10 ** 5, 10 ** 6)
+# Above this size the quadratic full-copy comparison takes too long to run
+LIST_COPY_MAX_SIZE = 10 ** 4
+
+
+def list_building_program(size, expression):
+    return f'''
+VAR l = []
+FOR i = 0 TO {size} THEN VAR l = {expression}
+LEN(l)
+'''
+
+NUMERIC_LIST_SIZE = 10 ** 6
+
+NUMERIC_LIST_PROGRAMS = (
+    ('ints', f'FOR i = 0 TO {NUMERIC_LIST_SIZE} THEN i * 7'),
+    ('floats', f'FOR i = 0 TO {NUMERIC_LIST_SIZE} THEN i / 7'),
+)
+
+BULK_LIST_SIZE = 10 ** 6
+
+BULK_BUILTIN_PROGRAMS = (
+    ('sum', f'''
+VAR l = RANGE(0, {BULK_LIST_SIZE})
+VAR total = 0
+FOR i = 0 TO LEN(l) THEN VAR total = total + l / i
+total
+''', f'''
+VAR l = RANGE(0, {BULK_LIST_SIZE})
+SUM(l)
+'''),
+    ('scale', f'''
+VAR l = RANGE(0, {BULK_LIST_SIZE})
+VAR scaled = FOR i = 0 TO LEN(l) THEN l / i * 3
+0
+''', f'''
+VAR l = RANGE(0, {BULK_LIST_SIZE})
+VAR scaled = MAP_MUL(l, 3)
+0
+'''),
+    ('dot product', f'''
+VAR a = RANGE(0, {BULK_LIST_SIZE})
+VAR b = RANGE(0, {BULK_LIST_SIZE})
+VAR total = 0
+FOR i = 0 TO LEN(a) THEN VAR total = total + a / i * (b / i)
+total
+''', f'''
+VAR a = RANGE(0, {BULK_LIST_SIZE})
+VAR b = RANGE(0, {BULK_LIST_SIZE})
+DOT(a, b)
+'''),
+)
+
+# Appends of 10 characters each, up to a 10 MB string
+STRING_BUILDING_SIZES = (10 ** 4, 10 ** 5, 10 ** 6)
+STRING_COPY_MAX_SIZE = 10 ** 4
+
+
+def string_building_program(size, builder):
+    if builder:
+        return f'''
+VAR b = STRING_BUILDER()
+FOR i = 0 TO {size} THEN APPEND(b, "0123456789")
+IF PRINT_RET(b) THEN 1 ELSE 0
+'''
+    # The final IF reads the string, which joins it
+    return f'''
+VAR s = ""
+FOR i = 0 TO {size} THEN VAR s = s + "0123456789"
+IF s * 1 THEN 1 ELSE 0
+'''
+
+PRINT_LINES = 10 ** 6
+
+PRINT_PROGRAM = f'''
+FOR i = 0 TO {PRINT_LINES} THEN PRINT(i)
+0
+'''
+
+RULE_EXECUTIONS = 10000
+
+# A small rule script of the kind an embedding service runs over and over
+RULE_PROGRAM = '''
+VAR score = 0
+VAR score = IF amount > 1000 THEN score + 40 ELSE score
+VAR score = IF country == 7 THEN score + 25 ELSE score
+VAR score = IF attempts >= 3 THEN score + 30 ELSE score
+score >= 50
+'''
+
+BATCH_JOBS = 16
+
+BATCH_JOB_PROGRAM = '''
+VAR total = 0
+FOR i = 0 TO n THEN VAR total = total + i % 7
+total
+'''
+
+# CPU-bound body: each iteration runs a short inner loop of its own
+PARFOR_PROGRAM = '''
+FUN work(n)
+    VAR total = 0
+    FOR k = 0 TO 200 THEN VAR total = total + (n * k) % 7
+    RETURN total
+END
+PARFOR i = 0 TO 4000 THEN work(i)
+'''
+
+HIGHER_ORDER_SIZE = 100000
+
+HIGHER_ORDER_PROGRAMS = (
+    ('FOR loop calling f', 'FUN f(x) -> x * 2 + 1\nVAR l = FOR i = 0 TO n THEN f(l_in / i)'),
+    ('MAP', 'FUN f(x) -> x * 2 + 1\nVAR l = MAP(f, l_in)'),
+    ('FOR loop, IF + APPEND', 'VAR l = []\nFOR i = 0 TO n THEN IF (l_in / i) % 3 == 0 THEN APPEND(l, l_in / i)'),
+    ('FILTER', 'VAR l = FILTER(FUN(x) -> x % 3 == 0, l_in)'),
+    ('FOR loop summing', 'VAR t = 0\nFOR i = 0 TO n THEN VAR t = t + l_in / i'),
+    ('REDUCE', 'VAR t = REDUCE(FUN(a, b) -> a + b, l_in, 0)'),
+)
+
+CALL_OVERHEAD_CALLS = 1000000
+
+# The loop alone, then the same loop calling a function with an empty
+# body: the difference is what a call costs
+CALL_OVERHEAD_PROGRAMS = (
+    ('loop alone', f'FOR i = 0 TO {CALL_OVERHEAD_CALLS} THEN 0\n0'),
+    ('no arguments', f'FUN f() -> 0\nFOR i = 0 TO {CALL_OVERHEAD_CALLS} THEN f()\n0'),
+    ('two arguments', f'FUN f(a, b) -> 0\nFOR i = 0 TO {CALL_OVERHEAD_CALLS} THEN f(i, i)\n0'),
+)
+
+
+def generated_script(token_count):
+    """Source text of roughly token_count tokens, one assignment per line."""
+    lines = []
+    count = 0
+    while count < token_count:
+        index = len(lines)
+        lines.append(f'VAR x{index} = x{index} + 17 * (3 - y) / "s"')
+        count += 14
+    return '\n'.join(lines)
+
+
+def best_of(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_checked(text, engine='tree', opt_level=0):
+    result, error = lang.run('<benchmark>', text, engine, opt_level)
+    if error:
+        raise RuntimeError(f'{error.error_type}: {error.details}')
+    return result
+
+
+def parse_checked(text):
+    tokens, error = lang.Lexer('<benchmark>', text).make_tokens()
+    if error:
+        raise RuntimeError(f'{error.error_type}: {error.details}')
+    ast = lang.Parser(tokens).parse()
+    if ast.error:
+        raise RuntimeError(f'{ast.error.error_type}: {ast.error.details}')
+    return ast.node
+
+
+def new_context():
+    context = lang.Context('<benchmark>', output=lang.OutputSink(None))
+    # Fresh globals rather than a child of the shared ones: calls from a
+    # scope between a frame and the globals cannot take the global fast path
+    context.symbol_table = lang.new_global_symbol_table()
+    return context
+
+
+class NameDispatchInterpreter(lang.Interpreter):
+    """
+    Interpreter as it dispatched before the cached tables: a formatted
+    getattr per visit and an if/elif chain over the operator token.
+    """
+    def visit(self, node, context):
+        method = getattr(self, f'visit_{type(node).__name__}', self.no_visit_method)
+        return method(node, context)
+
+    def visit_BinOpNode(self, node, context):
+        response = lang.RTResult()
+        left = response.register(self.visit(node.left_node, context))
+        if response.should_ret():
+            return response
+        right = response.register(self.visit(node.right_node, context))
+        if response.should_ret():
+            return response
+        op_token = node.op_token
+        for op_key, method_name in lang.BINARY_OP_METHODS.items():
+            if op_token.op_key() == op_key:
+                result, error = getattr(left, method_name)(right)
+                break
+        if error:
+            return response.failure(error.set_pos(node.pos_start, node.pos_end, context))
+        return response.success(result)
+
+
+class CopyingInterpreter(lang.Interpreter):
+    """Interpreter as it read variables before values became position-free."""
+    def visit_VarAccessNode(self, node, context):
+        response = super().visit_VarAccessNode(node, context)
+        if response.val is not None:
+            response.val = response.val.copy()
+        return response
+
+
+CopyingInterpreter.build_dispatch_table()
+
+
+def count_value_allocations(func):
+    with lang.AllocationCounter() as counter:
+        func()
+    return counter.total
+
+
+def report(title, rows):
+    print(title)
+    baseline = rows[0][1]
+    for label, seconds in rows:
+        print(f'  {label:<28}{seconds * 1000:>10.1f} ms{baseline / seconds:>8.2f}x')
+    print()
+
+
+def bench_engines():
+    for title, program in (('loop-heavy', LOOP_PROGRAM), ('call-heavy', CALL_PROGRAM)):
+        rows = []
+        for engine in lang.ENGINES:
+            rows.append((engine, best_of(lambda: run_checked(program, engine))))
+        report(f'engines: {title}', rows)
+
+
+def bench_control_flow():
+    calls = 242785
+    print(f'control flow: fib(25), {calls} calls')
+    rows = []
+    for label, engine in (('RTResult propagation', 'tree'), ('exceptions', 'direct')):
+        rows.append((label, best_of(lambda: run_checked(FIB_25_PROGRAM, engine), repeat=1)))
+    baseline = rows[0][1]
+    for label, seconds in rows:
+        print(f'  {label:<28}{seconds * 1000:>10.1f} ms{seconds / calls * 1e6:>8.2f} us/call{baseline / seconds:>7.2f}x')
+    print()
+
+
+def bench_dispatch():
+    node = parse_checked(ARITHMETIC_PROGRAM)
+    rows = []
+    for label, interpreter in (('name dispatch + if chain', NameDispatchInterpreter()),
+                               ('cached dispatch table', lang.Interpreter())):
+        rows.append((label, best_of(lambda: interpreter.visit(node, new_context()))))
+    report('dispatch: arithmetic-heavy expressions', rows)
+
+
+def bench_var_access():
+    reads = 4 * 10000
+    print('var access: Value allocations per variable read')
+    for label, engine, interpreter_class in (('copy on read', 'tree', CopyingInterpreter),
+                                             ('tree', 'tree', lang.Interpreter),
+                                             ('vm', 'vm', None)):
+        counts = []
+        for program in (VAR_READ_PROGRAM, VAR_READ_BASELINE_PROGRAM):
+            if interpreter_class:
+                node = lang.Resolver().resolve(parse_checked(program))
+                counts.append(count_value_allocations(lambda: interpreter_class().visit(node, new_context())))
+            else:
+                counts.append(count_value_allocations(lambda: run_checked(program, engine)))
+        print(f'  {label:<28}{(counts[0] - counts[1]) / reads:>10.2f}')
+    print()
+
+
+def bench_optimizer():
+    for engine in ('tree', 'direct'):
+        rows = []
+        for opt_level in lang.OPT_LEVELS:
+            rows.append((f'opt_level={opt_level}', best_of(lambda: run_checked(OPTIMIZER_PROGRAM, engine, opt_level))))
+        report(f'optimizer: folding and hoisting in a loop, {engine}', rows)
+
+
+def bench_loop_results():
+    print(f'loop results: {LOOP_RESULT_ITERATIONS} iterations, tree engine')
+    for label, program, opt_level in (('loop value returned', ACCUMULATE_PROGRAM, 0),
+                                      ('loop value discarded', ACCUMULATE_PROGRAM + 'x', 0),
+                                      ('list assigned, eager', DOUBLES_PROGRAM, 0),
+                                      ('list assigned, lazy', DOUBLES_PROGRAM, 3)):
+        seconds = best_of(lambda: run_checked(program, 'tree', opt_level), repeat=1)
+        tracemalloc.start()
+        run_checked(program, 'tree', opt_level)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'  {label:<28}{seconds * 1000:>10.1f} ms{peak_bytes / 2 ** 20:>8.1f} MB peak')
+    print()
+
+
+def bench_counted_loops():
+    from direct import DirectInterpreter
+    for title, program in (('empty body', EMPTY_LOOP_PROGRAM), ('accumulator', ACCUMULATOR_LOOP_PROGRAM)):
+        node, error = lang.build_ast('<benchmark>', program)
+        if error:
+            raise RuntimeError(f'{error.error_type}: {error.details}')
+        loop = next(statement for statement in node.elements if isinstance(statement, lang.ForNode))
+        var_in_body = loop.var_in_body
+        print(f'counted loops: {title}, {COUNTED_LOOP_ITERATIONS} iterations')
+        rows = []
+        for engine, execute in (('tree', lambda: lang.Interpreter().visit(node, new_context())),
+                                ('direct', lambda: DirectInterpreter().execute(node, new_context()))):
+            if not var_in_body:
+                # As if the body read the counter: a Number stored every iteration
+                loop.var_in_body = True
+                rows.append((f'{engine}, Number per iteration', best_of(execute, repeat=1)))
+                loop.var_in_body = False
+            rows.append((engine, best_of(execute, repeat=1)))
+        baseline = rows[0][1]
+        for label, seconds in rows:
+            print(f'  {label:<28}{seconds * 1000:>10.1f} ms'
+                  f'{seconds / COUNTED_LOOP_ITERATIONS * 1e9:>8.0f} ns/iter{baseline / seconds:>7.2f}x')
+        print()
+
+
+def copying_add_to(self, other):
+    # List.add_to as a full copy of the elements, for comparison
+    return lang.List(self.elements + [other]), None
+
+
+def bench_list_building():
+    print('list building: repeated + and * on one list, direct engine')
+    add_to = lang.List.add_to
+    for size in LIST_BUILDING_SIZES:
+        rows = [('l + i', list_building_program(size, 'l + i'), add_to),
+                ('l * [i]', list_building_program(size, 'l * [i]'), add_to)]
+        if size <= LIST_COPY_MAX_SIZE:
+            rows.append(('l + i, full copy', list_building_program(size, 'l + i'), copying_add_to))
+        for label, program, method in rows:
+            lang.List.add_to = method
+            try:
+                seconds = best_of(lambda: run_checked(program, 'direct'), repeat=1)
+            finally:
+                lang.List.add_to = add_to
+            print(f'  {size:>8} elements, {label:<20}{seconds * 1000:>10.1f} ms{seconds / size * 1e9:>8.0f} ns/element')
+    print()
+
+
+def bench_numeric_lists():
+    import persistent_list
+    print(f'numeric lists: {NUMERIC_LIST_SIZE} elements held, direct engine')
+    make_leaf = persistent_list.make_leaf
+    for title, program in NUMERIC_LIST_PROGRAMS:
+        for label, factory in (('boxed', tuple), ('typed arrays', make_leaf)):
+            # A tuple of the list's items is what every leaf was before
+            persistent_list.make_leaf = factory
+            try:
+                tracemalloc.start()
+                # The program's value is a list of its statements' values
+                result = run_checked(program, 'direct').get(-1)
+                held_bytes, _ = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                seconds = best_of(lambda: sum(result.get(index).val for index in range(0, NUMERIC_LIST_SIZE, 7)))
+            finally:
+                persistent_list.make_leaf = make_leaf
+            print(f'  {title + ", " + label:<28}{held_bytes / 2 ** 20:>8.1f} MB held'
+                  f'{seconds / (NUMERIC_LIST_SIZE // 7) * 1e9:>8.0f} ns/index')
+            del result
+    print()
+
+
+def bench_bulk_builtins():
+    print(f'bulk builtins: {BULK_LIST_SIZE} elements, tree engine')
+    for title, loop_program, builtin_program in BULK_BUILTIN_PROGRAMS:
+        loop_seconds = best_of(lambda: run_checked(loop_program), repeat=1)
+        builtin_seconds = best_of(lambda: run_checked(builtin_program), repeat=1)
+        print(f'  {title:<12} FOR loop{loop_seconds * 1000:>10.1f} ms  builtin{builtin_seconds * 1000:>8.1f} ms'
+              f'{loop_seconds / builtin_seconds:>8.1f}x')
+    print()
+
+
+def copying_joined(self, text):
+    # String.joined as a new str every time, for comparison
+    return lang.String(self.val + text)
+
+
+def bench_string_building():
+    print('string building: appends of 10 characters, direct engine')
+    joined = lang.String.joined
+    for size in STRING_BUILDING_SIZES:
+        rows = [('s + "..."', string_building_program(size, False), joined),
+                ('STRING_BUILDER', string_building_program(size, True), joined)]
+        if size <= STRING_COPY_MAX_SIZE:
+            rows.append(('s + "...", new str', string_building_program(size, False), copying_joined))
+        for label, program, method in rows:
+            lang.String.joined = method
+            try:
+                seconds = best_of(lambda: run_checked(program, 'direct'), repeat=1)
+            finally:
+                lang.String.joined = joined
+            print(f'  {size * 10 / 10 ** 6:>6.1f} MB, {label:<20}{seconds * 1000:>10.1f} ms'
+                  f'{seconds / size * 1e9:>8.0f} ns/append')
+    print()
+
+
+def bench_output():
+    print(f'output: {PRINT_LINES} PRINTs, direct engine')
+    with open(os.devnull, 'w') as devnull:
+        for label, make_sink in (('unbuffered, to a file', lambda: lang.OutputSink(devnull, buffer_size=0)),
+                                 ('buffered, to a file', lambda: lang.OutputSink(devnull)),
+                                 ('buffered, to StringIO', lambda: lang.OutputSink(io.StringIO())),
+                                 ('discarded', lambda: lang.OutputSink(None))):
+            def execute():
+                result, error = lang.run('<benchmark>', PRINT_PROGRAM, 'direct', output=make_sink())
+                if error:
+                    raise RuntimeError(f'{error.error_type}: {error.details}')
+            seconds = best_of(execute, repeat=1)
+            print(f'  {label:<28}{seconds * 1000:>10.1f} ms{seconds / PRINT_LINES * 1e9:>8.0f} ns/PRINT')
+    print()
+
+
+def bench_number_interning():
+    print('number interning: Numbers allocated and run time, tree engine')
+    make_number = lang.make_number
+    for title, program in (('loop-heavy', LOOP_PROGRAM), ('call-heavy', CALL_PROGRAM),
+                           ('arithmetic', ARITHMETIC_PROGRAM)):
+        for label, factory in (('no small int cache', lang.Number), ('small int cache', make_number)):
+            lang.make_number = factory
+            try:
+                with lang.AllocationCounter() as counter:
+                    run_checked(program)
+                seconds = best_of(lambda: run_checked(program))
+            finally:
+                lang.make_number = make_number
+            print(f'  {title + ", " + label:<36}{counter.counts.get("Number", 0):>10} Numbers{seconds * 1000:>10.1f} ms')
+    print()
+
+
+def bench_lexers():
+    text = generated_script(1000000)
+    megabytes = len(text.encode()) / 2 ** 20
+    print(f'lexers: throughput on {megabytes:.1f} MB of source')
+    rows = []
+    for label, lexer_class in (('Lexer', lang.Lexer), ('RegexLexer', lang.RegexLexer)):
+        seconds = best_of(lambda: lexer_class('<benchmark>', text).make_tokens())
+        rows.append((label, seconds))
+    baseline = rows[0][1]
+    for label, seconds in rows:
+        print(f'  {label:<28}{megabytes / seconds:>10.2f} MB/s{baseline / seconds:>6.2f}x')
+    print()
+
+
+def bench_parser():
+    print('parser: time per statement as the file grows')
+    for statement_count in (25000, 50000, 100000):
+        tokens, error = lang.RegexLexer('<benchmark>', generated_script(14 * statement_count)).make_tokens()
+        seconds = best_of(lambda: lang.Parser(tokens).parse())
+        print(f'  {statement_count:>7} statements{seconds * 1000:>15.1f} ms{seconds / statement_count * 1e6:>8.2f} us/stmt')
+    print()
+
+
+def count_parse_results(func):
+    count = 0
+    init = lang.ParseResult.__init__
+
+    def counting_init(self):
+        nonlocal count
+        count += 1
+        init(self)
+
+    lang.ParseResult.__init__ = counting_init
+    try:
+        func()
+    finally:
+        lang.ParseResult.__init__ = init
+    return count
+
+
+def max_nesting_depth():
+    def parses(depth):
+        tokens, _ = lang.RegexLexer('<benchmark>', '(' * depth + '1' + ')' * depth).make_tokens()
+        try:
+            return not lang.Parser(tokens).parse().error
+        except RecursionError:
+            return False
+
+    low, high = 1, sys.getrecursionlimit()
+    while low < high:
+        middle = (low + high + 1) // 2
+        if parses(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def bench_expressions():
+    line_count = 20000
+    primaries = 7 * line_count
+    tokens, error = lang.RegexLexer('<benchmark>', '\n'.join(
+        f'VAR x{index} = (a * 3 + b / 2 - c ^ 2) >= d AND NOT e == f' for index in range(line_count))).make_tokens()
+    seconds = best_of(lambda: lang.Parser(tokens).parse())
+    results = count_parse_results(lambda: lang.Parser(tokens).parse())
+    print(f'expressions: {line_count} lines, {primaries} primaries')
+    print(f'  {"parse time":<28}{seconds * 1000:>10.1f} ms')
+    print(f'  {"ParseResults per primary":<28}{results / primaries:>10.2f}')
+    print(f'  {"max parenthesis nesting":<28}{max_nesting_depth():>10}')
+    print()
+
+
+def bench_parse_cache():
+    helper = '\n'.join(f'FUN helper{index}(a, b) -> IF a > b THEN a * {index} ELSE b - {index}'
+                        for index in range(300))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'helper.ml')
+        with open(path, 'w') as f:
+            f.write(helper)
+        program = f'FOR i = 0 TO 50 THEN RUN("{path}")'.replace('\\', '\\\\')
+        cache = lang.parse_cache
+        rows = []
+        try:
+            lang.parse_cache = lang.ParseCache(max_entries=0)
+            rows.append(('RUN x50, no cache', best_of(lambda: run_checked(program))))
+            lang.parse_cache = lang.ParseCache()
+            rows.append(('RUN x50, memory cache', best_of(lambda: run_checked(program))))
+            report('parse cache: repeated RUN of a 300-line script', rows)
+
+            rows = []
+            lang.parse_cache = lang.ParseCache(cache_dir=os.path.join(directory, 'cache'))
+            lang.run_file(path)
+
+            def cold_start(cache_dir):
+                lang.parse_cache = lang.ParseCache(cache_dir=cache_dir)
+                lang.run_file(path)
+
+            rows.append(('new process, no cache dir', best_of(lambda: cold_start(None))))
+            rows.append(('new process, cache dir', best_of(lambda: cold_start(os.path.join(directory, 'cache')))))
+            report('parse cache: first RUN in a fresh process', rows)
+        finally:
+            lang.parse_cache = cache
+
+
+def bench_runtime():
+    runtime = lang.Runtime(output=lang.OutputSink(None))
+    for name, val in (('amount', 1500), ('country', 7), ('attempts', 1)):
+        runtime.symbol_table.set(name, lang.make_number(val))
+    # Same globals, but nothing stays parsed between runs
+    uncached = lang.Runtime(runtime.symbol_table, lang.ParseCache(max_entries=0), runtime.output)
+    rows = []
+    for engine in lang.ENGINES:
+        program, error = runtime.compile(RULE_PROGRAM, engine=engine)
+        if error:
+            raise RuntimeError(f'{error.error_type}: {error.details}')
+
+        def run_each(on):
+            for _ in range(RULE_EXECUTIONS):
+                on.run('<rule>', RULE_PROGRAM, engine)
+
+        def execute_each():
+            for _ in range(RULE_EXECUTIONS):
+                runtime.execute(program)
+        rows.append((f'{engine}, parsed every run', best_of(lambda: run_each(uncached))))
+        rows.append((f'{engine}, run(), cached', best_of(lambda: run_each(runtime))))
+        rows.append((f'{engine}, compiled once', best_of(execute_each)))
+    report(f'runtime: {RULE_EXECUTIONS} executions of a rule script', rows)
+
+
+def bench_batch():
+    import batch
+    jobs = [(BATCH_JOB_PROGRAM, {'n': 100000}) for _ in range(BATCH_JOBS)]
+
+    def in_process():
+        for source, inputs in jobs:
+            runtime = lang.Runtime()
+            for name, val in inputs.items():
+                runtime.symbol_table.set(name, batch.to_value(val))
+            runtime.run('<job>', source, 'direct')
+
+    def pooled(processes):
+        for result in batch.run_batch(jobs, processes, 'direct'):
+            if result.error:
+                raise RuntimeError(result.error)
+    rows = [('in this process', best_of(in_process, repeat=1))]
+    for processes in sorted({1, 2, os.cpu_count() or 1}):
+        rows.append((f'pool of {processes}', best_of(lambda: pooled(processes), repeat=1)))
+    report(f'batch: {BATCH_JOBS} jobs on {os.cpu_count()} CPUs, direct engine', rows)
+
+
+def bench_parfor():
+    import parallel
+    serial_program = PARFOR_PROGRAM.replace('PARFOR', 'FOR')
+
+    def run(text, engine, workers):
+        runtime = lang.Runtime(output=lang.OutputSink(None), parallel=parallel.ParallelOptions(workers))
+        result, error = runtime.run('<benchmark>', text, engine)
+        if error:
+            raise RuntimeError(error.to_string())
+    for engine in lang.ENGINES:
+        rows = [('FOR', best_of(lambda: run(serial_program, engine, None), repeat=1))]
+        for workers in sorted({2, os.cpu_count() or 1} - {1}):
+            rows.append((f'PARFOR, {workers} workers', best_of(lambda: run(PARFOR_PROGRAM, engine, workers), repeat=1)))
+        report(f'parfor: 4000 iterations on {os.cpu_count()} CPUs, {engine} engine', rows)
+
+
+def bench_higher_order():
+    import parallel
+    data = lang.number_list(list(range(HIGHER_ORDER_SIZE)))
+
+    def run(text, engine, workers=1):
+        runtime = lang.Runtime(output=lang.OutputSink(None), parallel=parallel.ParallelOptions(workers))
+        runtime.symbol_table.set('l_in', data)
+        runtime.symbol_table.set('n', lang.make_number(HIGHER_ORDER_SIZE))
+        result, error = runtime.run('<benchmark>', text, engine)
+        if error:
+            raise RuntimeError(error.to_string())
+    for engine in lang.ENGINES:
+        rows = [(label, best_of(lambda: run(text, engine))) for label, text in HIGHER_ORDER_PROGRAMS]
+        map_text = HIGHER_ORDER_PROGRAMS[1][1]
+        rows.append(('MAP, 2 workers', best_of(lambda: run(map_text, engine, 2))))
+        report(f'higher_order: {HIGHER_ORDER_SIZE} elements, {engine} engine', rows)
+
+
+def bench_call_overhead():
+    for engine in lang.ENGINES:
+        print(f'call overhead: empty function called {CALL_OVERHEAD_CALLS} times, {engine} engine')
+        loop_seconds = None
+        for label, program in CALL_OVERHEAD_PROGRAMS:
+            seconds = best_of(lambda: run_checked(program, engine), repeat=1)
+            if loop_seconds is None:
+                loop_seconds = seconds
+                print(f'  {label:<28}{seconds * 1000:>10.1f} ms')
+            else:
+                per_call = (seconds - loop_seconds) / CALL_OVERHEAD_CALLS
+                print(f'  {label:<28}{seconds * 1000:>10.1f} ms{per_call * 1e9:>8.0f} ns/call')
+        print()
+
+
+def bench_parse_memory():
+    text = generated_script(1000000)
+    tracemalloc.start()
+    tokens, error = lang.Lexer('<benchmark>', text).make_tokens()
+    token_bytes, _ = tracemalloc.get_traced_memory()
+    ast = lang.Parser(tokens).parse()
+    total_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if error or ast.error:
+        raise RuntimeError('generated script failed to parse')
+    print(f'parse memory: {len(tokens)} tokens, {len(text) / 2 ** 20:.1f} MB of source')
+    print(f'  {"token list":<28}{token_bytes / 2 ** 20:>10.1f} MB{token_bytes / len(tokens):>8.0f} B/token')
+    print(f'  {"token list + AST":<28}{total_bytes / 2 ** 20:>10.1f} MB')
+    print(f'  {"peak":<28}{peak_bytes / 2 ** 20:>10.1f} MB')
+
+    del tokens, ast
+    tracemalloc.start()
+    lexer = lang.Lexer('<benchmark>', text)
+    ast = lang.Parser(lexer.generate_tokens()).parse()
+    total_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if lexer.error or ast.error:
+        raise RuntimeError('generated script failed to parse')
+    print(f'  {"streamed tokens + AST":<28}{total_bytes / 2 ** 20:>10.1f} MB')
+    print(f'  {"streamed peak":<28}{peak_bytes / 2 ** 20:>10.1f} MB')
+    print()
+
+
+BENCHMARKS = {
+    'engines': bench_engines,
+    'control_flow': bench_control_flow,
+    'dispatch': bench_dispatch,
+    'var_access': bench_var_access,
+    'optimizer': bench_optimizer,
+    'loop_results': bench_loop_results,
+    'counted_loops': bench_counted_loops,
+    'list_building': bench_list_building,
+    'numeric_lists': bench_numeric_lists,
+    'bulk_builtins': bench_bulk_builtins,
+    'string_building': bench_string_building,
+    'output': bench_output,
+    'number_interning': bench_number_interning,
+    'lexers': bench_lexers,
+    'parser': bench_parser,
+    'expressions': bench_expressions,
+    'parse_cache': bench_parse_cache,
+    'runtime': bench_runtime,
+    'batch': bench_batch,
+    'parfor': bench_parfor,
+    'higher_order': bench_higher_order,
+    'call_overhead': bench_call_overhead,
+    'parse_memory': bench_parse_memory,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
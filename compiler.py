@@ -0,0 +1,442 @@
+from lang import *
+
+# Opcodes
+OP_LOAD_CONST = 0
+OP_LOAD_NAME = 1
+OP_STORE_NAME = 2
+OP_BINARY_OP = 3
+OP_UNARY_OP = 4
+OP_BUILD_LIST = 5
+OP_LIST_APPEND = 6
+OP_POP = 7
+OP_JUMP = 8
+OP_POP_JUMP_IF_FALSE = 9
+OP_FOR_PREP = 10
+OP_FOR_ITER = 11
+OP_MAKE_FUNCTION = 12
+OP_CALL = 13
+OP_RETURN_VALUE = 14
+OP_LOAD_FAST = 15
+OP_STORE_FAST = 16
+OP_LOAD_GLOBAL = 17
+OP_PARFOR = 18
+OP_POP_TO = 19
+OP_EXIT_LOOP = 20
+
+OP_NAMES = {
+    OP_LOAD_CONST: 'LOAD_CONST',
+    OP_LOAD_NAME: 'LOAD_NAME',
+    OP_STORE_NAME: 'STORE_NAME',
+    OP_BINARY_OP: 'BINARY_OP',
+    OP_UNARY_OP: 'UNARY_OP',
+    OP_BUILD_LIST: 'BUILD_LIST',
+    OP_LIST_APPEND: 'LIST_APPEND',
+    OP_POP: 'POP',
+    OP_JUMP: 'JUMP',
+    OP_POP_JUMP_IF_FALSE: 'POP_JUMP_IF_FALSE',
+    OP_FOR_PREP: 'FOR_PREP',
+    OP_FOR_ITER: 'FOR_ITER',
+    OP_MAKE_FUNCTION: 'MAKE_FUNCTION',
+    OP_CALL: 'CALL',
+    OP_RETURN_VALUE: 'RETURN_VALUE',
+    OP_LOAD_FAST: 'LOAD_FAST',
+    OP_STORE_FAST: 'STORE_FAST',
+    OP_LOAD_GLOBAL: 'LOAD_GLOBAL',
+    OP_PARFOR: 'PARFOR',
+    OP_POP_TO: 'POP_TO',
+    OP_EXIT_LOOP: 'EXIT_LOOP',
+}
+
+# Change in stack depth when execution falls through to the next instruction
+STACK_EFFECTS = {
+    OP_LOAD_CONST: 1,
+    OP_LOAD_NAME: 1,
+    OP_STORE_NAME: 0,
+    OP_BINARY_OP: -1,
+    OP_UNARY_OP: 0,
+    OP_LIST_APPEND: -1,
+    OP_POP: -1,
+    OP_JUMP: 0,
+    OP_POP_JUMP_IF_FALSE: -1,
+    OP_FOR_ITER: 0,
+    OP_MAKE_FUNCTION: 1,
+    OP_RETURN_VALUE: -1,
+    OP_LOAD_FAST: 1,
+    OP_STORE_FAST: 0,
+    OP_LOAD_GLOBAL: 1,
+    OP_PARFOR: 0,
+    OP_EXIT_LOOP: 0,
+}
+
+
+def stack_effect(op, arg):
+    if op == OP_BUILD_LIST:
+        return 1 - arg
+    if op == OP_CALL:
+        return -arg
+    if op == OP_FOR_PREP:
+        return -2 if arg else -1
+    return STACK_EFFECTS[op]
+
+
+class CodeObject:
+    """
+    Compiled form of a program or function body: a flat list of
+    (opcode, arg) pairs plus the constant and name tables they index into.
+    slot_names maps the locals the Resolver assigned slots to their index
+    in the call frame (varnames is the reverse). positions[i] holds the
+    (pos_start, pos_end) of the node that emitted instruction i and is only
+    consulted when an error is raised. loops holds (body_start, body_end,
+    break_target, break_depth, continue_target, continue_depth) for each
+    loop, inner loops first, for calls in a loop body whose callee ran
+    into a BREAK or CONTINUE. callees holds the name each call looks its
+    function up by, or None for a function that comes from anything else.
+    """
+    def __init__(self, name, arg_names=(), auto_ret=False, slot_names=None, frame=None):
+        self.name = name
+        self.arg_names = list(arg_names)
+        self.auto_ret = auto_ret
+        self.slot_names = slot_names
+        self.varnames = sorted(slot_names, key=slot_names.get) if slot_names else []
+        self.frame = frame
+        self.instructions = []
+        self.positions = []
+        self.consts = []
+        self.names = []
+        self.loops = []
+        self.callees = []
+
+    def disassemble(self):
+        lines = []
+        for index, (op, arg) in enumerate(self.instructions):
+            line = f'{index:>4} {OP_NAMES[op]:<18}'
+            if op in (OP_LOAD_CONST, OP_MAKE_FUNCTION):
+                line += f'{arg} ({self.consts[arg]!r})'
+            elif op in (OP_LOAD_NAME, OP_STORE_NAME, OP_LOAD_GLOBAL):
+                line += f'{arg} ({self.names[arg]})'
+            elif op in (OP_LOAD_FAST, OP_STORE_FAST):
+                line += f'{arg} ({self.varnames[arg]})'
+            elif op == OP_FOR_ITER:
+                exit_target, slot, name_index = arg
+                target = self.varnames[slot] if slot is not None else self.names[name_index]
+                line += f'{target} -> {exit_target}'
+            elif op == OP_PARFOR:
+                node_index, has_step, exit_target = arg
+                line += f'{self.consts[node_index].var.val} -> {exit_target}'
+            elif op == OP_EXIT_LOOP:
+                line += 'BREAK' if arg else 'CONTINUE'
+            elif arg is not None:
+                line += f'{arg}'
+            lines.append(line.rstrip())
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return f'<code {self.name}>'
+
+
+class Loop:
+    """
+    A loop being compiled. depth is the stack depth around it, below its
+    result list and FOR state; BREAK and CONTINUE drop whatever the
+    expressions around them left above that.
+    """
+    def __init__(self, continue_target, collect, has_state, depth):
+        self.continue_target = continue_target
+        self.collect = collect
+        self.has_state = has_state
+        self.depth = depth
+        self.continue_depth = depth + has_state
+        self.body_start = None
+        self.break_jumps = []
+
+
+class Compiler:
+    """
+    Turns the AST produced by Parser.parse() into a CodeObject for the VM.
+    Statement lists in block position (IF/FOR/WHILE/FUN bodies spanning
+    several lines) are compiled with their values discarded, matching the
+    Interpreter which returns Number.null for them. depth tracks the operand
+    stack depth the VM will be at after the last emitted instruction.
+    """
+    def __init__(self, name='<program>', arg_names=(), auto_ret=False, in_function=False, slot_names=None,
+                 frame=None):
+        self.code = CodeObject(name, arg_names, auto_ret, slot_names, frame)
+        self.in_function = in_function
+        self.loops = []
+        self.depth = 0
+        self.const_indexes = {}
+        self.name_indexes = {}
+
+    def compile_program(self, node):
+        self.compile(node)
+        self.emit(OP_RETURN_VALUE, None, node)
+        return self.code
+
+    def compile_function(self, node):
+        if node.auto_ret:
+            self.compile(node.body)
+        else:
+            self.compile_block(node.body)
+            self.emit(OP_LOAD_CONST, self.add_const(Number.null), node)
+        self.emit(OP_RETURN_VALUE, None, node)
+        return self.code
+
+    # Tables
+    def emit(self, op, arg, node):
+        self.code.instructions.append((op, arg))
+        self.code.positions.append((node.pos_start, node.pos_end))
+        if op == OP_POP_TO:
+            self.depth = arg
+        else:
+            self.depth += stack_effect(op, arg)
+        return len(self.code.instructions) - 1
+
+    def patch(self, index, arg):
+        op, _ = self.code.instructions[index]
+        self.code.instructions[index] = (op, arg)
+
+    def here(self):
+        return len(self.code.instructions)
+
+    def add_const(self, val):
+        if isinstance(val, (Number, String)):
+            key = (type(val), type(val.val), val.val)
+        else:
+            key = (type(val), None, id(val))
+        index = self.const_indexes.get(key)
+        if index is None:
+            index = len(self.code.consts)
+            self.code.consts.append(val)
+            self.const_indexes[key] = index
+        return index
+
+    def add_name(self, name):
+        index = self.name_indexes.get(name)
+        if index is None:
+            index = len(self.code.names)
+            self.code.names.append(name)
+            self.name_indexes[name] = index
+        return index
+
+    # Nodes
+    def compile(self, node):
+        method = getattr(self, f'compile_{type(node).__name__}', self.no_compile_method)
+        method(node)
+
+    def no_compile_method(self, node):
+        raise Exception(f'No compile_{type(node).__name__} method defined')
+
+    def compile_block(self, node):
+        for statement in node.elements:
+            self.compile(statement)
+            self.emit(OP_POP, None, statement)
+
+    def compile_body(self, node, ret_null):
+        if ret_null:
+            self.compile_block(node)
+            self.emit(OP_LOAD_CONST, self.add_const(Number.null), node)
+        else:
+            self.compile(node)
+
+    def compile_NumberNode(self, node):
+        self.emit(OP_LOAD_CONST, self.add_const(Number(node.token.val)), node)
+
+    def compile_StringNode(self, node):
+        self.emit(OP_LOAD_CONST, self.add_const(String(node.token.val)), node)
+
+    def compile_ListNode(self, node):
+        if node.discarded:
+            self.compile_block(node)
+            self.emit(OP_LOAD_CONST, self.add_const(Number.null), node)
+            return
+        for element in node.elements:
+            self.compile(element)
+        self.emit(OP_BUILD_LIST, len(node.elements), node)
+
+    def compile_VarAccessNode(self, node):
+        if node.depth == LOCAL_DEPTH:
+            self.emit(OP_LOAD_FAST, node.slot, node)
+        elif node.depth == GLOBAL_DEPTH:
+            self.emit(OP_LOAD_GLOBAL, self.add_name(node.var_name_token.val), node)
+        else:
+            self.emit(OP_LOAD_NAME, self.add_name(node.var_name_token.val), node)
+
+    def compile_VarAssignNode(self, node):
+        self.compile(node.val_node)
+        self.compile_store(node, node.var_name_token.val)
+
+    def compile_store(self, node, name):
+        if node.depth == LOCAL_DEPTH:
+            self.emit(OP_STORE_FAST, node.slot, node)
+        else:
+            self.emit(OP_STORE_NAME, self.add_name(name), node)
+
+    def compile_BinOpNode(self, node):
+        self.compile(node.left_node)
+        self.compile(node.right_node)
+        self.emit(OP_BINARY_OP, node.op_method, node)
+
+    def compile_UnaryOpNode(self, node):
+        self.compile(node.node)
+        if node.op_method:
+            self.emit(OP_UNARY_OP, node.op_method, node)
+
+    def compile_IfNode(self, node):
+        depth = self.depth
+        end_jumps = []
+        for condition, expression, ret_null in node.cases:
+            self.compile(condition)
+            false_jump = self.emit(OP_POP_JUMP_IF_FALSE, None, condition)
+            self.compile_body(expression, ret_null)
+            end_jumps.append(self.emit(OP_JUMP, None, node))
+            self.patch(false_jump, self.here())
+            self.depth = depth
+        if node.else_case:
+            expression, ret_null = node.else_case
+            self.compile_body(expression, ret_null)
+        else:
+            self.emit(OP_LOAD_CONST, self.add_const(Number.null), node)
+        for jump in end_jumps:
+            self.patch(jump, self.here())
+
+    def compile_ForNode(self, node):
+        collect = not node.ret_null and not node.discarded
+        if collect:
+            self.emit(OP_BUILD_LIST, 0, node)
+        depth = self.depth
+        self.compile(node.start)
+        self.compile(node.end)
+        if node.step:
+            self.compile(node.step)
+        if node.parallel:
+            # Runs the whole loop on the process pool and jumps past it, or
+            # falls through to the serial loop below, see VM.execute()
+            parfor = self.emit(OP_PARFOR, None, node)
+        self.emit(OP_FOR_PREP, node.step is not None, node)
+        loop_start = self.here()
+        for_iter = self.emit(OP_FOR_ITER, None, node)
+        loop = Loop(loop_start, collect, True, depth)
+        self.compile_loop_body(loop, node)
+        self.emit(OP_JUMP, loop_start, node)
+        loop_end = self.here()
+        if node.depth == LOCAL_DEPTH:
+            self.patch(for_iter, (loop_end, node.slot, None))
+        else:
+            self.patch(for_iter, (loop_end, None, self.add_name(node.var.val)))
+        self.finish_loop(loop, node, loop_end)
+        if node.parallel:
+            self.patch(parfor, (self.add_const(node), node.step is not None, self.here()))
+
+    def compile_WhileNode(self, node):
+        collect = not node.ret_null and not node.discarded
+        if collect:
+            self.emit(OP_BUILD_LIST, 0, node)
+        loop_start = self.here()
+        loop = Loop(loop_start, collect, False, self.depth)
+        self.compile(node.condition)
+        exit_jump = self.emit(OP_POP_JUMP_IF_FALSE, None, node.condition)
+        self.compile_loop_body(loop, node)
+        self.emit(OP_JUMP, loop_start, node)
+        loop_end = self.here()
+        self.patch(exit_jump, loop_end)
+        self.finish_loop(loop, node, loop_end)
+
+    def compile_loop_body(self, loop, node):
+        self.loops.append(loop)
+        loop.body_start = self.here()
+        if loop.collect:
+            self.compile(node.body)
+            self.emit(OP_LIST_APPEND, 2 if loop.has_state else 1, node.body)
+        elif node.ret_null:
+            self.compile_block(node.body)
+        else:
+            self.compile(node.body)
+            self.emit(OP_POP, None, node.body)
+        self.loops.pop()
+
+    def finish_loop(self, loop, node, loop_end):
+        # BREAK drops the FOR state itself, so it lands after the point where
+        # FOR_ITER would have popped it.
+        for jump in loop.break_jumps:
+            self.patch(jump, loop_end)
+        self.code.loops.append((loop.body_start, loop_end, loop_end, loop.depth,
+                                loop.continue_target, loop.continue_depth))
+        self.depth = loop.depth
+        if not loop.collect:
+            self.emit(OP_LOAD_CONST, self.add_const(Number.null), node)
+
+    def compile_FuncDefNode(self, node):
+        func_name = node.var_name_token.val if node.var_name_token else None
+        arg_names = [arg_name.val for arg_name in node.args]
+        compiler = Compiler(func_name or '<NULL>', arg_names, node.auto_ret,
+                            in_function=True, slot_names=node.slot_names, frame=node.frame)
+        code = compiler.compile_function(node)
+        self.code.consts.append(code)
+        self.emit(OP_MAKE_FUNCTION, len(self.code.consts) - 1, node)
+        if func_name:
+            self.compile_store(node, func_name)
+
+    def compile_CallNode(self, node):
+        call_node = node.call_node
+        self.code.callees.append(call_node.var_name_token.val if isinstance(call_node, VarAccessNode) else None)
+        self.compile(node.call_node)
+        for arg in node.args:
+            self.compile(arg)
+        self.emit(OP_CALL, len(node.args), node)
+
+    def compile_ReturnNode(self, node):
+        depth = self.depth
+        if node.ret_node:
+            self.compile(node.ret_node)
+        else:
+            self.emit(OP_LOAD_CONST, self.add_const(Number.null), node)
+        if not self.in_function:
+            # A top-level RETURN ends the program without a result value
+            self.emit(OP_POP, None, node)
+            self.emit(OP_LOAD_CONST, self.add_const(None), node)
+        self.emit(OP_RETURN_VALUE, None, node)
+        # Nothing after it runs: as an expression it is taken to push one value
+        self.depth = depth + 1
+
+    def compile_InvariantNode(self, node):
+        # Hoisting is left to the tree-walking engines; the VM recomputes it
+        self.compile(node.node)
+
+    def compile_ContinueNode(self, node):
+        depth = self.depth
+        if not self.loops:
+            self.compile_stray_exit(node, False)
+        else:
+            loop = self.loops[-1]
+            self.pop_to(loop.continue_depth, node)
+            self.emit(OP_JUMP, loop.continue_target, node)
+        self.depth = depth + 1
+
+    def compile_BreakNode(self, node):
+        depth = self.depth
+        if not self.loops:
+            self.compile_stray_exit(node, True)
+        else:
+            loop = self.loops[-1]
+            self.pop_to(loop.depth, node)
+            loop.break_jumps.append(self.emit(OP_JUMP, None, node))
+        self.depth = depth + 1
+
+    def pop_to(self, depth, node):
+        # Operands of the expressions the exit sits in, e.g. [1, BREAK]
+        if self.depth > depth:
+            self.emit(OP_POP_TO, depth, node)
+
+    def compile_stray_exit(self, node, is_break):
+        if self.in_function:
+            # Like the Interpreter's unhandled signal, the exit leaves the
+            # function and ends the loop the call is in, see VM.execute()
+            self.emit(OP_EXIT_LOOP, is_break, node)
+        else:
+            # Outside of any function it ends the program
+            self.emit(OP_LOAD_CONST, self.add_const(None), node)
+            self.emit(OP_RETURN_VALUE, None, node)
+
+
+def compile_ast(node, name='<program>'):
+    return Compiler(name).compile_program(node)
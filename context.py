@@ -1,6 +1,41 @@
+# Characters PRINT collects before writing them out
+DEFAULT_BUFFER_SIZE = 1 << 16
+
+
+class OutputSink:
+    """
+    Where PRINT output goes. Text is buffered and handed to target in large
+    writes: when buffer_size characters have piled up, on flush(), and
+    at the end of every run. target is anything with a write() method,
+    such as a file or an io.StringIO, or None to throw the output away.
+    """
+    def __init__(self, target, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.target = target
+        self.buffer_size = buffer_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        parts, self.parts, self.size = self.parts, [], 0
+        if self.target is not None:
+            self.target.write(''.join(parts))
+            flush = getattr(self.target, 'flush', None)
+            if flush:
+                flush()
+
+
 class Context:
-    def __init__(self, display_name, parent=None, parent_entry_pos=None):
+    def __init__(self, display_name, parent=None, parent_entry_pos=None, output=None, runtime=None):
         self.display_name = display_name
         self.parent = parent
         self.parent_entry_pos = parent_entry_pos
         self.symbol_table = None
+        # Shared with every context created under this one
+        self.output = output if output is not None or parent is None else parent.output
+        self.runtime = runtime if runtime is not None or parent is None else parent.runtime
@@ -0,0 +1,332 @@
+from lang import *
+from optimizer import lazy_loop
+
+
+class ReturnSignal(Exception):
+    def __init__(self, val):
+        super().__init__()
+        self.val = val
+
+
+class BreakSignal(Exception):
+    pass
+
+
+class ContinueSignal(Exception):
+    pass
+
+
+class ErrorSignal(Exception):
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+
+# BREAK and CONTINUE carry nothing, so one instance of each is raised every time
+BREAK = BreakSignal()
+CONTINUE = ContinueSignal()
+
+
+class DirectFunction(BaseFunction):
+    def __init__(self, name, body, arg_names, auto_ret, frame=None):
+        super().__init__(name)
+        self.body = body
+        self.arg_names = arg_names
+        self.auto_ret = auto_ret
+        self.frame = frame
+
+    def execute(self, args, context, pos_start, pos_end):
+        # Entry point for callers outside of the DirectInterpreter, e.g. builtins
+        response = RTResult()
+        try:
+            return response.success(DirectInterpreter().call(self, args, context, pos_start, pos_end))
+        except ErrorSignal as signal:
+            return response.failure(signal.error)
+        except BreakSignal:
+            return response.success_break()
+        except ContinueSignal:
+            return response.success_continue()
+
+    def make_caller(self, context, pos_start, pos_end):
+        interpreter = DirectInterpreter()
+
+        def call(args):
+            try:
+                return interpreter.call(self, args, context, pos_start, pos_end), None
+            except ErrorSignal as signal:
+                return None, signal.error
+            except (BreakSignal, ContinueSignal):
+                return Number.null, None
+        return call
+
+    def copy(self):
+        return DirectFunction(self.name, self.body, self.arg_names, self.auto_ret, self.frame)
+
+    def __repr__(self):
+        return f"<function {self.name}>"
+
+
+class DirectInterpreter:
+    """
+    Evaluates the same AST as Interpreter, with the same results, but
+    visit_ methods return values directly. The rare non-local exits travel
+    as exceptions instead of being checked for after every child visit:
+    RETURN raises ReturnSignal, BREAK and CONTINUE their shared signals, and
+    runtime errors ErrorSignal. Like the RTResult flags they replace, BREAK
+    and CONTINUE pass through function calls until a loop catches them.
+    """
+    # Node class -> unbound visit_ method, filled in by build_dispatch_table()
+    dispatch = {}
+
+    @classmethod
+    def build_dispatch_table(cls):
+        cls.dispatch = {}
+        for node_class in NODE_TYPES:
+            method = getattr(cls, f'visit_{node_class.__name__}', None)
+            if method is not None:
+                cls.dispatch[node_class] = method
+
+    def execute(self, node, context):
+        try:
+            return self.visit(node, context), None
+        except ErrorSignal as signal:
+            return None, signal.error
+        except (ReturnSignal, BreakSignal, ContinueSignal):
+            # An exit outside of any function or loop ends the program
+            return None, None
+
+    def visit(self, node, context):
+        method = self.dispatch.get(type(node))
+        if method is None:
+            raise Exception(f'No visit_{type(node).__name__} method defined')
+        return method(self, node, context)
+
+    def call(self, function, args, context, pos_start, pos_end):
+        new_context, error = function.new_frame(args, context, pos_start, function.frame)
+        if error:
+            raise ErrorSignal(error.set_pos(pos_start, pos_end, context))
+        visit = self.visit
+        try:
+            if function.auto_ret:
+                return visit(function.body, new_context)
+            # A RETURN directly in the body's statement list needs no signal
+            for statement in function.body.elements:
+                if type(statement) is ReturnNode:
+                    return visit(statement.ret_node, new_context) if statement.ret_node else Number.null
+                visit(statement, new_context)
+        except ReturnSignal as signal:
+            return signal.val
+        return Number.null
+
+    # noinspection PyMethodMayBeStatic
+    def visit_NumberNode(self, node, context):
+        return make_number(node.token.val)
+
+    # noinspection PyMethodMayBeStatic
+    def visit_StringNode(self, node, context):
+        return String(node.token.val)
+
+    def visit_ListNode(self, node, context):
+        visit = self.visit
+        if node.discarded:
+            for element in node.elements:
+                visit(element, context)
+            return Number.null
+        return List([visit(element, context) for element in node.elements])
+
+    # noinspection PyMethodMayBeStatic
+    def visit_VarAccessNode(self, node, context):
+        var_name = node.var_name_token.val
+        symbol_table = context.symbol_table
+        if node.depth == LOCAL_DEPTH:
+            val = symbol_table.slots[node.slot]
+            if val is None and symbol_table.parent:
+                val = symbol_table.parent.get(var_name)
+        elif node.depth == GLOBAL_DEPTH and symbol_table.program is not None:
+            val = symbol_table.globals.symbols.get(var_name) or symbol_table.get(var_name)
+        else:
+            val = symbol_table.get(var_name)
+        if not val:
+            raise ErrorSignal(RTError(node.pos_start, node.pos_end, f"'{var_name}' is not defined", context))
+        return val
+
+    def visit_VarAssignNode(self, node, context):
+        val = self.visit(node.val_node, context)
+        self.assign(node, node.var_name_token.val, val, context)
+        return val
+
+    # noinspection PyMethodMayBeStatic
+    def assign(self, node, var_name, val, context):
+        if node.depth == LOCAL_DEPTH:
+            context.symbol_table.slots[node.slot] = val
+        else:
+            context.symbol_table.set(var_name, val)
+
+    def visit_BinOpNode(self, node, context):
+        left = self.visit(node.left_node, context)
+        right = self.visit(node.right_node, context)
+        result, error = getattr(left, node.op_method)(right)
+        if error:
+            raise ErrorSignal(error.set_pos(node.pos_start, node.pos_end, context))
+        return result
+
+    def visit_UnaryOpNode(self, node, context):
+        val = self.visit(node.node, context)
+        if not node.op_method:
+            return val
+        result, error = getattr(val, node.op_method)()
+        if error:
+            raise ErrorSignal(error.set_pos(node.pos_start, node.pos_end, context))
+        return result
+
+    def visit_IfNode(self, node, context):
+        for condition, expression, ret_null in node.cases:
+            if self.visit(condition, context).is_true():
+                expr_val = self.visit(expression, context)
+                return Number.null if ret_null else expr_val
+        if node.else_case:
+            expression, ret_null = node.else_case
+            expr_val = self.visit(expression, context)
+            return Number.null if ret_null else expr_val
+        return Number.null
+
+    def visit_ForNode(self, node, context):
+        visit = self.visit
+        elements = []
+        collect = not node.ret_null and not node.discarded
+        start = visit(node.start, context)
+        end = visit(node.end, context)
+        step = visit(node.step, context) if node.step else make_number(1)
+        error = for_bounds_error(node, (start, end, step), context)
+        if error:
+            raise ErrorSignal(error)
+        end, step = end.val, step.val
+        if node.parallel:
+            result = self.parallel_for(node, start.val, end, step, context)
+            if result is not None:
+                elements, error = result
+                if error:
+                    raise ErrorSignal(error)
+                return List(elements) if collect else Number.null
+        if node.lazy_vars is not None:
+            lazy_list = self.lazy_for(node, start.val, end, step, context)
+            if lazy_list:
+                return lazy_list
+        for invariant in node.invariants:
+            invariant.val = None
+        var_name = node.var.val
+        body = node.body
+        assign_each = node.var_in_body
+        i = None
+        try:
+            for i in counter_values(start.val, end, step):
+                if assign_each:
+                    self.assign(node, var_name, make_number(i), context)
+                try:
+                    val = visit(body, context)
+                except ContinueSignal:
+                    continue
+                except BreakSignal:
+                    break
+                if collect:
+                    elements.append(val)
+        finally:
+            # However the loop ends, the variable holds the last counter value
+            if not assign_each and i is not None:
+                self.assign(node, var_name, make_number(i), context)
+        return List(elements) if collect else Number.null
+
+    # noinspection PyMethodMayBeStatic
+    def parallel_for(self, node, start, end, step, context):
+        return load_parallel().run_parallel(node, start, end, step, context, 'direct')
+
+    def lazy_for(self, node, start, end, step, context):
+        values = []
+        for var_node in node.lazy_vars:
+            try:
+                values.append(self.visit(var_node, context))
+            except ErrorSignal:
+                # Left for the eager loop to report, if its body gets that far
+                return None
+        loop = lazy_loop(node, start, end, step, values, context)
+        if loop is None:
+            return None
+        indices, snapshot = loop
+        if indices:
+            self.assign(node, node.var.val, make_number(indices[-1]), context)
+        return LazyList(lambda: self.lazy_elements(node, indices, snapshot))
+
+    def lazy_elements(self, node, indices, context):
+        for invariant in node.invariants:
+            invariant.val = None
+        visit = self.visit
+        body = node.body
+        var_name = node.var.val
+        symbol_table = context.symbol_table
+        elements = []
+        for i in indices:
+            symbol_table.set(var_name, make_number(i))
+            elements.append(visit(body, context))
+        return elements
+
+    def visit_WhileNode(self, node, context):
+        visit = self.visit
+        elements = []
+        collect = not node.ret_null and not node.discarded
+        for invariant in node.invariants:
+            invariant.val = None
+        while visit(node.condition, context).is_true():
+            try:
+                val = visit(node.body, context)
+            except ContinueSignal:
+                continue
+            except BreakSignal:
+                break
+            if collect:
+                elements.append(val)
+        return List(elements) if collect else Number.null
+
+    def visit_FuncDefNode(self, node, context):
+        func_name = node.var_name_token.val if node.var_name_token else None
+        arg_names = [arg_name.val for arg_name in node.args]
+        func_val = DirectFunction(func_name, node.body, arg_names, node.auto_ret, node.frame)
+        if node.var_name_token:
+            self.assign(node, func_name, func_val, context)
+        return func_val
+
+    def visit_CallNode(self, node, context):
+        visit = self.visit
+        call_val = visit(node.call_node, context)
+        args = [visit(arg, context) for arg in node.args]
+        if type(call_val) is DirectFunction:
+            return self.call(call_val, args, context, node.pos_start, node.pos_end)
+        response = call_val.execute(args, context, node.pos_start, node.pos_end)
+        if response.error:
+            raise ErrorSignal(response.error)
+        if response.loop_break:
+            raise BREAK
+        if response.loop_continue:
+            raise CONTINUE
+        return response.val
+
+    def visit_InvariantNode(self, node, context):
+        if node.val is not None:
+            return node.val
+        val = self.visit(node.node, context)
+        if is_reusable(val) and all(is_reusable(self.visit(var_node, context)) for var_node in node.var_nodes):
+            node.val = val
+        return val
+
+    def visit_ReturnNode(self, node, context):
+        raise ReturnSignal(self.visit(node.ret_node, context) if node.ret_node else Number.null)
+
+    # noinspection PyMethodMayBeStatic
+    def visit_ContinueNode(self, node, context):
+        raise CONTINUE
+
+    # noinspection PyMethodMayBeStatic
+    def visit_BreakNode(self, node, context):
+        raise BREAK
+
+
+DirectInterpreter.build_dispatch_table()
@@ -35,6 +35,18 @@ class RTError(Error):
         super().__init__(pos_start, pos_end, 'Runtime Error', details)
         self.context = context
 
+    def set_pos(self, pos_start, pos_end, context=None):
+        """
+        Attaches the position (and context) of the node that raised the error,
+        unless it already has one from further down the call stack.
+        """
+        if self.pos_start is None:
+            self.pos_start = pos_start
+            self.pos_end = pos_end
+        if self.context is None:
+            self.context = context
+        return self
+
     def to_string(self):
         result = self.generate_traceback()
         result += f'{self.error_type}: {self.details} \n'
@@ -47,11 +59,10 @@ class RTError(Error):
         context_stack = self.context
 
         while context_stack:
-            if not pos.file_name:
-                pos.file_name = '<std_in>'
-            result = f'  File {pos.file_name}, line {str(pos.ln + 1)}, in {context_stack.display_name}\n' + result
+            file_name = pos.file_name or '<std_in>'
+            result = f'  File {file_name}, line {str(pos.ln + 1)}, in {context_stack.display_name}\n' + result
             pos = context_stack.parent_entry_pos
-            context_stack = self.context
+            context_stack = context_stack.parent
 
         return 'Traceback (most recent call last):\n' + result
 
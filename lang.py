@@ -1,10 +1,18 @@
 from context import *
 from symbol_table import *
 import string
+import persistent_list
 from error_handling import *
 from node_types import *
+from resolver import *
+from parse_cache import *
 import os
+import sys
 import math
+import operator
+import re
+from bisect import bisect_right
+from array import array
 
 # Constants
 DIGITS = '0123456789'
@@ -43,6 +51,60 @@ TT_EOL = 'EOL'
 
 TT_EOF = 'EOF'
 
+# Tokens an expression (and, with these keywords, a statement) can start with
+EXPR_START_TYPES = {TT_INT, TT_FLOAT, TT_STRING, TT_IDENTIFIER, TT_LPAR, TT_LBRAK, TT_ADD, TT_SUB}
+EXPR_START_KEYWORDS = {'VAR', 'IF', 'FOR', 'PARFOR', 'WHILE', 'FUN', 'NOT'}
+STATEMENT_KEYWORDS = {'RETURN', 'CONTINUE', 'BREAK'}
+
+# Value method each operator token evaluates to, bound onto BinOpNode and
+# UnaryOpNode by the Parser so the Interpreter does not re-derive it per visit
+BINARY_OP_METHODS = {
+    TT_ADD: 'add_to',
+    TT_SUB: 'sub_by',
+    TT_MUL: 'mul_by',
+    TT_DIV: 'div_by',
+    TT_MOD: 'mod_by',
+    TT_POW: 'pow_by',
+    TT_EEQ: 'get_comparison_eeq',
+    TT_NEQ: 'get_comparison_neq',
+    TT_LT: 'get_comparison_lt',
+    TT_GT: 'get_comparison_gt',
+    TT_LTE: 'get_comparison_lte',
+    TT_GTE: 'get_comparison_gte',
+    (TT_KEYWORD, 'AND'): 'and_with',
+    (TT_KEYWORD, 'OR'): 'or_with',
+}
+
+# Binary operator -> (precedence, minimum precedence of its right operand).
+# A right operand binding one level tighter makes an operator left
+# associative; POW takes a unary-level right operand, so it associates to
+# the right and accepts a sign (2 ^ -1). Unary +/- bind tighter than every
+# binary operator but POW, NOT only as tightly as a comparison.
+LOGICAL_PRECEDENCE = 1
+COMPARISON_PRECEDENCE = 2
+UNARY_PRECEDENCE = 5
+BINARY_PRECEDENCE = {
+    (TT_KEYWORD, 'AND'): (1, 2),
+    (TT_KEYWORD, 'OR'): (1, 2),
+    TT_EEQ: (2, 3),
+    TT_NEQ: (2, 3),
+    TT_LT: (2, 3),
+    TT_GT: (2, 3),
+    TT_LTE: (2, 3),
+    TT_GTE: (2, 3),
+    TT_ADD: (3, 4),
+    TT_SUB: (3, 4),
+    TT_MUL: (4, 5),
+    TT_DIV: (4, 5),
+    TT_MOD: (4, 5),
+    TT_POW: (6, 5),
+}
+UNARY_OP_METHODS = {
+    TT_ADD: None,
+    TT_SUB: 'neg_of',
+    (TT_KEYWORD, 'NOT'): 'not_of',
+}
+
 KEYWORDS = [
     'VAR',
     'AND',
@@ -54,6 +116,7 @@ KEYWORDS = [
     'ELIF',
     'ELSE',
     'FOR',
+    'PARFOR',
     'TO',
     'STEP',
     'WHILE',
@@ -64,45 +127,101 @@ KEYWORDS = [
 ]
 
 
+# Source Class
+class Source:
+    """
+    Text of one file shared by every Position into it. Line starts are
+    only computed the first time a line or column is asked for, which in
+    practice means when an error is reported.
+    """
+    __slots__ = ('file_name', 'text', 'line_starts')
+
+    def __init__(self, file_name, text):
+        self.file_name = file_name
+        self.text = text
+        self.line_starts = None
+
+    def line_col(self, index):
+        if self.line_starts is None:
+            line_starts = [0]
+            newline = self.text.find('\n')
+            while newline >= 0:
+                line_starts.append(newline + 1)
+                newline = self.text.find('\n', newline + 1)
+            self.line_starts = line_starts
+        if index < 0:
+            return 0, index
+        ln = bisect_right(self.line_starts, index) - 1
+        return ln, index - self.line_starts[ln]
+
+
 # Position Class
 class Position:
-    def __init__(self, index, ln, col, file_name, file_txt):
+    __slots__ = ('index', 'source')
+
+    def __init__(self, index, source):
         self.index = index
-        self.ln = ln
-        self.col = col
-        self.file_name = file_name
-        self.file_txt = file_txt
+        self.source = source
 
-    def advance(self, curr_char=None):
-        self.index += 1
-        self.col += 1
+    @property
+    def ln(self):
+        return self.source.line_col(self.index)[0]
 
-        if curr_char == '\n':
-            self.ln += 1
-            self.col = 0
+    @property
+    def col(self):
+        return self.source.line_col(self.index)[1]
 
+    @property
+    def file_name(self):
+        return self.source.file_name
+
+    @property
+    def file_txt(self):
+        return self.source.text
+
+    def advance(self):
+        self.index += 1
         return self
 
     def copy(self):
-        return Position(self.index, self.ln, self.col, self.file_name, self.file_txt)
+        return Position(self.index, self.source)
 
 
 # Token Class
 class Token:
+    """
+    Tokens keep their span as integer offsets into the shared Source;
+    pos_start/pos_end build Position objects on demand.
+    """
+    __slots__ = ('type', 'val', 'start', 'end', 'source')
+
     def __init__(self, type_, val=None, pos_start=None, pos_end=None):
         self.type = type_
         self.val = val
+        self.start = self.end = -1
+        self.source = None
 
         if pos_start:
-            self.pos_start = pos_start.copy()
-            self.pos_end = pos_start.copy()
-            self.pos_end.advance()
+            self.start = pos_start.index
+            self.end = pos_start.index + 1
+            self.source = pos_start.source
         if pos_end:
-            self.pos_end = pos_end
+            self.end = pos_end.index
+
+    @property
+    def pos_start(self):
+        return Position(self.start, self.source)
+
+    @property
+    def pos_end(self):
+        return Position(self.end, self.source)
 
     def matches(self, type_, val):
         return self.type == type_ and self.val == val
 
+    def op_key(self):
+        return (self.type, self.val) if self.type == TT_KEYWORD else self.type
+
     # String representation
     def __repr__(self):
         if self.val:
@@ -111,84 +230,111 @@ class Token:
             return f'{self.type}'
 
 
+class SpanToken(Token):
+    """Token built straight from offsets, as RegexLexer produces them."""
+    __slots__ = ()
+
+    def __init__(self, type_, val, start, end, source):
+        self.type = type_
+        self.val = val
+        self.start = start
+        self.end = end
+        self.source = source
+
+
 class Lexer:
     def __init__(self, file_name, text):
         self.file_name = file_name
         self.text = text
-        self.pos = Position(-1, 0, -1, file_name, text)
+        self.pos = Position(-1, Source(file_name, text))
         self.curr_char = None
+        self.error = None
         self.advance()
 
     def advance(self):
-        self.pos.advance(self.curr_char)
+        self.pos.advance()
         self.curr_char = self.text[self.pos.index] if self.pos.index < len(self.text) else None
 
     def make_tokens(self):
-        tokens = []
+        tokens = list(self.generate_tokens())
+        if self.error:
+            return [], self.error
+        return tokens, None
+
+    def generate_tokens(self):
+        """
+        Yields tokens as they are scanned. An illegal character ends the
+        stream with an EOF token and leaves the error in self.error.
+        """
+        self.error = None
         while self.curr_char is not None:
             if self.curr_char in ' \t':
                 self.advance()
             elif self.curr_char in ';\n':
-                tokens.append(Token(TT_EOL, pos_start=self.pos))
+                yield Token(TT_EOL, pos_start=self.pos)
                 self.advance()
             elif self.curr_char == '#':
                 self.skip_comment()
             elif self.curr_char in DIGITS:
-                tokens.append(self.make_num())
+                yield self.make_num()
             elif self.curr_char in LETTERS:
-                tokens.append(self.make_identifier())
+                yield self.make_identifier()
             elif self.curr_char == '"':
-                tokens.append(self.make_string())
+                yield self.make_string()
             elif self.curr_char == '+':
-                tokens.append(Token(TT_ADD, pos_start=self.pos))
+                yield Token(TT_ADD, pos_start=self.pos)
                 self.advance()
             elif self.curr_char == '-':
-                tokens.append(self.make_sub_or_arrow())
+                yield self.make_sub_or_arrow()
             elif self.curr_char == '*':
-                tokens.append(Token(TT_MUL, pos_start=self.pos))
+                yield Token(TT_MUL, pos_start=self.pos)
                 self.advance()
             elif self.curr_char == '/':
-                tokens.append(Token(TT_DIV, pos_start=self.pos))
+                yield Token(TT_DIV, pos_start=self.pos)
                 self.advance()
             elif self.curr_char == '%':
-                tokens.append(Token(TT_MOD, pos_start=self.pos))
+                yield Token(TT_MOD, pos_start=self.pos)
                 self.advance()
             elif self.curr_char == '^':
-                tokens.append(Token(TT_POW, pos_start=self.pos))
+                yield Token(TT_POW, pos_start=self.pos)
                 self.advance()
             elif self.curr_char == '(':
-                tokens.append(Token(TT_LPAR, pos_start=self.pos))
+                yield Token(TT_LPAR, pos_start=self.pos)
                 self.advance()
             elif self.curr_char == ')':
-                tokens.append(Token(TT_RPAR, pos_start=self.pos))
+                yield Token(TT_RPAR, pos_start=self.pos)
                 self.advance()
             elif self.curr_char == '[':
-                tokens.append(Token(TT_LBRAK, pos_start=self.pos))
+                yield Token(TT_LBRAK, pos_start=self.pos)
                 self.advance()
             elif self.curr_char == ']':
-                tokens.append(Token(TT_RBRAK, pos_start=self.pos))
+                yield Token(TT_RBRAK, pos_start=self.pos)
                 self.advance()
             elif self.curr_char == ',':
-                tokens.append(Token(TT_COMMA, pos_start=self.pos))
+                yield Token(TT_COMMA, pos_start=self.pos)
                 self.advance()
             elif self.curr_char == '!':
                 token, error = self.make_not_equals()
                 if error:
-                    return [], error
-                tokens.append(token)
+                    self.error = error
+                    yield Token(TT_EOF, pos_start=self.pos)
+                    return
+                yield token
             elif self.curr_char == '=':
-                tokens.append(self.make_equals())
+                yield self.make_equals()
             elif self.curr_char == '<':
-                tokens.append(self.make_less_than())
+                yield self.make_less_than()
             elif self.curr_char == '>':
-                tokens.append(self.make_greater_than())
+                yield self.make_greater_than()
             else:
                 pos_start = self.pos.copy()
                 char = self.curr_char
                 self.advance()
-                return [], IllegalCharError(pos_start, self.pos, "'" + char + "'")
-        tokens.append(Token(TT_EOF, pos_start=self.pos))
-        return tokens, None
+                self.error = IllegalCharError(pos_start, self.pos, "'" + char + "'")
+                yield Token(TT_EOF, pos_start=self.pos)
+                return
+        yield Token(TT_EOF, pos_start=self.pos)
+
 
     def make_num(self):
         num_str = ''
@@ -242,7 +388,7 @@ class Lexer:
             self.advance()
 
         token_type = TT_KEYWORD if id_str in KEYWORDS else TT_IDENTIFIER
-        return Token(token_type, id_str, pos_start, self.pos)
+        return Token(token_type, sys.intern(id_str), pos_start, self.pos)
 
     def make_sub_or_arrow(self):
         token_type = TT_SUB
@@ -303,22 +449,100 @@ class Lexer:
         self.advance()
 
 
+class RegexLexer:
+    """
+    Lexer producing the same tokens and errors as Lexer, but scanning each
+    lexeme with one compiled pattern instead of a character at a time.
+    A comment running to the end of the file simply ends the token stream.
+    """
+    ESCAPES = {'n': '\n', 't': '\t'}
+    OPERATOR_TOKENS = {
+        '+': TT_ADD, '-': TT_SUB, '*': TT_MUL, '/': TT_DIV, '%': TT_MOD,
+        '^': TT_POW, '(': TT_LPAR, ')': TT_RPAR, '[': TT_LBRAK, ']': TT_RBRAK,
+        ',': TT_COMMA, '=': TT_EQ, '<': TT_LT, '>': TT_GT, ';': TT_EOL, '\n': TT_EOL,
+        '->': TT_ARROW, '==': TT_EEQ, '!=': TT_NEQ, '<=': TT_LTE, '>=': TT_GTE,
+    }
+    PATTERN = re.compile(r'''
+        [ \t]*
+        (?:
+        (?P<COMMENT>\#[^\n]*\n?)
+      | (?P<OP>->|[=!<>]=|[-+*/%^()\[\],=<>;\n])
+      | (?P<IDENTIFIER>[A-Za-z][A-Za-z0-9_]*)
+      | (?P<NUMBER>[0-9]+(?P<FRACTION>\.[0-9]*)?)
+      | (?P<STRING>"(?P<BODY>(?:[^"\\]|\\.?)*)(?P<CLOSE>"?))
+      | (?P<BANG>!)
+      | (?P<ILLEGAL>.)
+      | $
+        )
+    ''', re.VERBOSE | re.DOTALL)
+
+    def __init__(self, file_name, text):
+        self.file_name = file_name
+        self.text = text
+        self.source = Source(file_name, text)
+        self.error = None
+
+    def make_tokens(self):
+        tokens = list(self.generate_tokens())
+        if self.error:
+            return [], self.error
+        return tokens, None
+
+    def generate_tokens(self):
+        self.error = None
+        source = self.source
+        op_types = self.OPERATOR_TOKENS
+        end = 0
+        for match in self.PATTERN.finditer(self.text):
+            # Each match is the blanks before a lexeme plus the lexeme itself
+            kind = match.lastgroup
+            if kind is None:
+                # Trailing blanks; an unterminated string has already
+                # stepped past the end
+                end = max(end, match.end())
+                continue
+            start, end = match.span(kind)
+            if kind == 'OP':
+                yield SpanToken(op_types[match.group(kind)], None, start, end, source)
+            elif kind == 'IDENTIFIER':
+                name = sys.intern(match.group(kind))
+                yield SpanToken(TT_KEYWORD if name in KEYWORDS else TT_IDENTIFIER, name, start, end, source)
+            elif kind == 'NUMBER':
+                if match.group('FRACTION') is None:
+                    yield SpanToken(TT_INT, int(match.group(kind)), start, end, source)
+                else:
+                    yield SpanToken(TT_FLOAT, float(match.group(kind)), start, end, source)
+            elif kind == 'STRING':
+                if not match.group('CLOSE'):
+                    # Lexer steps past the end of an unterminated string
+                    end += 1
+                yield SpanToken(TT_STRING, self.unescape(match.group('BODY')), start, end, source)
+            elif kind == 'BANG':
+                end = start + 2
+                self.error = ExpectedCharError(Position(start, source), Position(end, source), "'=' (after '!')")
+                break
+            elif kind == 'ILLEGAL':
+                self.error = IllegalCharError(Position(start, source), Position(end, source), "'" + match.group(kind) + "'")
+                break
+        yield SpanToken(TT_EOF, None, end, end + 1, source)
+
+    def unescape(self, body):
+        if '\\' not in body:
+            return body
+        return re.sub(r'\\(.?)', lambda match: self.ESCAPES.get(match.group(1), match.group(1)), body, flags=re.DOTALL)
+
+
 class Value:
-    def __init__(self):
-        self.set_pos()
-        self.set_context()
-        self.pos_start = None
-        self.pos_end = None
-        self.context = None
-
-    def set_pos(self, pos_start=None, pos_end=None):
-        self.pos_start = pos_start
-        self.pos_end = pos_end
-        return self
+    """
+    Base class for runtime values. Values do not carry source positions or
+    a context; reading a variable hands out the stored object itself. Errors
+    raised by value operations get the position and context of the node
+    that triggered them attached by the caller (see RTError.set_pos).
+    """
+    __slots__ = ()
 
-    def set_context(self, context=None):
-        self.context = context
-        return self
+    def __init__(self):
+        pass
 
     def add_to(self, other):
         return None, self.illegal_operation(other)
@@ -362,8 +586,11 @@ class Value:
     def not_of(self):
         return None, self.illegal_operation()
 
-    def execute(self, args):
-        return RTResult().failure(self.illegal_operation())
+    def neg_of(self):
+        return self.mul_by(make_number(-1))
+
+    def execute(self, args, context, pos_start, pos_end):
+        return RTResult().failure(self.illegal_operation().set_pos(pos_start, pos_end, context))
 
     def copy(self):
         raise Exception('No copy method defined')
@@ -371,158 +598,258 @@ class Value:
     def is_true(self):
         return False
 
+    # noinspection PyMethodMayBeStatic
+    def runtime_error(self, details):
+        return RTError(None, None, details, None)
+
     def illegal_operation(self, other=None):
-        if not other:
-            other = self
-        return RTError(
-            self.pos_start, other.pos_end,
-            'Illegal operation',
-            self.context
-        )
+        return self.runtime_error('Illegal operation')
+
+
+class AllocationCounter:
+    """
+    Counts the Value objects created while it is active, by class name:
+
+        with AllocationCounter() as counter:
+            run('<stdin>', text)
+        counter.counts  # {'Number': ..., 'List': ...}
+
+    It wraps the __init__ methods of Value and its subclasses only for the
+    duration of the with block, so there is no cost otherwise.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.originals = {}
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def __enter__(self):
+        classes = [Value]
+        for cls in classes:
+            classes.extend(cls.__subclasses__())
+            if '__init__' in cls.__dict__:
+                self.originals[cls] = cls.__dict__['__init__']
+                cls.__init__ = self.counting_init(cls.__dict__['__init__'])
+        return self
+
+    def counting_init(self, init):
+        counts = self.counts
+
+        def counting_init(value, *args, **kwargs):
+            # Only the most derived __init__ counts; the rest run via super()
+            if type(value).__init__ is counting_init:
+                counts[type(value).__name__] = counts.get(type(value).__name__, 0) + 1
+            init(value, *args, **kwargs)
+
+        return counting_init
+
+    def __exit__(self, *exc_info):
+        for cls, init in self.originals.items():
+            cls.__init__ = init
+        self.originals = {}
 
 
 class Number(Value):
+    """
+    Numbers are never changed in place, so one object may stand for every
+    occurrence of a value: results that are small integers come from
+    SMALL_INTS (see make_number) and comparisons return Number.true or
+    Number.false.
+    """
+    __slots__ = ('val',)
+
     def __init__(self, val):
-        super().__init__()
         self.val = val
 
     def add_to(self, other):
         if isinstance(other, Number):
-            return Number(self.val + other.val).set_context(self.context), None
+            return make_number(self.val + other.val), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def sub_by(self, other):
         if isinstance(other, Number):
-            return Number(self.val - other.val).set_context(self.context), None
+            return make_number(self.val - other.val), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def mul_by(self, other):
         if isinstance(other, Number):
-            return Number(self.val * other.val).set_context(self.context), None
+            return make_number(self.val * other.val), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def div_by(self, other):
         if isinstance(other, Number):
             if other.val == 0:
-                return None, RTError(other.pos_start, other.pos_end,
-                                     'Division by Zero', self.context)
-            return Number(self.val / other.val).set_context(self.context), None
+                return None, self.runtime_error('Division by Zero')
+            return Number(self.val / other.val), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def mod_by(self, other):
         if isinstance(other, Number):
             if other.val == 0:
-                return None, RTError(other.pos_start, other.pos_end,
-                                     'Division by Zero', self.context)
-            return Number(self.val % other.val).set_context(self.context), None
+                return None, self.runtime_error('Division by Zero')
+            return make_number(self.val % other.val), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def pow_by(self, other):
         if isinstance(other, Number):
-            return Number(self.val ** other.val).set_context(self.context), None
+            return make_number(self.val ** other.val), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def get_comparison_eeq(self, other):
         if isinstance(other, Number):
-            return Number(int(self.val == other.val)).set_context(self.context), None
+            return (Number.true if self.val == other.val else Number.false), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def get_comparison_neq(self, other):
         if isinstance(other, Number):
-            return Number(int(self.val != other.val)).set_context(self.context), None
+            return (Number.true if self.val != other.val else Number.false), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def get_comparison_lt(self, other):
         if isinstance(other, Number):
-            return Number(int(self.val < other.val)).set_context(self.context), None
+            return (Number.true if self.val < other.val else Number.false), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def get_comparison_gt(self, other):
         if isinstance(other, Number):
-            return Number(int(self.val > other.val)).set_context(self.context), None
+            return (Number.true if self.val > other.val else Number.false), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def get_comparison_lte(self, other):
         if isinstance(other, Number):
-            return Number(int(self.val <= other.val)).set_context(self.context), None
+            return (Number.true if self.val <= other.val else Number.false), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def get_comparison_gte(self, other):
         if isinstance(other, Number):
-            return Number(int(self.val >= other.val)).set_context(self.context), None
+            return (Number.true if self.val >= other.val else Number.false), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def and_with(self, other):
         if isinstance(other, Number):
-            return Number(int(self.val and other.val)).set_context(self.context), None
+            return make_number(int(self.val and other.val)), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def or_with(self, other):
         if isinstance(other, Number):
-            return Number(int(self.val or other.val)).set_context(self.context), None
+            return make_number(int(self.val or other.val)), None
         else:
-            return None, Value.illegal_operation(self.pos_start, other.pos_end)
+            return None, self.illegal_operation(other)
 
     def not_of(self):
-        return Number(1 if self.val == 0 else 0).set_context(self.context), None
+        return (Number.true if self.val == 0 else Number.false), None
 
     def is_true(self):
         return self.val != 0
 
     def copy(self):
-        copy = Number(self.val)
-        copy.set_pos(self.pos_start, self.pos_end)
-        copy.set_context(self.context)
-        return copy
+        return Number(self.val)
 
     def __repr__(self):
         return str(self.val)
 
 
-Number.null = Number(0)
-Number.false = Number(0)
-Number.true = Number(1)
+# Shared Number objects for the integers results most often are (CPython
+# keeps a similar cache of its own int objects)
+SMALL_INT_MIN = -128
+SMALL_INT_MAX = 1024
+SMALL_INTS = [Number(val) for val in range(SMALL_INT_MIN, SMALL_INT_MAX + 1)]
+
+
+def make_number(val):
+    """Number for val, shared with other uses of the same small integer."""
+    if type(val) is int and SMALL_INT_MIN <= val <= SMALL_INT_MAX:
+        return SMALL_INTS[val - SMALL_INT_MIN]
+    return Number(val)
+
+
+Number.null = Number.false = make_number(0)
+Number.true = make_number(1)
 Number.math_PI = Number(math.pi)
 
 
+# Shorter results of String + are joined right away
+LAZY_JOIN_MIN_LENGTH = 64
+
+
 class String(Value):
+    """
+    Text of a String is joined lazily: a + whose result is long gives a
+    String holding the first count strings of a parts list, which is only
+    joined into one the first time val is read. The result of + on such a
+    String takes over its parts list and appends to it, so building a
+    string with repeated + is amortized O(1) per step. An append only
+    counts if the list was exactly count long, so Strings sharing one
+    parts list never see each other's later parts.
+    """
+    __slots__ = ('_val', 'parts', 'count')
+
     def __init__(self, val):
-        super().__init__()
-        self.val = val
+        self._val = val
+        self.parts = None
+        self.count = 0
+
+    @classmethod
+    def from_parts(cls, parts, count):
+        new_string = cls(None)
+        new_string.parts = parts
+        new_string.count = count
+        return new_string
+
+    @property
+    def val(self):
+        if self.parts is not None:
+            self._val = ''.join(self.parts[:self.count])
+            self.parts = None
+        return self._val
+
+    def joined(self, text):
+        parts = self.parts
+        if parts is not None:
+            count = self.count
+            if len(parts) == count:
+                parts.append(text)
+                # Another thread may have appended to the same list meanwhile
+                if len(parts) == count + 1:
+                    return String.from_parts(parts, count + 1)
+            return String.from_parts([self.val, text], 2)
+        if len(self._val) + len(text) < LAZY_JOIN_MIN_LENGTH:
+            return String(self._val + text)
+        return String.from_parts([self._val, text], 2)
 
     def add_to(self, other):
         if isinstance(other, String):
-            return String(self.val + other.val).set_context(self.context), None
+            return self.joined(other.val), None
         else:
-            return None, Value.illegal_operation(self, other)
+            return None, self.illegal_operation(other)
 
     def mul_by(self, other):
         if isinstance(other, Number):
-            return String(self.val * other.val).set_context(self.context), None
+            return String(self.val * other.val), None
         else:
-            return None, Value.illegal_operation(self, other)
+            return None, self.illegal_operation(other)
 
     def is_true(self):
-        return len(self.val) > 0
+        # Parts are only used for results of at least LAZY_JOIN_MIN_LENGTH
+        return self.parts is not None or len(self._val) > 0
 
     def copy(self):
-        copy = String(self.val)
-        copy.set_pos(self.pos_start, self.pos_end)
-        copy.set_context(self.context)
-        return copy
+        return String(self.val)
 
     def __str__(self):
         return self.val
@@ -531,57 +858,169 @@ class String(Value):
         return f'"{self.val}"'
 
 
+class StringBuilder(Value):
+    """Text appended to in place by APPEND, made by STRING_BUILDER()."""
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+
+    def append(self, text):
+        self.parts.append(text)
+
+    def is_true(self):
+        return len(str(self)) > 0
+
+    def copy(self):
+        builder = StringBuilder()
+        builder.parts.append(str(self))
+        return builder
+
+    def __str__(self):
+        if len(self.parts) > 1:
+            self.parts[:] = [''.join(self.parts)]
+        return self.parts[0] if self.parts else ''
+
+    def __repr__(self):
+        return f'<string builder "{self}">'
+
+
+# Numbers are stored in lists as their bare val, which persistent_list
+# packs into typed arrays; box() turns them back into Numbers on the way out
+def unbox(val):
+    if type(val) is Number and type(val.val) in (int, float):
+        return val.val
+    return val
+
+
+def box(item):
+    return make_number(item) if type(item) in (int, float) else item
+
+
+def list_numbers(list_):
+    """Bare values of the elements of list_ as a Python list, or None if any is not a Number."""
+    numbers = []
+    for leaf in persistent_list.leaves(list_.root):
+        if type(leaf) is array:
+            numbers.extend(leaf)
+            continue
+        for item in leaf:
+            if type(item) is Number:
+                item = item.val
+            elif type(item) not in (int, float):
+                return None
+            numbers.append(item)
+    return numbers
+
+
+def number_list(numbers):
+    """List of the bare numbers in a Python list, without boxing them."""
+    return List.from_root(persistent_list.from_list(numbers) if numbers else None)
+
+
 class List(Value):
+    """
+    Elements are held in a persistent_list tree, so copy() is O(1) and +,
+    - and * build their result sharing all but O(log n) nodes with their
+    operands. APPEND, EXTEND and POP replace the list's own root instead.
+    Runs of numbers are kept unboxed (see unbox), so a list of a million
+    numbers takes about 8 MB.
+    """
     def __init__(self, elements):
         super().__init__()
-        self.elements = elements
+        self.root = List.make_root(elements)
+
+    @staticmethod
+    def make_root(elements):
+        return persistent_list.from_list(list(map(unbox, elements))) if elements else None
+
+    @classmethod
+    def from_root(cls, root):
+        new_list = cls([])
+        new_list.root = root
+        return new_list
+
+    @property
+    def elements(self):
+        return list(self)
+
+    def __iter__(self):
+        return map(box, persistent_list.iterate(self.root))
+
+    def length(self):
+        return persistent_list.size(self.root)
+
+    def get(self, index):
+        return box(persistent_list.get(self.root, index))
+
+    def append(self, val):
+        self.root = persistent_list.append(self.root, unbox(val))
+
+    def extend(self, other):
+        self.root = persistent_list.concat(self.root, other.root)
+
+    def pop(self, index):
+        element = self.get(index)
+        self.root = persistent_list.delete(self.root, index)
+        return element
 
     def add_to(self, other):
-        new_list = self.copy()
-        new_list.elements.append(other)
-        return new_list, None
+        return List.from_root(persistent_list.append(self.root, unbox(other))), None
 
     def sub_by(self, other):
         if isinstance(other, Number):
-            new_list = self.copy()
             try:
-                new_list.elements.pop(other.val)
-                return new_list, None
-            except RuntimeError:
-                return None, RTError(other.pos_start, other.pos_end,
-                                     'IndexOutOfBoundsException', self.context)
+                return List.from_root(persistent_list.delete(self.root, other.val)), None
+            except IndexError:
+                return None, self.runtime_error('IndexOutOfBoundsException')
         else:
-            return None, Value.illegal_operation(self, other)
+            return None, self.illegal_operation(other)
 
     def mul_by(self, other):
         if isinstance(other, List):
-            new_list = self.copy()
-            new_list.elements.extend(other.elements)
-            return new_list, None
+            return List.from_root(persistent_list.concat(self.root, other.root)), None
         else:
-            return None, Value.illegal_operation(self, other)
+            return None, self.illegal_operation(other)
 
     def div_by(self, other):
         if isinstance(other, Number):
             try:
-                return self.elements[other.val], None
-            except RuntimeError:
-                return None, RTError(other.pos_start, other.pos_end,
-                                     'IndexOutOfBoundsException', self.context)
+                return self.get(other.val), None
+            except IndexError:
+                return None, self.runtime_error('IndexOutOfBoundsException')
         else:
-            return None, Value.illegal_operation(self, other)
+            return None, self.illegal_operation(other)
 
     def copy(self):
-        copy = List(self.elements)
-        copy.set_pos(self.pos_start, self.pos_end)
-        copy.set_context(self.context)
-        return copy
+        return List.from_root(self.root)
 
     def __str__(self):
-        return ", ".join([str(x) for x in self.elements])
+        return ", ".join([str(x) for x in self])
 
     def __repr__(self):
-        return f'[{", ".join([str(x) for x in self.elements])}]'
+        return f'[{", ".join([str(x) for x in self])}]'
+
+
+class LazyList(List):
+    """
+    List of a lazy FOR loop (see optimizer.lazy_loop), filled in by
+    produce() the first time its elements are used.
+    """
+    def __init__(self, produce):
+        super().__init__([])
+        self.produce = produce
+
+    @property
+    def root(self):
+        if self.produce is not None:
+            self._root = List.make_root(self.produce())
+            # Drops the loop's snapshot along with the function
+            self.produce = None
+        return self._root
+
+    @root.setter
+    def root(self, root):
+        self.produce = None
+        self._root = root
 
 
 class BaseFunction(Value):
@@ -589,32 +1028,57 @@ class BaseFunction(Value):
         super().__init__()
         self.name = name or '<NULL>'
 
-    def make_new_context(self):
-        new_context = Context(self.name, self.context, self.pos_start)
-        new_context.symbol_table = SymbolTable(new_context.parent.symbol_table)
+    def make_new_context(self, context, pos_start, slot_names=None):
+        new_context = Context(self.name, context, pos_start)
+        if slot_names is None:
+            new_context.symbol_table = SymbolTable(context.symbol_table)
+        else:
+            new_context.symbol_table = FrameSymbolTable(slot_names, context.symbol_table)
         return new_context
 
+    def new_frame(self, args, context, pos_start, frame):
+        """
+        (context for a call with args from context, None), or (None, error)
+        if they are the wrong number. frame is the function's FrameTemplate,
+        or None if its locals have no slots.
+        """
+        if frame is not None:
+            symbol_table = frame.new_table(args, context.symbol_table)
+            if symbol_table is not None:
+                new_context = Context(self.name, context, pos_start)
+                new_context.symbol_table = symbol_table
+                return new_context, None
+        new_context = self.make_new_context(context, pos_start, frame.slot_names if frame is not None else None)
+        response = self.check_and_populate_args(self.arg_names, args, new_context)
+        if response.error:
+            return None, response.error
+        return new_context, None
+
+    def make_caller(self, context, pos_start, pos_end):
+        """
+        call(args) -> (val, error) calling this function from context, for
+        builtins such as MAP that call it once per element. Subclasses set
+        up what every call can share, such as an interpreter, once here.
+        """
+        def call(args):
+            response = self.execute(args, context, pos_start, pos_end)
+            return response.val, response.error
+        return call
+
     def check_args(self, arg_names, args):
         response = RTResult()
         if len(args) > len(arg_names):
-            return response.failure(RTError(self.pos_start,
-                                            self.pos_end,
-                                            f"{len(args) - len(arg_names)} too many args "
-                                            f"passed into '{self.name}'", self.context))
+            return response.failure(self.runtime_error(f"{len(args) - len(arg_names)} too many args "
+                                                       f"passed into '{self.name}'"))
         if len(args) < len(arg_names):
-            return response.failure(RTError(self.pos_start,
-                                            self.pos_end,
-                                            f"{len(arg_names) - len(args)} too few args "
-                                            f"passed into '{self.name}'", self.context))
+            return response.failure(self.runtime_error(f"{len(arg_names) - len(args)} too few args "
+                                                       f"passed into '{self.name}'"))
         return response.success(None)
 
     # noinspection PyMethodMayBeStatic
     def populate_args(self, arg_names, args, context):
         for i in range(len(args)):
-            arg_name = arg_names[i]
-            arg_val = args[i]
-            arg_val.set_context(context)
-            context.symbol_table.set(arg_name, arg_val)
+            context.symbol_table.set(arg_names[i], args[i])
 
     def check_and_populate_args(self, arg_names, args, context):
         response = RTResult()
@@ -626,30 +1090,29 @@ class BaseFunction(Value):
 
 
 class Function(BaseFunction):
-    def __init__(self, name, body, arg_names, auto_ret):
+    def __init__(self, name, body, arg_names, auto_ret, frame=None):
         super().__init__(name)
         self.body = body
         self.arg_names = arg_names
         self.auto_ret = auto_ret
+        self.frame = frame
 
-    def execute(self, args):
-        response = RTResult()
+    def execute(self, args, context, pos_start, pos_end):
+        return Interpreter().call(self, args, context, pos_start, pos_end)
+
+    def make_caller(self, context, pos_start, pos_end):
         interpreter = Interpreter()
-        context = self.make_new_context()
-        response.register(self.check_and_populate_args(self.arg_names, args, context))
-        if response.should_ret():
-            return response
-        val = response.register(interpreter.visit(self.body, context))
-        if response.should_ret() and response.fun_ret_val is None:
-            return response
-        ret_val = (val if self.auto_ret else None) or response.fun_ret_val or Number.null
-        return response.success(ret_val)
+
+        def call(args):
+            response = interpreter.call(self, args, context, pos_start, pos_end)
+            if response.error:
+                return None, response.error
+            # A BREAK or CONTINUE that left the function has no loop to end here
+            return response.val or Number.null, None
+        return call
 
     def copy(self):
-        copy = Function(self.name, self.body, self.arg_names, self.auto_ret)
-        copy.set_context(self.context)
-        copy.set_pos(self.pos_start, self.pos_end)
-        return copy
+        return Function(self.name, self.body, self.arg_names, self.auto_ret, self.frame)
 
     def __repr__(self):
         return f"<function {self.name}>"
@@ -659,33 +1122,36 @@ class BuiltInFunction(BaseFunction):
     def __init__(self, name):
         super().__init__(name)
 
-    def execute(self, args):
+    def execute(self, args, context, pos_start, pos_end):
         response = RTResult()
-        context = self.make_new_context()
+        context = self.make_new_context(context, pos_start)
         method_name = f'execute_{self.name}'
         method = getattr(self, method_name, self.no_visit_method)
         response.register(self.check_and_populate_args(method.arg_names, args, context))
         if response.should_ret():
+            response.error.set_pos(pos_start, pos_end, context.parent)
             return response
-        return_value = response.register(method(context))
+        return_value = response.register(self.call_method(method, context, pos_start, pos_end))
         if response.should_ret():
+            response.error.set_pos(pos_start, pos_end, context)
             return response
         return response.success(return_value)
 
+    # noinspection PyMethodMayBeStatic
+    def call_method(self, method, context, pos_start, pos_end):
+        return method(context)
+
     def no_visit_method(self, node, context):
         raise Exception(f'No execute_{self.name} method defined')
 
     def copy(self):
-        copy = BuiltInFunction(self.name)
-        copy.set_context(self.context)
-        copy.set_pos(self.pos_start, self.pos_end)
-        return copy
+        return BuiltInFunction(self.name)
 
     def __repr__(self):
         return f'<built-in function {self.name}>'
 
     def execute_print(self, context):
-        print(str(context.symbol_table.get('value')))
+        context.output.write(f"{context.symbol_table.get('value')}\n")
         return RTResult().success(Number.null)
     execute_print.arg_names = ['value']
 
@@ -693,12 +1159,15 @@ class BuiltInFunction(BaseFunction):
         return RTResult().success(String(str(context.symbol_table.get('value'))))
     execute_print_ret.arg_names = ['value']
 
-    def execute_input(self):
+    def execute_input(self, context):
+        # Shows everything printed so far before waiting for the user
+        context.output.flush()
         text = input()
         return RTResult().success(String(text))
     execute_input.arg_names = []
 
-    def execute_input_int(self):
+    def execute_input_int(self, context):
+        context.output.flush()
         while True:
             text = input()
             try:
@@ -706,10 +1175,11 @@ class BuiltInFunction(BaseFunction):
                 break
             except ValueError:
                 print(f"'{text}' must be an integer.")
-        return RTResult().success(Number(num))
+        return RTResult().success(make_number(num))
     execute_input_int.arg_names = []
 
-    def execute_clear(self):
+    def execute_clear(self, context):
+        context.output.flush()
         os.system('cls' if os.name == 'nt' else 'clear')
         return RTResult().success(Number.null)
     execute_clear.arg_names = []
@@ -730,19 +1200,20 @@ class BuiltInFunction(BaseFunction):
     execute_is_list.arg_names = ['value']
 
     def execute_is_fun(self, context):
-        is_fun = isinstance(context.symbol_table.get("value"), Function)
+        value = context.symbol_table.get("value")
+        is_fun = isinstance(value, BaseFunction) and not isinstance(value, BuiltInFunction)
         return RTResult().success(Number.true if is_fun else Number.false)
     execute_is_fun.arg_names = ['value']
 
     def execute_append(self, context):
         list_ = context.symbol_table.get("list")
         value = context.symbol_table.get("value")
+        if isinstance(list_, StringBuilder):
+            list_.append(str(value))
+            return RTResult().success(Number.null)
         if not isinstance(list_, List):
-            return RTResult().failure(RTError(self.pos_start,
-                                              self.pos_end,
-                                              "First argument must be type 'List'",
-                                              context))
-        list_.elements.append(value)
+            return RTResult().failure(self.runtime_error("First argument must be type 'List' or 'StringBuilder'"))
+        list_.append(value)
         return RTResult().success(Number.null)
     execute_append.arg_names = ['list', 'value']
 
@@ -750,83 +1221,235 @@ class BuiltInFunction(BaseFunction):
         list_ = context.symbol_table.get("list")
         index = context.symbol_table.get("index")
         if not isinstance(list_, List):
-            return RTResult().failure(RTError(self.pos_start,
-                                              self.pos_end,
-                                              "First argument must be list",
-                                              context))
+            return RTResult().failure(self.runtime_error("First argument must be list"))
         if not isinstance(index, Number):
-            return RTResult().failure(RTError(self.pos_start,
-                                              self.pos_end,
-                                              "Second argument must be number",
-                                              context))
+            return RTResult().failure(self.runtime_error("Second argument must be number"))
         try:
-            element = list_.elements.pop(index.val)
-        except RuntimeError:
-            return RTResult().failure(RTError(self.pos_start,
-                                              self.pos_end,
-                                              'IndexOutOfBoundsException',
-                                              context))
+            element = list_.pop(index.val)
+        except IndexError:
+            return RTResult().failure(self.runtime_error('IndexOutOfBoundsException'))
         return RTResult().success(element)
     execute_pop.arg_names = ["list", "index"]
 
     def execute_extend(self, context):
-        list_a = context.symbol_table.get("list_a")
-        list_b = context.symbol_table.get("list_b")
+        list_a = context.symbol_table.get("listA")
+        list_b = context.symbol_table.get("listB")
 
         if not isinstance(list_a, List):
-            return RTResult().failure(RTError(self.pos_start,
-                                              self.pos_end,
-                                              "First argument must be type 'List'",
-                                              context))
+            return RTResult().failure(self.runtime_error("First argument must be type 'List'"))
 
         if not isinstance(list_b, List):
-            return RTResult().failure(RTError(self.pos_start,
-                                              self.pos_end,
-                                              "Second argument must be type 'List'",
-                                              context))
-        list_a.elements.extend(list_b.elements)
+            return RTResult().failure(self.runtime_error("Second argument must be type 'List'"))
+        list_a.extend(list_b)
         return RTResult().success(Number.null)
     execute_extend.arg_names = ["listA", "listB"]
 
     def execute_len(self, context):
         list_ = context.symbol_table.get("list")
         if not isinstance(list_, List):
-            return RTResult().failure(RTError(self.pos_start,
-                                              self.pos_end,
-                                              "Argument must be type 'List'",
-                                              context))
-        return RTResult().success(Number(len(list_.elements)))
+            return RTResult().failure(self.runtime_error("Argument must be type 'List'"))
+        return RTResult().success(make_number(list_.length()))
     execute_len.arg_names = ["list"]
 
+    def list_and_numbers(self, context, name, position):
+        """(list, its numbers, None) for argument name, or (None, None, error)."""
+        list_ = context.symbol_table.get(name)
+        if not isinstance(list_, List):
+            return None, None, self.runtime_error(f"{position} must be type 'List'")
+        numbers = list_numbers(list_)
+        if numbers is None:
+            return None, None, self.runtime_error(f"{position} must only contain numbers")
+        return list_, numbers, None
+
+    def execute_flush(self, context):
+        context.output.flush()
+        return RTResult().success(Number.null)
+    execute_flush.arg_names = []
+
+    # noinspection PyMethodMayBeStatic
+    def execute_string_builder(self, context):
+        return RTResult().success(StringBuilder())
+    execute_string_builder.arg_names = []
+
+    def execute_sum(self, context):
+        _, numbers, error = self.list_and_numbers(context, "list", "Argument")
+        if error:
+            return RTResult().failure(error)
+        return RTResult().success(make_number(sum(numbers)))
+    execute_sum.arg_names = ["list"]
+
+    def map_numbers(self, context, op):
+        # Applies op between each number of "list" and "value", or the
+        # matching number of "value" if that is a list too
+        _, numbers, error = self.list_and_numbers(context, "list", "First argument")
+        if error:
+            return RTResult().failure(error)
+        value = context.symbol_table.get("value")
+        if isinstance(value, Number):
+            value = value.val
+            return RTResult().success(number_list([op(number, value) for number in numbers]))
+        if not isinstance(value, List):
+            return RTResult().failure(self.runtime_error("Second argument must be type 'Number' or 'List'"))
+        _, values, error = self.list_and_numbers(context, "value", "Second argument")
+        if error:
+            return RTResult().failure(error)
+        if len(values) != len(numbers):
+            return RTResult().failure(self.runtime_error("Lists must have the same length"))
+        return RTResult().success(number_list(list(map(op, numbers, values))))
+
+    def execute_map_add(self, context):
+        return self.map_numbers(context, operator.add)
+    execute_map_add.arg_names = ["list", "value"]
+
+    def execute_map_mul(self, context):
+        return self.map_numbers(context, operator.mul)
+    execute_map_mul.arg_names = ["list", "value"]
+
+    def execute_dot(self, context):
+        _, numbers_a, error = self.list_and_numbers(context, "listA", "First argument")
+        if error:
+            return RTResult().failure(error)
+        _, numbers_b, error = self.list_and_numbers(context, "listB", "Second argument")
+        if error:
+            return RTResult().failure(error)
+        if len(numbers_a) != len(numbers_b):
+            return RTResult().failure(self.runtime_error("Lists must have the same length"))
+        return RTResult().success(make_number(sum(map(operator.mul, numbers_a, numbers_b))))
+    execute_dot.arg_names = ["listA", "listB"]
+
+    def execute_min(self, context):
+        _, numbers, error = self.list_and_numbers(context, "list", "Argument")
+        if error:
+            return RTResult().failure(error)
+        if not numbers:
+            return RTResult().failure(self.runtime_error("List is empty"))
+        return RTResult().success(make_number(min(numbers)))
+    execute_min.arg_names = ["list"]
+
+    def execute_max(self, context):
+        _, numbers, error = self.list_and_numbers(context, "list", "Argument")
+        if error:
+            return RTResult().failure(error)
+        if not numbers:
+            return RTResult().failure(self.runtime_error("List is empty"))
+        return RTResult().success(make_number(max(numbers)))
+    execute_max.arg_names = ["list"]
+
+    def execute_range(self, context):
+        start = context.symbol_table.get("start")
+        end = context.symbol_table.get("end")
+        if not isinstance(start, Number):
+            return RTResult().failure(self.runtime_error("First argument must be type 'Number'"))
+        if not isinstance(end, Number):
+            return RTResult().failure(self.runtime_error("Second argument must be type 'Number'"))
+        # The values a FOR loop from start TO end gives its variable
+        return RTResult().success(number_list(list(counter_values(start.val, end.val, 1))))
+    execute_range.arg_names = ["start", "end"]
+
+    def execute_sort(self, context):
+        list_ = context.symbol_table.get("list")
+        if not isinstance(list_, List):
+            return RTResult().failure(self.runtime_error("Argument must be type 'List'"))
+        numbers = list_numbers(list_)
+        if numbers is not None:
+            return RTResult().success(number_list(sorted(numbers)))
+        elements = list_.elements
+        if not all(isinstance(element, String) for element in elements):
+            return RTResult().failure(self.runtime_error("List must only contain numbers or only strings"))
+        return RTResult().success(List(sorted(elements, key=lambda element: element.val)))
+    execute_sort.arg_names = ["list"]
+
     def execute_run(self, context):
         file_name = context.symbol_table.get("file_name")
         if not isinstance(file_name, String):
-            return RTResult().failure(RTError(self.pos_start,
-                                              self.pos_end,
-                                              "Argument must be type 'String'",
-                                              context))
+            return RTResult().failure(self.runtime_error("Argument must be type 'String'"))
         file_name = file_name.val
         try:
-            with open(file_name, 'r') as f:
-                script = f.read()
-        except RuntimeError as e:
-            return RTResult().failure(RTError(self.pos_start,
-                                              self.pos_end,
-                                              f"Failed to load script \"{file_name}\"\n" + str(e),
-                                              context))
-        _, error = run(file_name, script)
+            runtime = context.runtime if context.runtime is not None else default_runtime()
+            _, error = runtime.run_file(file_name, output=context.output)
+        except OSError as e:
+            return RTResult().failure(self.runtime_error(f"Failed to load script \"{file_name}\"\n" + str(e)))
         if error:
-            return RTResult().failure(RTError(self.pos_start,
-                                              self.pos_end,
-                                              f"Failed to finish executing script \"{file_name}\"\n" +
-                                              error.to_string(),
-                                              context))
+            return RTResult().failure(self.runtime_error(f"Failed to finish executing script \"{file_name}\"\n" +
+                                                         error.to_string()))
         return RTResult().success(Number.null)
     execute_run.arg_names = ["file_name"]
 
 
+class HigherOrderFunction(BuiltInFunction):
+    """
+    Built-in function that calls a MiniLang function it is passed, once per
+    element of a list. Its execute_ methods also get the positions of the
+    call, which the calls they make are attributed to. The function is
+    called from the caller's context, so it cannot see the builtin's own
+    argument names.
+    """
+    def call_method(self, method, context, pos_start, pos_end):
+        return method(context, pos_start, pos_end)
+
+    def copy(self):
+        return HigherOrderFunction(self.name)
+
+    def function_and_list(self, context):
+        """(function, list, None) for the "function" and "list" arguments, or (None, None, error)."""
+        function = context.symbol_table.get("function")
+        list_ = context.symbol_table.get("list")
+        if not isinstance(function, BaseFunction):
+            return None, None, self.runtime_error("First argument must be a function")
+        if not isinstance(list_, List):
+            return None, None, self.runtime_error("Second argument must be type 'List'")
+        return function, list_, None
+
+    def map_or_filter(self, context, pos_start, pos_end, keep):
+        # keep: whether to return the elements the function is true for
+        # instead of its results
+        function, list_, error = self.function_and_list(context)
+        if error:
+            return RTResult().failure(error)
+        result = load_parallel().run_map(function, list_, keep, context.parent, pos_start, pos_end)
+        if result is None:
+            call = function.make_caller(context.parent, pos_start, pos_end)
+            result = []
+            for element in list_:
+                val, error = call([element])
+                if error:
+                    return RTResult().failure(error)
+                if not keep:
+                    result.append(val)
+                elif val.is_true():
+                    result.append(element)
+        elif result[1]:
+            return RTResult().failure(result[1])
+        else:
+            result = result[0]
+        return RTResult().success(List(result))
+
+    def execute_map(self, context, pos_start, pos_end):
+        return self.map_or_filter(context, pos_start, pos_end, False)
+    execute_map.arg_names = ["function", "list"]
+
+    def execute_filter(self, context, pos_start, pos_end):
+        return self.map_or_filter(context, pos_start, pos_end, True)
+    execute_filter.arg_names = ["function", "list"]
+
+    def execute_reduce(self, context, pos_start, pos_end):
+        # Each call needs the one before it, so REDUCE never leaves this process
+        function, list_, error = self.function_and_list(context)
+        if error:
+            return RTResult().failure(error)
+        call = function.make_caller(context.parent, pos_start, pos_end)
+        accumulator = context.symbol_table.get("initial")
+        for element in list_:
+            accumulator, error = call([accumulator, element])
+            if error:
+                return RTResult().failure(error)
+        return RTResult().success(accumulator)
+    execute_reduce.arg_names = ["function", "list", "initial"]
+
+
 BuiltInFunction.print = BuiltInFunction("print")
 BuiltInFunction.print_ret = BuiltInFunction("print_ret")
+BuiltInFunction.flush = BuiltInFunction("flush")
 BuiltInFunction.input = BuiltInFunction("input")
 BuiltInFunction.input_int = BuiltInFunction("input_int")
 BuiltInFunction.clear = BuiltInFunction("clear")
@@ -838,68 +1461,103 @@ BuiltInFunction.append = BuiltInFunction("append")
 BuiltInFunction.pop = BuiltInFunction("pop")
 BuiltInFunction.extend = BuiltInFunction("extend")
 BuiltInFunction.len = BuiltInFunction("len")
+BuiltInFunction.string_builder = BuiltInFunction("string_builder")
+BuiltInFunction.sum = BuiltInFunction("sum")
+BuiltInFunction.map_add = BuiltInFunction("map_add")
+BuiltInFunction.map_mul = BuiltInFunction("map_mul")
+BuiltInFunction.dot = BuiltInFunction("dot")
+BuiltInFunction.min = BuiltInFunction("min")
+BuiltInFunction.max = BuiltInFunction("max")
+BuiltInFunction.range = BuiltInFunction("range")
+BuiltInFunction.sort = BuiltInFunction("sort")
 BuiltInFunction.run = BuiltInFunction("run")
+HigherOrderFunction.map = HigherOrderFunction("map")
+HigherOrderFunction.filter = HigherOrderFunction("filter")
+HigherOrderFunction.reduce = HigherOrderFunction("reduce")
+
+
+# Node built straight from a single token by the expression parser
+LEAF_NODES = {
+    TT_INT: NumberNode,
+    TT_FLOAT: NumberNode,
+    TT_STRING: StringNode,
+    TT_IDENTIFIER: VarAccessNode,
+}
+
+
+def discard_value(node):
+    """Marks a statement whose value is never read, down through the parts that would produce it."""
+    if isinstance(node, ListNode):
+        node.discarded = True
+        for element in node.elements:
+            discard_value(element)
+    elif isinstance(node, (ForNode, WhileNode)):
+        node.discarded = True
+        if not node.ret_null:
+            discard_value(node.body)
+    elif isinstance(node, IfNode):
+        for _, expression, ret_null in node.cases:
+            if not ret_null:
+                discard_value(expression)
+        if node.else_case and not node.else_case[1]:
+            discard_value(node.else_case[0])
 
 
 class ParseResult:
     def __init__(self):
         self.error = None
         self.node = None
-        self.advance_count = 0
-        self.last_advance_count = 0
-        self.to_reverse_count = 0
 
     def register(self, response):
-        self.last_advance_count = response.advance_count
-        self.advance_count += response.advance_count
         if response.error:
             self.error = response.error
         return response.node
 
-    def register_advancement(self):
-        self.advance_count += 1
-        self.last_advance_count = 1
-
-    def try_register(self, response):
-        if response.error:
-            self.to_reverse_count = response.advance_count
-            return None
-        return self.register(response)
-
     def success(self, node):
         self.node = node
         return self
 
     def failure(self, error):
-        if not self.error or self.last_advance_count == 0:
-            self.error = error
+        self.error = error
         return self
 
 
 class Parser:
+    """
+    Predictive parser: every choice is made from the current token alone,
+    so tokens are consumed strictly in order and never rewound.
+    """
     def __init__(self, tokens):
-        self.tokens = tokens
+        self.tokens = iter(tokens)
         self.token_index = -1
-        if 0 <= self.token_index < len(self.tokens):
-            self.curr_token = self.tokens[self.token_index]
+        self.curr_token = None
         self.advance()
 
     def advance(self):
         self.token_index += 1
-        self.update_curr_token()
+        # Past the end the EOF token keeps being the current one
+        self.curr_token = next(self.tokens, self.curr_token)
         return self.curr_token
 
-    def reverse(self, count=1):
-        self.token_index -= count
-        self.update_curr_token()
-        return self.curr_token
+    def starts_expr(self, token):
+        if token.type == TT_KEYWORD:
+            return token.val in EXPR_START_KEYWORDS
+        return token.type in EXPR_START_TYPES
 
-    def update_curr_token(self):
-        if 0 <= self.token_index < len(self.tokens):
-            self.curr_token = self.tokens[self.token_index]
+    def starts_statement(self, token):
+        return self.starts_expr(token) or (token.type == TT_KEYWORD and token.val in STATEMENT_KEYWORDS)
+
+    def expected(self, response, start_index, details):
+        """
+        Fails with details at the current token, unless the rule that just
+        failed had already consumed tokens: its own error is more precise then.
+        """
+        if self.token_index != start_index:
+            return response
+        return response.failure(InvalidSyntaxError(self.curr_token.pos_start, self.curr_token.pos_end, details))
 
     def parse(self):
-        response = self.statements()
+        response = self.statements(keep_last=True)
         if not response.error and self.curr_token.type != TT_EOF:
             return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                        self.curr_token.pos_end,
@@ -908,63 +1566,63 @@ class Parser:
                                                        "'While', 'AND', or 'OR'"))
         return response
 
-    def statements(self):
+    def statements(self, keep_last=False):
+        """
+        Statement list of a block, or of the whole program with keep_last.
+        A block's value is never read and only the last statement of a
+        program counts as its result, so the others are marked with
+        discard_value(): loops among them evaluate to NULL.
+        """
         response = ParseResult()
         statements = []
         pos_start = self.curr_token.pos_start.copy()
         while self.curr_token.type == TT_EOL:
-            response.register_advancement()
             self.advance()
         statement = response.register(self.statement())
         if response.error:
             return response
         statements.append(statement)
-        more_statements = True
         while True:
             eol_count = 0
             while self.curr_token.type == TT_EOL:
-                response.register_advancement()
                 self.advance()
                 eol_count += 1
-            if eol_count == 0:
-                more_statements = False
-            if not more_statements:
+            if eol_count == 0 or not self.starts_statement(self.curr_token):
                 break
-            statement = response.try_register(self.statement())
-            if not statement:
-                self.reverse(response.to_reverse_count)
-                more_statements = False
-                continue
+            statement = response.register(self.statement())
+            if response.error:
+                return response
             statements.append(statement)
-        return response.success(ListNode(statements,
-                                         pos_start,
-                                         self.curr_token.pos_end.copy()))
+        for statement in statements[:-1] if keep_last else statements:
+            discard_value(statement)
+        node = ListNode(statements, pos_start, self.curr_token.pos_end.copy())
+        node.discarded = not keep_last
+        return response.success(node)
 
     def statement(self):
         response = ParseResult()
         pos_start = self.curr_token.pos_start.copy()
         if self.curr_token.matches(TT_KEYWORD, 'RETURN'):
-            response.register_advancement()
             self.advance()
-            expression = response.try_register(self.expr())
-            if not expression:
-                self.reverse(response.to_reverse_count)
+            expression = None
+            if self.starts_expr(self.curr_token):
+                expression = response.register(self.expr())
+                if response.error:
+                    return response
             return response.success(ReturnNode(expression, pos_start, self.curr_token.pos_start.copy()))
         if self.curr_token.matches(TT_KEYWORD, 'CONTINUE'):
-            response.register_advancement()
             self.advance()
             return response.success(ContinueNode(pos_start, self.curr_token.pos_start.copy()))
         if self.curr_token.matches(TT_KEYWORD, 'BREAK'):
-            response.register_advancement()
             self.advance()
             return response.success(BreakNode(pos_start, self.curr_token.pos_start.copy()))
+        start_index = self.token_index
         expression = response.register(self.expr())
         if response.error:
-            return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
-                                                       self.curr_token.pos_end,
-                                                       "Expected 'RETURN', 'CONTINUE', 'BREAK', 'VAR', "
-                                                       "'IF', 'FOR', 'WHILE', 'FUN', "
-                                                       "int, float, identifier, '+', '-', '[' or '('"))
+            return self.expected(response, start_index,
+                                 "Expected 'RETURN', 'CONTINUE', 'BREAK', 'VAR', "
+                                 "'IF', 'FOR', 'WHILE', 'FUN', "
+                                 "int, float, identifier, '+', '-', '[' or '('")
         return response.success(expression)
 
     def list_expr(self):
@@ -975,20 +1633,17 @@ class Parser:
             return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                        self.curr_token.pos_end,
                                                        f"Expected '['"))
-        response.register_advancement()
         self.advance()
         if self.curr_token.type == TT_RBRAK:
-            response.register_advancement()
             self.advance()
         else:
+            start_index = self.token_index
             elements.append((response.register(self.expr())))
             if response.error:
-                return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
-                                                           self.curr_token.pos_end,
-                                                           "Expected ']', '[', 'VAR', 'If', 'FOR', 'WHILE', 'FUN', "
-                                                           "int, float, identifier, '+', '-' or '('"))
+                return self.expected(response, start_index,
+                                     "Expected ']', '[', 'VAR', 'If', 'FOR', 'WHILE', 'FUN', "
+                                     "int, float, identifier, '+', '-' or '('")
             while self.curr_token.type == TT_COMMA:
-                response.register_advancement()
                 self.advance()
                 elements.append(response.register(self.expr()))
                 if response.error:
@@ -997,7 +1652,6 @@ class Parser:
                 return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                            self.curr_token.pos_end,
                                                            f"Expected ',' or ']'"))
-            response.register_advancement()
             self.advance()
         return response.success(ListNode(elements, pos_start, self.curr_token.pos_end.copy()))
 
@@ -1017,17 +1671,14 @@ class Parser:
         else_case = None
 
         if self.curr_token.matches(TT_KEYWORD, 'ELSE'):
-            response.register_advancement()
             self.advance()
             if self.curr_token.type == TT_EOL:
-                response.register_advancement()
                 self.advance()
                 statements = response.register(self.statements())
                 if response.error:
                     return response
                 else_case = (statements, True)
                 if self.curr_token.matches(TT_KEYWORD, 'END'):
-                    response.register_advancement()
                     self.advance()
                 else:
                     return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
@@ -1063,7 +1714,6 @@ class Parser:
             return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                        self.curr_token.pos_end,
                                                        f"Expected '{case_keyword}'"))
-        response.register_advancement()
         self.advance()
         condition = response.register(self.expr())
         if response.error:
@@ -1073,18 +1723,15 @@ class Parser:
                 self.curr_token.pos_start, self.curr_token.pos_end,
                 f"Expected 'THEN'"
             ))
-        response.register_advancement()
         self.advance()
 
         if self.curr_token.type == TT_EOL:
-            response.register_advancement()
             self.advance()
             statements = response.register(self.statements())
             if response.error:
                 return response
             cases.append((condition, statements, True))
             if self.curr_token.matches(TT_KEYWORD, 'END'):
-                response.register_advancement()
                 self.advance()
             else:
                 all_cases = response.register(self.if_elif_and_else())
@@ -1107,24 +1754,22 @@ class Parser:
 
     def for_expr(self):
         response = ParseResult()
-        if not self.curr_token.matches(TT_KEYWORD, 'FOR'):
+        if not (self.curr_token.matches(TT_KEYWORD, 'FOR') or self.curr_token.matches(TT_KEYWORD, 'PARFOR')):
             return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                        self.curr_token.pos_end,
                                                        f"Expected 'FOR'"))
-        response.register_advancement()
+        parallel = self.curr_token.val == 'PARFOR'
         self.advance()
         if self.curr_token.type != TT_IDENTIFIER:
             return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                        self.curr_token.pos_end,
                                                        f"Expected identifier"))
         var = self.curr_token
-        response.register_advancement()
         self.advance()
         if self.curr_token.type != TT_EQ:
             return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                        self.curr_token.pos_end,
                                                        f"Expected '='"))
-        response.register_advancement()
         self.advance()
         start = response.register(self.expr())
         if response.error:
@@ -1133,13 +1778,11 @@ class Parser:
             return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                        self.curr_token.pos_end,
                                                        f"Expected 'TO'"))
-        response.register_advancement()
         self.advance()
         end = response.register(self.expr())
         if response.error:
             return response
         if self.curr_token.matches(TT_KEYWORD, 'STEP'):
-            response.register_advancement()
             self.advance()
             step = response.register(self.expr())
             if response.error:
@@ -1150,10 +1793,8 @@ class Parser:
             return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                        self.curr_token.pos_end,
                                                        f"Expected 'THEN'"))
-        response.register_advancement()
         self.advance()
         if self.curr_token.type == TT_EOL:
-            response.register_advancement()
             self.advance()
             body = response.register(self.statements())
             if response.error:
@@ -1162,13 +1803,12 @@ class Parser:
                 return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                            self.curr_token.pos_end,
                                                            f"Expected 'END'"))
-            response.register_advancement()
             self.advance()
-            return response.success(ForNode(var, start, end, step, body, True))
+            return response.success(ForNode(var, start, end, step, body, True, parallel))
         body = response.register(self.statement())
         if response.error:
             return response
-        return response.success(ForNode(var, start, end, step, body, False))
+        return response.success(ForNode(var, start, end, step, body, False, parallel))
 
     def while_expr(self):
         response = ParseResult()
@@ -1176,7 +1816,6 @@ class Parser:
             return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                        self.curr_token.pos_end,
                                                        f"Expected 'WHILE'"))
-        response.register_advancement()
         self.advance()
         condition = response.register(self.expr())
         if response.error:
@@ -1186,10 +1825,8 @@ class Parser:
                 self.curr_token.pos_start, self.curr_token.pos_end,
                 f"Expected 'THEN'"
             ))
-        response.register_advancement()
         self.advance()
         if self.curr_token.type == TT_EOL:
-            response.register_advancement()
             self.advance()
             body = response.register(self.statements())
             if response.error:
@@ -1199,7 +1836,6 @@ class Parser:
                                                            self.curr_token.pos_end,
                                                            f"Expected 'END'"))
 
-            response.register_advancement()
             self.advance()
             return response.success(WhileNode(condition, body, True))
         body = response.register(self.statement())
@@ -1213,57 +1849,52 @@ class Parser:
         if response.error:
             return response
         if self.curr_token.type == TT_LPAR:
-            response.register_advancement()
+            return self.call_args(atom)
+        return response.success(atom)
+
+    def call_args(self, atom):
+        response = ParseResult()
+        self.advance()
+        args = []
+        if self.curr_token.type == TT_RPAR:
             self.advance()
-            args = []
-            if self.curr_token.type == TT_RPAR:
-                response.register_advancement()
+        else:
+            start_index = self.token_index
+            args.append((response.register(self.expr())))
+            if response.error:
+                return self.expected(response, start_index,
+                                     "Expected ')', '[', 'VAR', 'If', 'FOR', 'WHILE', 'FUN', "
+                                     "int, float, identifier, '+', '-' or '('")
+            while self.curr_token.type == TT_COMMA:
                 self.advance()
-            else:
-                args.append((response.register(self.expr())))
+                args.append(response.register(self.expr()))
                 if response.error:
-                    return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
-                                                               self.curr_token.pos_end,
-                                                               "Expected ')', '[', 'VAR', 'If', 'FOR', 'WHILE', 'FUN', "
-                                                               "int, float, identifier, '+', '-' or '('"))
-                while self.curr_token.type == TT_COMMA:
-                    response.register_advancement()
-                    self.advance()
-                    args.append(response.register(self.expr()))
-                    if response.error:
-                        return response
-                if self.curr_token.type != TT_RPAR:
-                    return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
-                                                               self.curr_token.pos_end,
-                                                               f"Expected ',' or ')'"))
-                response.register_advancement()
-                self.advance()
-            return response.success(CallNode(atom, args))
-        return response.success(atom)
+                    return response
+            if self.curr_token.type != TT_RPAR:
+                return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
+                                                           self.curr_token.pos_end,
+                                                           f"Expected ',' or ')'"))
+            self.advance()
+        return response.success(CallNode(atom, args))
 
     def atom(self):
         response = ParseResult()
         token = self.curr_token
         if token.type in (TT_INT, TT_FLOAT):
-            response.register_advancement()
             self.advance()
             return response.success(NumberNode(token))
         elif token.type == TT_STRING:
-            response.register_advancement()
             self.advance()
             return response.success(StringNode(token))
         elif token.type == TT_IDENTIFIER:
-            response.register_advancement()
             self.advance()
             return response.success(VarAccessNode(token))
         elif token.type == TT_LPAR:
-            response.register_advancement()
             self.advance()
             expression = response.register(self.expr())
             if response.error:
                 return response
             if self.curr_token.type == TT_RPAR:
-                response.register_advancement()
                 self.advance()
                 return response.success(expression)
             else:
@@ -1280,7 +1911,7 @@ class Parser:
             if response.error:
                 return response
             return response.success(if_expr)
-        elif token.matches(TT_KEYWORD, 'FOR'):
+        elif token.matches(TT_KEYWORD, 'FOR') or token.matches(TT_KEYWORD, 'PARFOR'):
             for_expr = response.register(self.for_expr())
             if response.error:
                 return response
@@ -1300,75 +1931,79 @@ class Parser:
                                                    "Expected 'IF', 'FOR', 'WHILE', 'FUN', "
                                                    "int, float, identifier, '+', '-' or '('"))
 
-    def power(self):
-        return self.bin_op(self.call, (TT_POW,), self.factor)
-
-    def factor(self):
+    def binary_expr(self, min_precedence):
+        """
+        Precedence climbing: parses an operand (with any prefix operators),
+        then folds in every binary operator whose precedence is at least
+        min_precedence, parsing each right operand one level tighter.
+        """
         response = ParseResult()
         token = self.curr_token
         if token.type in (TT_ADD, TT_SUB):
-            response.register_advancement()
             self.advance()
-            factor = response.register(self.factor())
+            node = response.register(self.binary_expr(UNARY_PRECEDENCE))
             if response.error:
                 return response
-            return response.success(UnaryOpNode(token, factor))
-
-        return self.power()
-
-    def term(self):
-        return self.bin_op(self.factor, (TT_MUL, TT_DIV, TT_MOD))
-
-    def arith_expr(self):
-        return self.bin_op(self.term, (TT_ADD, TT_SUB))
+            left = UnaryOpNode(token, node, UNARY_OP_METHODS[token.type])
+        elif min_precedence <= COMPARISON_PRECEDENCE and token.matches(TT_KEYWORD, 'NOT'):
+            self.advance()
+            node = response.register(self.binary_expr(COMPARISON_PRECEDENCE))
+            if response.error:
+                return response
+            left = UnaryOpNode(token, node, UNARY_OP_METHODS[token.op_key()])
+        elif token.type in LEAF_NODES:
+            # Literals and names are by far the most common operands
+            self.advance()
+            left = LEAF_NODES[token.type](token)
+            if self.curr_token.type == TT_LPAR:
+                left = response.register(self.call_args(left))
+                if response.error:
+                    return response
+        else:
+            start_index = self.token_index
+            left = response.register(self.call())
+            if response.error:
+                if min_precedence > COMPARISON_PRECEDENCE:
+                    return response
+                return self.expected(response, start_index,
+                                     "Expected int, float, identifier, '+', '-', '(' or 'NOT'")
 
-    def comp_expr(self):
-        response = ParseResult()
-        if self.curr_token.matches(TT_KEYWORD, 'NOT'):
+        while True:
             op_token = self.curr_token
-            response.register_advancement()
+            precedence = BINARY_PRECEDENCE.get(op_token.op_key())
+            if precedence is None or precedence[0] < min_precedence:
+                return response.success(left)
             self.advance()
-
-            node = response.register(self.comp_expr())
+            right = response.register(self.binary_expr(precedence[1]))
             if response.error:
                 return response
-            return response.success(UnaryOpNode(op_token, node))
-        node = response.register(self.bin_op(self.arith_expr,
-                                             (TT_EEQ, TT_NEQ, TT_LT, TT_GT, TT_LTE, TT_GTE)))
-        if response.error:
-            return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
-                                                       self.curr_token.pos_end,
-                                                       "Expected int, float, identifier, '+', '-', '(' or 'NOT'"))
-        return response.success(node)
+            left = BinOpNode(left, op_token, right, BINARY_OP_METHODS[op_token.op_key()])
 
     def expr(self):
         response = ParseResult()
         if self.curr_token.matches(TT_KEYWORD, 'VAR'):
-            response.register_advancement()
             self.advance()
             if self.curr_token.type != TT_IDENTIFIER:
                 return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                            self.curr_token.pos_end,
                                                            "Expected identifier"))
             var_name = self.curr_token
-            response.register_advancement()
             self.advance()
             if self.curr_token.type != TT_EQ:
                 return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                            self.curr_token.pos_end,
                                                            "Expected'='"))
-            response.register_advancement()
             self.advance()
             expression = response.register(self.expr())
             if response.error:
                 return response
             return response.success(VarAssignNode(var_name, expression))
-        node = response.register(self.bin_op(self.comp_expr, ((TT_KEYWORD, "AND"), (TT_KEYWORD, "OR"))))
+        start_index = self.token_index
+        node = response.register(self.binary_expr(LOGICAL_PRECEDENCE))
         if response.error:
-            return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
-                                                       self.curr_token.pos_end,
-                                                       "Expected 'VAR', 'IF', 'FOR', 'WHILE', 'FUN', "
-                                                       "int, float, identifier, '+', '-', '[' or '('"))
+            return self.expected(response, start_index,
+                                 "Expected 'VAR', 'IF', 'FOR', 'WHILE', 'FUN', "
+                                 "int, float, identifier, '+', '-', '[' or '('")
         return response.success(node)
 
     def func_def(self):
@@ -1377,11 +2012,9 @@ class Parser:
             return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                        self.curr_token.pos_end,
                                                        f"Expected 'FUN"))
-        response.register_advancement()
         self.advance()
         if self.curr_token.type == TT_IDENTIFIER:
             var = self.curr_token
-            response.register_advancement()
             self.advance()
             if self.curr_token.type != TT_LPAR:
                 return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
@@ -1393,22 +2026,18 @@ class Parser:
                 return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                            self.curr_token.pos_end,
                                                            f"Expected identifier or '('"))
-        response.register_advancement()
         self.advance()
         args = []
         if self.curr_token.type == TT_IDENTIFIER:
             args.append(self.curr_token)
-            response.register_advancement()
             self.advance()
             while self.curr_token.type == TT_COMMA:
-                response.register_advancement()
                 self.advance()
                 if self.curr_token.type != TT_IDENTIFIER:
                     return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                                self.curr_token.pos_end,
                                                                f"Expected identifier"))
                 args.append(self.curr_token)
-                response.register_advancement()
                 self.advance()
             if self.curr_token.type != TT_RPAR:
                 return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
@@ -1419,10 +2048,8 @@ class Parser:
                 return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                            self.curr_token.pos_end,
                                                            f"Expected identifier or ')'"))
-        response.register_advancement()
         self.advance()
         if self.curr_token.type == TT_ARROW:
-            response.register_advancement()
             self.advance()
             body = response.register(self.expr())
             if response.error:
@@ -1433,7 +2060,6 @@ class Parser:
                 self.curr_token.pos_start, self.curr_token.pos_end,
                 f"Expected '->' or NEWLINE"
             ))
-        response.register_advancement()
         self.advance()
         body = response.register(self.statements())
         if response.error:
@@ -1442,69 +2068,105 @@ class Parser:
             return response.failure(InvalidSyntaxError(self.curr_token.pos_start,
                                                        self.curr_token.pos_end,
                                                        f"Expected 'END'"))
-        response.register_advancement()
         self.advance()
         return response.success(FuncDefNode(var, args, body, False))
 
-    def bin_op(self, func_a, ops, func_b=None):
-        if func_b is None:
-            func_b = func_a
-        response = ParseResult()
-        left = response.register(func_a())
-        if response.error:
-            return response
-        while self.curr_token.type in ops or (self.curr_token.type, self.curr_token.val) in ops:
-            op_token = self.curr_token
-            response.register_advancement()
-            self.advance()
-            right = response.register(func_b())
-            if response.error:
-                return response
-            left = BinOpNode(left, op_token, right)
-        return response.success(left)
+
+def for_bounds_error(node, bounds, context):
+    """RTError for a FOR loop whose bounds are not all numbers, as the VM's FOR_PREP reports it, or None."""
+    for bound in bounds:
+        if not isinstance(bound, Number):
+            return RTError(node.pos_start, node.pos_end, "FOR bounds must be type 'Number'", context)
+    return None
+
+
+def counter_values(start, end, step):
+    """Values of a FOR loop's counter, as plain numbers."""
+    if type(start) is type(end) is type(step) is int and step != 0:
+        return range(start, end, step)
+    return stepped_values(start, end, step)
+
+
+def stepped_values(i, end, step):
+    if step >= 0:
+        while i < end:
+            yield i
+            i += step
+    else:
+        while i > end:
+            yield i
+            i += step
+
+
+def is_reusable(val):
+    """Whether handing out val again instead of recomputing it is indistinguishable."""
+    return isinstance(val, (Number, String))
 
 
 class Interpreter:
+    # Node class -> unbound visit_ method, filled in by build_dispatch_table()
+    dispatch = {}
+
+    @classmethod
+    def build_dispatch_table(cls):
+        cls.dispatch = {}
+        for node_class in NODE_TYPES:
+            method = getattr(cls, f'visit_{node_class.__name__}', None)
+            if method is not None:
+                cls.dispatch[node_class] = method
+
     def visit(self, node, context):
-        method_name = f'visit_{type(node).__name__}'
-        method = getattr(self, method_name, self.no_visit_method)
-        return method(node, context)
+        method = self.dispatch.get(type(node))
+        if method is None:
+            return self.no_visit_method(node, context)
+        return method(self, node, context)
 
     def no_visit_method(self, node, context):
         raise Exception(f'No visit_{type(node).__name__} method defined')
 
     # noinspection PyMethodMayBeStatic
     def visit_NumberNode(self, node, context):
-        return RTResult().success(
-            Number(node.token.val).set_context(context).set_pos(node.pos_start, node.pos_end)
-        )
+        return RTResult().success(make_number(node.token.val))
 
     # noinspection PyMethodMayBeStatic
     def visit_StringNode(self, node, context):
-        return RTResult().success(
-            String(node.token.val).set_context(context).set_pos(node.pos_start, node.pos_end)
-        )
+        return RTResult().success(String(node.token.val))
 
     def visit_ListNode(self, node, context):
         response = RTResult()
+        if node.discarded:
+            for element in node.elements:
+                response.register(self.visit(element, context))
+                if response.should_ret():
+                    return response
+            return response.success(Number.null)
         elements = []
         for element in node.elements:
             elements.append(response.register(self.visit(element, context)))
             if response.should_ret():
                 return response
-        return response.success(List(elements).set_context(context).set_pos(node.pos_start, node.pos_end))
+        return response.success(List(elements))
 
     # noinspection PyMethodMayBeStatic
     def visit_VarAccessNode(self, node, context):
         response = RTResult()
         var_name = node.var_name_token.val
-        val = context.symbol_table.get(var_name)
+        symbol_table = context.symbol_table
+        if node.depth == LOCAL_DEPTH:
+            val = symbol_table.slots[node.slot]
+            if val is None and symbol_table.parent:
+                val = symbol_table.parent.get(var_name)
+        elif node.depth == GLOBAL_DEPTH and symbol_table.program is not None:
+            # No frame of separately resolved code (the REPL, RUN) between
+            # here and the globals, which could shadow the global
+            val = symbol_table.globals.symbols.get(var_name) or symbol_table.get(var_name)
+        else:
+            val = symbol_table.get(var_name)
         if not val:
             return response.failure(RTError(node.pos_start,
                                             node.pos_end,
                                             f"'{var_name}' is not defined",
                                             context))
-        val = val.copy().set_pos(node.pos_start, node.pos_end).set_context(context)
         return response.success(val)
 
     def visit_VarAssignNode(self, node, context):
@@ -1513,9 +2175,16 @@ class Interpreter:
         val = response.register(self.visit(node.val_node, context))
         if response.should_ret():
             return response
-        context.symbol_table.set(var_name, val)
+        self.assign(node, var_name, val, context)
         return response.success(val)
 
+    # noinspection PyMethodMayBeStatic
+    def assign(self, node, var_name, val, context):
+        if node.depth == LOCAL_DEPTH:
+            context.symbol_table.slots[node.slot] = val
+        else:
+            context.symbol_table.set(var_name, val)
+
     def visit_BinOpNode(self, node, context):
         response = RTResult()
         left = response.register(self.visit(node.left_node, context))
@@ -1524,40 +2193,11 @@ class Interpreter:
         right = response.register(self.visit(node.right_node, context))
         if response.should_ret():
             return response
-        result = None
-        error = None
-        if node.op_token.type == TT_ADD:
-            result, error = left.add_to(right)
-        elif node.op_token.type == TT_SUB:
-            result, error = left.sub_by(right)
-        elif node.op_token.type == TT_MUL:
-            result, error = left.mul_by(right)
-        elif node.op_token.type == TT_DIV:
-            result, error = left.div_by(right)
-        elif node.op_token.type == TT_MOD:
-            result, error = left.mod_by(right)
-        elif node.op_token.type == TT_POW:
-            result, error = left.pow_by(right)
-        elif node.op_token.type == TT_EEQ:
-            result, error = left.get_comparison_eeq(right)
-        elif node.op_token.type == TT_NEQ:
-            result, error = left.get_comparison_neq(right)
-        elif node.op_token.type == TT_LT:
-            result, error = left.get_comparison_lt(right)
-        elif node.op_token.type == TT_GT:
-            result, error = left.get_comparison_gt(right)
-        elif node.op_token.type == TT_LTE:
-            result, error = left.get_comparison_lte(right)
-        elif node.op_token.type == TT_GTE:
-            result, error = left.get_comparison_gte(right)
-        elif node.op_token.matches(TT_KEYWORD, 'AND'):
-            result, error = left.and_with(right)
-        elif node.op_token.matches(TT_KEYWORD, 'OR'):
-            result, error = left.or_with(right)
+        result, error = getattr(left, node.op_method)(right)
         if error:
-            return response.failure(error)
+            return response.failure(error.set_pos(node.pos_start, node.pos_end, context))
         else:
-            return response.success(result.set_pos(node.pos_start, node.pos_end))
+            return response.success(result)
 
     def visit_UnaryOpNode(self, node, context):
         response = RTResult()
@@ -1565,14 +2205,12 @@ class Interpreter:
         if response.should_ret():
             return response
         error = None
-        if node.op_token.type == TT_SUB:
-            num, error = num.mul_by(Number(-1))
-        elif node.op_token.matches(TT_KEYWORD, 'NOT'):
-            num, error = num.not_of()
+        if node.op_method:
+            num, error = getattr(num, node.op_method)()
         if error:
-            return response.failure(error)
+            return response.failure(error.set_pos(node.pos_start, node.pos_end, context))
         else:
-            return response.success(num.set_pos(node.pos_start, node.pos_end))
+            return response.success(num)
 
     def visit_IfNode(self, node, context):
         response = RTResult()
@@ -1597,6 +2235,7 @@ class Interpreter:
     def visit_ForNode(self, node, context):
         response = RTResult()
         elements = []
+        collect = not node.ret_null and not node.discarded
         start = response.register(self.visit(node.start, context))
         if response.should_ret():
             return response
@@ -1608,34 +2247,76 @@ class Interpreter:
             if response.should_ret():
                 return response
         else:
-            step = Number(1)
-        i = start.val
-        if step.val >= 0:
-            condition = i < end.val
-        else:
-            condition = i > end.val
-
-        while condition:
-            context.symbol_table.set(node.var.val, Number(i))
-            i += step.val
+            step = make_number(1)
+        error = for_bounds_error(node, (start, end, step), context)
+        if error:
+            return response.failure(error)
+        if node.parallel:
+            result = self.parallel_for(node, start.val, end.val, step.val, context)
+            if result is not None:
+                elements, error = result
+                if error:
+                    return response.failure(error)
+                return response.success(List(elements) if collect else Number.null)
+        if node.lazy_vars is not None:
+            lazy_list = self.lazy_for(node, start.val, end.val, step.val, context)
+            if lazy_list:
+                return response.success(lazy_list)
+        for invariant in node.invariants:
+            invariant.val = None
+        var_name = node.var.val
+        assign_each = node.var_in_body
+        i = None
+        for i in counter_values(start.val, end.val, step.val):
+            if assign_each:
+                self.assign(node, var_name, make_number(i), context)
             val = response.register(self.visit(node.body, context))
             if response.should_ret() and not response.loop_continue and not response.loop_break:
+                if not assign_each:
+                    self.assign(node, var_name, make_number(i), context)
                 return response
-            if step.val >= 0:
-                condition = i < end.val
-            else:
-                condition = i > end.val
             if response.loop_continue:
                 continue
             if response.loop_break:
                 break
-            elements.append(val)
-        return response.success(Number.null if node.ret_null else
-                                List(elements).set_context(context).set_pos(node.pos_start, node.pos_end))
+            if collect:
+                elements.append(val)
+        if not assign_each and i is not None:
+            # Nothing in the body could see the variable until now
+            self.assign(node, var_name, make_number(i), context)
+        return response.success(List(elements) if collect else Number.null)
+
+    # noinspection PyMethodMayBeStatic
+    def parallel_for(self, node, start, end, step, context):
+        return load_parallel().run_parallel(node, start, end, step, context, 'tree')
+
+    def lazy_for(self, node, start, end, step, context):
+        values = [self.visit(var_node, context).val for var_node in node.lazy_vars]
+        loop = optimizer.lazy_loop(node, start, end, step, values, context)
+        if loop is None:
+            return None
+        indices, snapshot = loop
+        if indices:
+            # The variable is left as the eager loop would leave it
+            self.assign(node, node.var.val, make_number(indices[-1]), context)
+        return LazyList(lambda: self.lazy_elements(node, indices, snapshot))
+
+    def lazy_elements(self, node, indices, context):
+        for invariant in node.invariants:
+            invariant.val = None
+        var_name = node.var.val
+        elements = []
+        for i in indices:
+            context.symbol_table.set(var_name, make_number(i))
+            elements.append(self.visit(node.body, context).val)
+        return elements
 
     def visit_WhileNode(self, node, context):
         response = RTResult()
         elements = []
+        collect = not node.ret_null and not node.discarded
+        for invariant in node.invariants:
+            invariant.val = None
         while True:
             condition = response.register(self.visit(node.condition, context))
             if response.should_ret():
@@ -1649,9 +2330,9 @@ class Interpreter:
                 continue
             if response.loop_break:
                 break
-            elements.append(val)
-        return response.success(Number.null if node.ret_null else
-                                List(elements).set_context(context).set_pos(node.pos_start, node.pos_end))
+            if collect:
+                elements.append(val)
+        return response.success(List(elements) if collect else Number.null)
 
     # noinspection PyMethodMayBeStatic
     def visit_FuncDefNode(self, node, context):
@@ -1659,10 +2340,9 @@ class Interpreter:
         func_name = node.var_name_token.val if node.var_name_token else None
         body = node.body
         arg_names = [arg_name.val for arg_name in node.args]
-        func_val = Function(
-            func_name, body, arg_names, node.auto_ret).set_context(context).set_pos(node.pos_start, node.pos_end)
+        func_val = Function(func_name, body, arg_names, node.auto_ret, node.frame)
         if node.var_name_token:
-            context.symbol_table.set(func_name, func_val)
+            self.assign(node, func_name, func_val, context)
         return response.success(func_val)
 
     def visit_CallNode(self, node, context):
@@ -1671,15 +2351,28 @@ class Interpreter:
         call_val = response.register(self.visit(node.call_node, context))
         if response.should_ret():
             return response
-        call_val = call_val.copy().set_pos(node.pos_start, node.pos_end)
         for arg in node.args:
             args.append(response.register(self.visit(arg, context)))
             if response.should_ret():
                 return response
-        ret_val = response.register(call_val.execute(args))
+        if type(call_val) is Function:
+            ret_val = response.register(self.call(call_val, args, context, node.pos_start, node.pos_end))
+        else:
+            ret_val = response.register(call_val.execute(args, context, node.pos_start, node.pos_end))
         if response.should_ret():
             return response
-        ret_val = ret_val.copy().set_pos(node.pos_start, node.pos_end).set_context(context)
+        return response.success(ret_val)
+
+    def call(self, function, args, context, pos_start, pos_end):
+        """Runs a Function on this interpreter, in a frame bound from its FrameTemplate."""
+        response = RTResult()
+        new_context, error = function.new_frame(args, context, pos_start, function.frame)
+        if error:
+            return response.failure(error.set_pos(pos_start, pos_end, context))
+        val = response.register(self.visit(function.body, new_context))
+        if response.should_ret() and response.fun_ret_val is None:
+            return response
+        ret_val = (val if function.auto_ret else None) or response.fun_ret_val or Number.null
         return response.success(ret_val)
 
     def visit_ReturnNode(self, node, context):
@@ -1692,56 +2385,261 @@ class Interpreter:
             val = Number.null
         return response.success_ret(val)
 
+    def visit_InvariantNode(self, node, context):
+        response = RTResult()
+        if node.val is not None:
+            return response.success(node.val)
+        val = response.register(self.visit(node.node, context))
+        if response.should_ret():
+            return response
+        if is_reusable(val) and all(is_reusable(self.visit(var_node, context).val) for var_node in node.var_nodes):
+            node.val = val
+        return response.success(val)
+
     # noinspection PyMethodMayBeStatic
-    def visit_ContinueNode(self):
+    def visit_ContinueNode(self, node, context):
         return RTResult().success_continue()
 
     # noinspection PyMethodMayBeStatic
-    def visit_BreakNode(self):
+    def visit_BreakNode(self, node, context):
         return RTResult().success_break()
 
 
-global_symbol_table = SymbolTable()
-global_symbol_table.set("TRUE", Number.true)
-global_symbol_table.set("FALSE", Number.false)
-global_symbol_table.set("MATH_PI", Number.math_PI)
-global_symbol_table.set("PRINT", BuiltInFunction.print)
-global_symbol_table.set("PRINT_RET", BuiltInFunction.print_ret)
-global_symbol_table.set("INPUT", BuiltInFunction.input)
-global_symbol_table.set("INPUT_INT", BuiltInFunction.input_int)
-global_symbol_table.set("CLEAR", BuiltInFunction.clear)
-global_symbol_table.set("CLS", BuiltInFunction.clear)
-global_symbol_table.set("IS_NUM", BuiltInFunction.is_num)
-global_symbol_table.set("IS_STR", BuiltInFunction.is_str)
-global_symbol_table.set("IS_LIST", BuiltInFunction.is_list)
-global_symbol_table.set("IS_FUN", BuiltInFunction.is_fun)
-global_symbol_table.set("APPEND", BuiltInFunction.append)
-global_symbol_table.set("POP", BuiltInFunction.pop)
-global_symbol_table.set("EXTEND", BuiltInFunction.extend)
-global_symbol_table.set("LEN", BuiltInFunction.len)
-global_symbol_table.set("RUN", BuiltInFunction.run)
-
-
-def run(file_name, text):
-    # Generate Tokens
-    lexer = Lexer(file_name, text)
-    tokens, error = lexer.make_tokens()
-    if error:
-        return None, error
-
-    # Generate AST
+Interpreter.build_dispatch_table()
+
+
+def new_global_symbol_table():
+    """Symbol table holding the builtin constants and functions, and nothing else."""
+    symbol_table = SymbolTable()
+    symbol_table.set("TRUE", Number.true)
+    symbol_table.set("FALSE", Number.false)
+    symbol_table.set("MATH_PI", Number.math_PI)
+    symbol_table.set("PRINT", BuiltInFunction.print)
+    symbol_table.set("PRINT_RET", BuiltInFunction.print_ret)
+    symbol_table.set("FLUSH", BuiltInFunction.flush)
+    symbol_table.set("INPUT", BuiltInFunction.input)
+    symbol_table.set("INPUT_INT", BuiltInFunction.input_int)
+    symbol_table.set("CLEAR", BuiltInFunction.clear)
+    symbol_table.set("CLS", BuiltInFunction.clear)
+    symbol_table.set("IS_NUM", BuiltInFunction.is_num)
+    symbol_table.set("IS_STR", BuiltInFunction.is_str)
+    symbol_table.set("IS_LIST", BuiltInFunction.is_list)
+    symbol_table.set("IS_FUN", BuiltInFunction.is_fun)
+    symbol_table.set("APPEND", BuiltInFunction.append)
+    symbol_table.set("POP", BuiltInFunction.pop)
+    symbol_table.set("EXTEND", BuiltInFunction.extend)
+    symbol_table.set("LEN", BuiltInFunction.len)
+    symbol_table.set("STRING_BUILDER", BuiltInFunction.string_builder)
+    symbol_table.set("SUM", BuiltInFunction.sum)
+    symbol_table.set("MAP_ADD", BuiltInFunction.map_add)
+    symbol_table.set("MAP_MUL", BuiltInFunction.map_mul)
+    symbol_table.set("DOT", BuiltInFunction.dot)
+    symbol_table.set("MIN", BuiltInFunction.min)
+    symbol_table.set("MAX", BuiltInFunction.max)
+    symbol_table.set("RANGE", BuiltInFunction.range)
+    symbol_table.set("SORT", BuiltInFunction.sort)
+    symbol_table.set("RUN", BuiltInFunction.run)
+    symbol_table.set("MAP", HigherOrderFunction.map)
+    symbol_table.set("FILTER", HigherOrderFunction.filter)
+    symbol_table.set("REDUCE", HigherOrderFunction.reduce)
+    return symbol_table
+
+
+global_symbol_table = new_global_symbol_table()
+
+
+ENGINES = ('tree', 'vm', 'direct')
+# See optimizer.py for what each level does
+OPT_LEVELS = (0, 1, 2, 3)
+
+
+# Parsed programs shared by run(), run_file() and RUN outside of a Runtime;
+# set cache_dir on it to also keep them on disk between processes
+parse_cache = ParseCache()
+
+
+def build_ast(file_name, text, opt_level=0):
+    # Generate AST, pulling tokens from the lexer as the parser needs them
+    lexer = RegexLexer(file_name, text)
+    tokens = lexer.generate_tokens()
     parser = Parser(tokens)
     # print(parser.__dict__)
     ast = parser.parse()
+    if ast.error and not lexer.error:
+        # An illegal character further on takes precedence, as it would
+        # have with the whole file lexed up front
+        for _ in tokens:
+            pass
+    if lexer.error:
+        return None, lexer.error
     if ast.error:
         return None, ast.error
     # print(ast.__dict__)
+    node = ast.node
+
+    if opt_level:
+        # Folds constants, prunes dead IF branches and hoists loop invariants
+        node = optimizer.optimize(node, opt_level)
+
+    # Assign variable slots
+    Resolver().resolve(node)
+    return node, None
+
+
+def load_ast(file_name, text, stat=None, opt_level=0, cache=None):
+    if cache is None:
+        cache = parse_cache
+    entry = cache.get(file_name, text, stat, opt_level)
+    if entry is None:
+        node, error = build_ast(file_name, text, opt_level)
+        if error:
+            return None, error
+        entry = cache.put(file_name, text, node, stat, opt_level)
+    return entry, None
+
+
+def check_options(engine, opt_level):
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', expected one of {', '.join(ENGINES)}")
+    if opt_level not in OPT_LEVELS:
+        raise ValueError(f"Unknown optimization level {opt_level!r}, expected one of "
+                         f"{', '.join(str(level) for level in OPT_LEVELS)}")
+
+
+class Program:
+    """A parsed program, and its bytecode for the vm engine, made by Runtime.compile()."""
+    __slots__ = ('entry', 'engine')
+
+    def __init__(self, entry, engine):
+        self.entry = entry
+        self.engine = engine
+
+
+class Runtime:
+    """
+    What programs run against: a global symbol table, builtins included, a
+    parse cache, and the OutputSink PRINT writes to unless execute() is
+    given another. Programs on different Runtimes do not share globals, so
+    each can serve its own scripts. compile() parses a program once for
+    any number of execute() calls; a Program should not be executed by two
+    threads at once, as loops keep hoisted values in its nodes.
+    """
+    def __init__(self, symbol_table=None, parse_cache=None, output=None, parallel=None):
+        self.symbol_table = symbol_table if symbol_table is not None else new_global_symbol_table()
+        self.parse_cache = parse_cache if parse_cache is not None else ParseCache()
+        self.output = output
+        # parallel.ParallelOptions for PARFOR loops; None for the defaults
+        self.parallel = parallel
+
+    def compile(self, text, file_name='<program>', engine='tree', opt_level=0):
+        """(Program, None), or (None, error) if text is not a valid program."""
+        check_options(engine, opt_level)
+        entry, error = load_ast(file_name, text, opt_level=opt_level, cache=self.parse_cache)
+        if error:
+            return None, error
+        return self.make_program(entry, engine), None
+
+    def compile_file(self, path, engine='tree', opt_level=0):
+        """
+        Like compile() for the script at path. A file whose mtime and size
+        match its cached entry is not even read. Raises OSError if the
+        file cannot be read.
+        """
+        check_options(engine, opt_level)
+        stat = os.stat(path)
+        entry = self.parse_cache.get_file(path, stat, opt_level)
+        if entry is None:
+            with open(path, 'r') as f:
+                text = f.read()
+            entry, error = load_ast(path, text, stat, opt_level, self.parse_cache)
+            if error:
+                return None, error
+        return self.make_program(entry, engine), None
+
+    def make_program(self, entry, engine):
+        if engine == 'vm' and entry.code is None:
+            # Compiled to bytecode once per cache entry
+            from compiler import compile_ast
+            self.parse_cache.set_code(entry, compile_ast(entry.node, entry.file_name))
+        return Program(entry, engine)
+
+    def execute(self, program, output=None):
+        if output is None:
+            output = self.output if self.output is not None else OutputSink(sys.stdout)
+        try:
+            return execute_program(program, self, output)
+        finally:
+            output.flush()
+
+    def run(self, file_name, text, engine='tree', opt_level=0, output=None):
+        program, error = self.compile(text, file_name, engine, opt_level)
+        if error:
+            return None, error
+        return self.execute(program, output)
+
+    def run_file(self, path, engine='tree', opt_level=0, output=None):
+        program, error = self.compile_file(path, engine, opt_level)
+        if error:
+            return None, error
+        return self.execute(program, output)
+
+
+def default_runtime():
+    """Runtime over the module's global_symbol_table and parse_cache."""
+    return Runtime(global_symbol_table, parse_cache)
+
+
+def run(file_name, text, engine='tree', opt_level=0, output=None):
+    """
+    Runs text as a program on the module's shared globals. What it prints
+    goes to output, an OutputSink, or through a new buffered one to
+    sys.stdout if output is None.
+    """
+    return default_runtime().run(file_name, text, engine, opt_level, output)
+
+
+def run_file(path, engine='tree', opt_level=0, output=None):
+    """Like run() for the script at path. Raises OSError if the file cannot be read."""
+    return default_runtime().run_file(path, engine, opt_level, output)
+
+
+def execute_program(program, runtime, output):
+    context = Context('<program>', output=output, runtime=runtime)
+    context.symbol_table = runtime.symbol_table
+    engine, entry = program.engine, program.entry
+
+    if engine == 'vm':
+        # Runs the bytecode on the stack VM
+        from vm import VM, LoopExit
+        result, error = VM().execute(entry.code, context)
+        # A BREAK or CONTINUE that left a function outside of any loop ends the program
+        return (None if type(result) is LoopExit else result), error
+
+    if engine == 'direct':
+        # Walks the AST with non-local exits raised as exceptions
+        from direct import DirectInterpreter
+        return DirectInterpreter().execute(entry.node, context)
 
     # Traverses and computes the AST
     interpreter = Interpreter()
-    context = Context('<program>')
-    context.symbol_table = global_symbol_table
-    result = interpreter.visit(ast.node, context)
+    result = interpreter.visit(entry.node, context)
     # print(global_symbol_table.__dict__)
 
     return result.val, result.error
+
+
+# parallel loads multiprocessing, which is slow to start: it is imported by
+# the first PARFOR, MAP or FILTER that needs it and kept here
+parallel_module = None
+
+
+def load_parallel():
+    global parallel_module
+    if parallel_module is None:
+        import parallel
+        parallel_module = parallel
+    return parallel_module
+
+
+# Builds on this module, so it is bound once everything above is defined
+import optimizer
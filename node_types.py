@@ -1,49 +1,93 @@
 class NumberNode:
+    __slots__ = ('token',)
+
     def __init__(self, token):
         self.token = token
-        self.pos_start = self.token.pos_start
-        self.pos_end = self.token.pos_end
+
+    @property
+    def pos_start(self):
+        return self.token.pos_start
+
+    @property
+    def pos_end(self):
+        return self.token.pos_end
 
     def __repr__(self):
         return f'{self.token}'
 
 
 class StringNode:
+    __slots__ = ('token',)
+
     def __init__(self, token):
         self.token = token
-        self.pos_start = self.token.pos_start
-        self.pos_end = self.token.pos_end
+
+    @property
+    def pos_start(self):
+        return self.token.pos_start
+
+    @property
+    def pos_end(self):
+        return self.token.pos_end
 
     def __repr__(self):
         return f'{self.token}'
 
 
 class ListNode:
+    # discarded: the value is never read (a block of statements, or a list
+    # literal used as a statement), so only the elements are evaluated
+    __slots__ = ('elements', 'pos_start', 'pos_end', 'discarded')
+
     def __init__(self, elements, pos_start, pos_end):
         self.elements = elements
         self.pos_start = pos_start
         self.pos_end = pos_end
+        self.discarded = False
 
 
 class VarAccessNode:
+    __slots__ = ('var_name_token', 'depth', 'slot')
+
     def __init__(self, var_name_token):
         self.var_name_token = var_name_token
-        self.pos_start = self.var_name_token.pos_start
-        self.pos_end = self.var_name_token.pos_end
+        self.depth = None
+        self.slot = None
+
+    @property
+    def pos_start(self):
+        return self.var_name_token.pos_start
+
+    @property
+    def pos_end(self):
+        return self.var_name_token.pos_end
 
 
 class VarAssignNode:
+    __slots__ = ('var_name_token', 'val_node', 'depth', 'slot')
+
     def __init__(self, var_name_token, val_node):
         self.var_name_token = var_name_token
         self.val_node = val_node
-        self.pos_start = self.var_name_token.pos_start
-        self.pos_end = self.var_name_token.pos_end
+        self.depth = None
+        self.slot = None
+
+    @property
+    def pos_start(self):
+        return self.var_name_token.pos_start
+
+    @property
+    def pos_end(self):
+        return self.var_name_token.pos_end
 
 
 class UnaryOpNode:
-    def __init__(self, op_token, node):
+    __slots__ = ('op_token', 'node', 'op_method', 'pos_start', 'pos_end')
+
+    def __init__(self, op_token, node, op_method=None):
         self.op_token = op_token
         self.node = node
+        self.op_method = op_method
         self.pos_start = self.op_token.pos_start
         self.pos_end = node.pos_end
 
@@ -52,10 +96,13 @@ class UnaryOpNode:
 
 
 class BinOpNode:
-    def __init__(self, left_node, op_token, right_node):
+    __slots__ = ('left_node', 'op_token', 'right_node', 'op_method', 'pos_start', 'pos_end')
+
+    def __init__(self, left_node, op_token, right_node, op_method=None):
         self.left_node = left_node
         self.op_token = op_token
         self.right_node = right_node
+        self.op_method = op_method
         self.pos_start = self.left_node.pos_start
         self.pos_end = self.right_node.pos_end
 
@@ -64,6 +111,8 @@ class BinOpNode:
 
 
 class IfNode:
+    __slots__ = ('cases', 'else_case', 'pos_start', 'pos_end')
+
     def __init__(self, cases, else_case):
         self.cases = cases
         self.else_case = else_case
@@ -72,7 +121,16 @@ class IfNode:
 
 
 class ForNode:
-    def __init__(self, var, start, end, step, body, ret_null):
+    # discarded: a single-line loop whose list nobody reads, so the body
+    # values are not collected. var_in_body: cleared by the Resolver when
+    # nothing the body runs can see the variable, which then only needs
+    # its final value. lazy_vars: set by the optimizer on loops whose list
+    # may be produced on first use, see optimizer.lazy_loop(). parallel: a
+    # PARFOR, whose iterations may run in other processes, see parallel.py
+    __slots__ = ('var', 'start', 'end', 'step', 'body', 'pos_start', 'pos_end', 'ret_null',
+                 'discarded', 'var_in_body', 'depth', 'slot', 'invariants', 'lazy_vars', 'parallel')
+
+    def __init__(self, var, start, end, step, body, ret_null, parallel=False):
         self.var = var
         self.start = start
         self.end = end
@@ -81,9 +139,20 @@ class ForNode:
         self.pos_start = self.var.pos_start
         self.pos_end = self.body.pos_end
         self.ret_null = ret_null
+        self.discarded = False
+        self.var_in_body = True
+        self.depth = None
+        self.slot = None
+        self.invariants = ()
+        self.lazy_vars = None
+        self.parallel = parallel
 
 
 class FuncDefNode:
+    # slot_names and frame (a symbol_table.FrameTemplate) are set by the Resolver
+    __slots__ = ('var_name_token', 'args', 'body', 'pos_start', 'pos_end', 'auto_ret',
+                 'depth', 'slot', 'slot_names', 'frame')
+
     def __init__(self, var_name_token, args, body, auto_ret):
         self.var_name_token = var_name_token
         self.args = args
@@ -96,9 +165,15 @@ class FuncDefNode:
             self.pos_start = self.body.pos_start
         self.pos_end = self.body.pos_end
         self.auto_ret = auto_ret
+        self.depth = None
+        self.slot = None
+        self.slot_names = None
+        self.frame = None
 
 
 class CallNode:
+    __slots__ = ('call_node', 'args', 'pos_start', 'pos_end')
+
     def __init__(self, call_node, args):
         self.call_node = call_node
         self.args = args
@@ -110,15 +185,21 @@ class CallNode:
 
 
 class WhileNode:
+    __slots__ = ('condition', 'body', 'pos_start', 'pos_end', 'ret_null', 'discarded', 'invariants')
+
     def __init__(self, condition, body, ret_null):
         self.condition = condition
         self.body = body
         self.pos_start = self.condition.pos_start
         self.pos_end = self.body.pos_end
         self.ret_null = ret_null
+        self.discarded = False
+        self.invariants = ()
 
 
 class ReturnNode:
+    __slots__ = ('ret_node', 'pos_start', 'pos_end')
+
     def __init__(self, ret_node, pos_start, pos_end):
         self.ret_node = ret_node
         self.pos_start = pos_start
@@ -126,13 +207,54 @@ class ReturnNode:
 
 
 class ContinueNode:
+    __slots__ = ('pos_start', 'pos_end')
+
     def __init__(self, pos_start, pos_end):
         self.pos_start = pos_start
         self.pos_end = pos_end
 
 
 class BreakNode:
+    __slots__ = ('pos_start', 'pos_end')
+
     def __init__(self, pos_start, pos_end):
         self.pos_start = pos_start
         self.pos_end = pos_end
 
+
+class InvariantNode:
+    """
+    Expression the optimizer found to be invariant in the loop listing it
+    in its invariants. The loop clears val when it starts; the first
+    evaluation after that is kept in val if it cannot be changed by being
+    reused, i.e. the result and every variable read in var_nodes is a
+    Number or String.
+    """
+    __slots__ = ('node', 'var_nodes', 'val', 'pos_start', 'pos_end')
+
+    def __init__(self, node, var_nodes):
+        self.node = node
+        self.var_nodes = var_nodes
+        self.val = None
+        self.pos_start = node.pos_start
+        self.pos_end = node.pos_end
+
+
+NODE_TYPES = (
+    NumberNode,
+    StringNode,
+    ListNode,
+    VarAccessNode,
+    VarAssignNode,
+    UnaryOpNode,
+    BinOpNode,
+    IfNode,
+    ForNode,
+    FuncDefNode,
+    CallNode,
+    WhileNode,
+    ReturnNode,
+    ContinueNode,
+    BreakNode,
+    InvariantNode,
+)
@@ -0,0 +1,496 @@
+from lang import *
+
+# Optimization levels (lang.OPT_LEVELS) accepted by lang.run()
+#   0: run the AST as parsed
+#   1: fold literal arithmetic and comparisons, drop IF branches whose
+#      condition is a literal, and hoist loop-invariant expressions
+#   2: as 1, but TRUE, FALSE and MATH_PI count as literals in programs that
+#      never bind those names themselves (a script loaded with RUN could)
+#   3: as 2, and single-line FOR loops whose value is used but whose body
+#      can neither fail nor change anything produce their list on first use
+
+BUILTIN_CONSTANTS = {
+    'TRUE': Number.true,
+    'FALSE': Number.false,
+    'MATH_PI': Number.math_PI,
+}
+
+# Folding is done ahead of time even for code that never runs, so results
+# that would be expensive to build are left for the program to compute
+MAX_FOLDED_STRING = 1024
+MAX_FOLDED_EXPONENT = 64
+
+LITERAL_NODES = (NumberNode, StringNode)
+
+
+def literal_node(val, node):
+    """NumberNode or StringNode for val, spanning the source of node."""
+    pos_start, pos_end = node.pos_start, node.pos_end
+    if isinstance(val, String):
+        token = SpanToken(TT_STRING, val.val, pos_start.index, pos_end.index, pos_start.source)
+        return StringNode(token)
+    token_type = TT_FLOAT if isinstance(val.val, float) else TT_INT
+    return NumberNode(SpanToken(token_type, val.val, pos_start.index, pos_end.index, pos_start.source))
+
+
+def literal_val(node):
+    if isinstance(node, NumberNode):
+        return Number(node.token.val)
+    return String(node.token.val)
+
+
+class Optimizer:
+    """
+    Rewrites an unresolved AST in place (run it before the Resolver). Every
+    rewrite gives the same result, output and errors as the original code.
+    """
+    def __init__(self, level=1):
+        self.level = level
+        self.constants = {}
+
+    def optimize(self, node):
+        if self.level <= 0:
+            return node
+        if self.level >= 2:
+            bound = set()
+            BoundNames(bound).visit(node)
+            self.constants = {name: val for name, val in BUILTIN_CONSTANTS.items() if name not in bound}
+        node = self.visit(node)
+        Hoister().visit(node)
+        if self.level >= 3:
+            LazyLoopMarker().visit(node)
+        return node
+
+    def visit(self, node):
+        method = getattr(self, f'visit_{type(node).__name__}', None)
+        return method(node) if method else node
+
+    def visit_ListNode(self, node):
+        node.elements = [self.visit(element) for element in node.elements]
+        return node
+
+    def visit_VarAccessNode(self, node):
+        val = self.constants.get(node.var_name_token.val)
+        return literal_node(val, node) if val else node
+
+    def visit_VarAssignNode(self, node):
+        node.val_node = self.visit(node.val_node)
+        return node
+
+    def visit_UnaryOpNode(self, node):
+        node.node = self.visit(node.node)
+        if not isinstance(node.node, LITERAL_NODES):
+            return node
+        if not node.op_method:
+            return literal_node(literal_val(node.node), node)
+        return self.fold(node, getattr(literal_val(node.node), node.op_method))
+
+    def visit_BinOpNode(self, node):
+        node.left_node = self.visit(node.left_node)
+        node.right_node = self.visit(node.right_node)
+        left, right = node.left_node, node.right_node
+        if not isinstance(left, LITERAL_NODES) or not isinstance(right, LITERAL_NODES):
+            return node
+        left_val, right_val = literal_val(left), literal_val(right)
+        if node.op_method == 'pow_by' and isinstance(right_val, Number) and abs(right_val.val) > MAX_FOLDED_EXPONENT:
+            return node
+        if node.op_method == 'mul_by' and isinstance(left_val, String) and isinstance(right_val, Number) \
+                and len(left_val.val) * right_val.val > MAX_FOLDED_STRING:
+            return node
+        return self.fold(node, lambda: getattr(left_val, node.op_method)(right_val))
+
+    # noinspection PyMethodMayBeStatic
+    def fold(self, node, operation):
+        try:
+            val, error = operation()
+        except (ArithmeticError, ValueError, TypeError):
+            # Left for the program to raise where it always did
+            return node
+        if error or not isinstance(val, (Number, String)):
+            return node
+        if isinstance(val, String) and len(val.val) > MAX_FOLDED_STRING:
+            return node
+        return literal_node(val, node)
+
+    def visit_IfNode(self, node):
+        cases = []
+        for condition, expression, ret_null in node.cases:
+            condition = self.visit(condition)
+            expression = self.visit(expression)
+            if isinstance(condition, LITERAL_NODES):
+                if literal_val(condition).is_true():
+                    # Always taken: later cases and the ELSE are unreachable
+                    node.cases = cases
+                    node.else_case = (expression, ret_null)
+                    return node
+                continue
+            cases.append((condition, expression, ret_null))
+        node.cases = cases
+        if node.else_case:
+            expression, ret_null = node.else_case
+            node.else_case = (self.visit(expression), ret_null)
+        return node
+
+    def visit_ForNode(self, node):
+        node.start = self.visit(node.start)
+        node.end = self.visit(node.end)
+        if node.step:
+            node.step = self.visit(node.step)
+        node.body = self.visit(node.body)
+        return node
+
+    def visit_WhileNode(self, node):
+        node.condition = self.visit(node.condition)
+        node.body = self.visit(node.body)
+        return node
+
+    def visit_FuncDefNode(self, node):
+        node.body = self.visit(node.body)
+        return node
+
+    def visit_CallNode(self, node):
+        node.call_node = self.visit(node.call_node)
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+    def visit_ReturnNode(self, node):
+        if node.ret_node:
+            node.ret_node = self.visit(node.ret_node)
+        return node
+
+
+class NodeWalker:
+    """Visits every node below the one given; subclasses hook the node types they need."""
+    def visit(self, node):
+        method = getattr(self, f'visit_{type(node).__name__}', None)
+        if method:
+            method(node)
+        else:
+            self.visit_children(node)
+
+    def visit_children(self, node):
+        for child in children(node):
+            self.visit(child)
+
+
+def children(node):
+    if isinstance(node, ListNode):
+        return node.elements
+    if isinstance(node, VarAssignNode):
+        return [node.val_node]
+    if isinstance(node, UnaryOpNode):
+        return [node.node]
+    if isinstance(node, BinOpNode):
+        return [node.left_node, node.right_node]
+    if isinstance(node, IfNode):
+        nodes = []
+        for condition, expression, _ in node.cases:
+            nodes += [condition, expression]
+        if node.else_case:
+            nodes.append(node.else_case[0])
+        return nodes
+    if isinstance(node, ForNode):
+        return [child for child in (node.start, node.end, node.step, node.body) if child]
+    if isinstance(node, WhileNode):
+        return [node.condition, node.body]
+    if isinstance(node, FuncDefNode):
+        return [node.body]
+    if isinstance(node, CallNode):
+        return [node.call_node] + node.args
+    if isinstance(node, ReturnNode):
+        return [node.ret_node] if node.ret_node else []
+    if isinstance(node, InvariantNode):
+        return [node.node]
+    return []
+
+
+class BoundNames(NodeWalker):
+    """Collects every name a piece of code assigns or binds as a parameter."""
+    def __init__(self, names):
+        self.names = names
+
+    def visit_VarAssignNode(self, node):
+        self.names.add(node.var_name_token.val)
+        self.visit_children(node)
+
+    def visit_ForNode(self, node):
+        self.names.add(node.var.val)
+        self.visit_children(node)
+
+    def visit_FuncDefNode(self, node):
+        if node.var_name_token:
+            self.names.add(node.var_name_token.val)
+        self.names.update(arg.val for arg in node.args)
+        self.visit_children(node)
+
+
+class HasCall(NodeWalker):
+    def __init__(self):
+        self.found = False
+
+    def visit_CallNode(self, node):
+        self.found = True
+
+    def visit_FuncDefNode(self, node):
+        # Defining a function inside the loop does not run it
+        pass
+
+
+class Hoister(NodeWalker):
+    """
+    Marks expressions that cannot change while a loop runs as InvariantNodes
+    of the outermost such loop. Only loops without calls qualify: a call
+    can reach RUN, which may rebind globals, and builtins such as APPEND
+    change lists in place. In a call-free loop a variable the loop never
+    assigns keeps its value, so an operator expression over literals and
+    such variables is invariant.
+    """
+    def visit_ForNode(self, node):
+        self.hoist(node, [node.body], {node.var.val})
+        self.visit_children(node)
+
+    def visit_WhileNode(self, node):
+        self.hoist(node, [node.condition, node.body], set())
+        self.visit_children(node)
+
+    def hoist(self, loop, parts, assigned):
+        has_call = HasCall()
+        for part in parts:
+            has_call.visit(part)
+        if has_call.found:
+            return
+        for part in parts:
+            BoundNames(assigned).visit(part)
+        invariants = []
+        InvariantMarker(loop, assigned, invariants).visit(loop)
+        loop.invariants = tuple(invariants)
+
+
+class InvariantMarker(NodeWalker):
+    def __init__(self, loop, assigned, invariants):
+        self.loop = loop
+        self.assigned = assigned
+        self.invariants = invariants
+
+    def visit_ForNode(self, node):
+        # The loop's own bounds are evaluated once, outside of its body
+        if node is not self.loop:
+            self.replace_children(node, ('start', 'end', 'step'))
+        self.replace_children(node, ('body',))
+
+    def visit_WhileNode(self, node):
+        self.replace_children(node, ('condition', 'body'))
+
+    def visit_FuncDefNode(self, node):
+        # The body runs when called, in a scope of its own
+        pass
+
+    def visit_InvariantNode(self, node):
+        pass
+
+    def visit_ListNode(self, node):
+        node.elements = [self.replace(element) for element in node.elements]
+
+    def visit_VarAssignNode(self, node):
+        node.val_node = self.replace(node.val_node)
+
+    def visit_UnaryOpNode(self, node):
+        node.node = self.replace(node.node)
+
+    def visit_BinOpNode(self, node):
+        node.left_node = self.replace(node.left_node)
+        node.right_node = self.replace(node.right_node)
+
+    def visit_IfNode(self, node):
+        node.cases = [(self.replace(condition), self.replace(expression), ret_null)
+                      for condition, expression, ret_null in node.cases]
+        if node.else_case:
+            expression, ret_null = node.else_case
+            node.else_case = (self.replace(expression), ret_null)
+
+    def visit_ReturnNode(self, node):
+        if node.ret_node:
+            node.ret_node = self.replace(node.ret_node)
+
+    def replace_children(self, node, fields):
+        for field in fields:
+            child = getattr(node, field)
+            if child:
+                setattr(node, field, self.replace(child))
+
+    def replace(self, node):
+        var_nodes = []
+        if isinstance(node, (BinOpNode, UnaryOpNode)) and self.is_invariant(node, var_nodes):
+            invariant = InvariantNode(node, var_nodes)
+            self.invariants.append(invariant)
+            return invariant
+        self.visit(node)
+        return node
+
+    def is_invariant(self, node, var_nodes):
+        if isinstance(node, LITERAL_NODES):
+            return True
+        if isinstance(node, VarAccessNode):
+            var_nodes.append(node)
+            return node.var_name_token.val not in self.assigned
+        if isinstance(node, BinOpNode):
+            return self.is_invariant(node.left_node, var_nodes) and self.is_invariant(node.right_node, var_nodes)
+        if isinstance(node, UnaryOpNode):
+            return self.is_invariant(node.node, var_nodes)
+        return False
+
+
+class LazyLoopMarker(NodeWalker):
+    """
+    Sets lazy_vars on collecting FOR loops whose body is a side-effect free
+    expression: no assignments, calls, loops or list literals. lazy_vars
+    holds one VarAccessNode per other variable the body reads. PARFOR
+    loops are left eager: the point of one is to run the body now, elsewhere.
+    So are loops whose body holds an invariant hoisted to an enclosing loop:
+    its cached value belongs to whichever run of that loop set it last.
+    """
+    def visit_ForNode(self, node):
+        if not node.ret_null and not node.discarded and not node.parallel:
+            var_nodes = {}
+            if self.is_pure(node.body, node, var_nodes):
+                var_nodes.pop(node.var.val, None)
+                node.lazy_vars = tuple(var_nodes.values())
+        self.visit_children(node)
+
+    def is_pure(self, node, loop, var_nodes):
+        if isinstance(node, LITERAL_NODES):
+            return True
+        if isinstance(node, VarAccessNode):
+            var_nodes.setdefault(node.var_name_token.val, node)
+            return True
+        if isinstance(node, InvariantNode):
+            # The loop's own invariants are reset by lazy_elements()
+            return node in loop.invariants and self.is_pure(node.node, loop, var_nodes)
+        if isinstance(node, UnaryOpNode):
+            return self.is_pure(node.node, loop, var_nodes)
+        if isinstance(node, BinOpNode):
+            return self.is_pure(node.left_node, loop, var_nodes) and self.is_pure(node.right_node, loop, var_nodes)
+        if isinstance(node, IfNode):
+            expressions = [(expression, ret_null) for _, expression, ret_null in node.cases]
+            if node.else_case:
+                expressions.append(node.else_case)
+            return all(self.is_pure(condition, loop, var_nodes) for condition, _, _ in node.cases) and \
+                all(not ret_null and self.is_pure(expression, loop, var_nodes) for expression, ret_null in expressions)
+        return False
+
+
+NUMBER_KINDS = ('int', 'float')
+
+# Operations that succeed on any two numbers
+ARITHMETIC_METHODS = ('add_to', 'sub_by', 'mul_by')
+NUMBER_RESULT_METHODS = ('get_comparison_eeq', 'get_comparison_neq', 'get_comparison_lt', 'get_comparison_gt',
+                         'get_comparison_lte', 'get_comparison_gte', 'and_with', 'or_with')
+
+
+def value_kind(val):
+    if isinstance(val, String):
+        return 'str'
+    if isinstance(val, Number):
+        return 'int' if type(val.val) is int else 'float' if type(val.val) is float else None
+    return None
+
+
+def result_kinds(node, kinds):
+    """
+    Set of kinds ('int', 'float' or 'str') a pure expression can evaluate
+    to, given the kinds of the variables it reads, or None if evaluating it
+    might fail.
+    """
+    if isinstance(node, NumberNode):
+        return {'int' if type(node.token.val) is int else 'float'}
+    if isinstance(node, StringNode):
+        return {'str'}
+    if isinstance(node, VarAccessNode):
+        return kinds.get(node.var_name_token.val)
+    if isinstance(node, InvariantNode):
+        return result_kinds(node.node, kinds)
+    if isinstance(node, UnaryOpNode):
+        operand = result_kinds(node.node, kinds)
+        if operand is None or node.op_method != 'not_of':
+            # Negation multiplies by -1, which works on numbers and strings alike
+            return operand
+        return {'int'} if operand.issubset(NUMBER_KINDS) else None
+    if isinstance(node, BinOpNode):
+        left, right = result_kinds(node.left_node, kinds), result_kinds(node.right_node, kinds)
+        if left is None or right is None:
+            return None
+        results = set()
+        for left_kind in left:
+            for right_kind in right:
+                result = binary_kind(node, left_kind, right_kind)
+                if result is None:
+                    return None
+                results.add(result)
+        return results
+    if isinstance(node, IfNode):
+        results = set() if node.else_case else {'int'}
+        for condition, _, _ in node.cases:
+            if result_kinds(condition, kinds) is None:
+                return None
+        expressions = [expression for _, expression, _ in node.cases]
+        if node.else_case:
+            expressions.append(node.else_case[0])
+        for expression in expressions:
+            expression_kinds = result_kinds(expression, kinds)
+            if expression_kinds is None:
+                return None
+            results |= expression_kinds
+        return results
+    return None
+
+
+def binary_kind(node, left, right):
+    op_method = node.op_method
+    if left == 'str':
+        if op_method == 'add_to' and right == 'str' or op_method == 'mul_by' and right == 'int':
+            return 'str'
+        return None
+    if right == 'str':
+        return None
+    if op_method in NUMBER_RESULT_METHODS:
+        return 'int'
+    if op_method in ARITHMETIC_METHODS:
+        return 'int' if left == right == 'int' else 'float'
+    divisor = node.right_node
+    if op_method in ('div_by', 'mod_by') and isinstance(divisor, NumberNode) and divisor.token.val != 0:
+        return 'float' if op_method == 'div_by' or 'float' in (left, right) else 'int'
+    # POW can overflow or leave the reals
+    return None
+
+
+def lazy_loop(node, start, end, step, values, context):
+    """
+    (indices, snapshot) to produce a lazy FOR loop's list from later, or
+    None when this run of the loop has to be eager. values are those of
+    node.lazy_vars now (None where unset). The loop qualifies when its
+    bounds are integers and its body cannot fail for these values; then
+    evaluating it later in snapshot, a context holding copies of the
+    variables it reads, gives the same list as evaluating it now.
+    """
+    if not type(start) is type(end) is type(step) is int or step == 0:
+        return None
+    kinds = {}
+    for var_node, val in zip(node.lazy_vars, values):
+        kind = value_kind(val)
+        if kind is None:
+            return None
+        kinds[var_node.var_name_token.val] = {kind}
+    kinds[node.var.val] = {'int'}
+    if result_kinds(node.body, kinds) is None:
+        return None
+    snapshot = Context(context.display_name, context.parent, context.parent_entry_pos, context.output,
+                       context.runtime)
+    slot_names = getattr(context.symbol_table, 'slot_names', None)
+    snapshot.symbol_table = FrameSymbolTable(slot_names) if slot_names is not None else SymbolTable()
+    for var_node, val in zip(node.lazy_vars, values):
+        snapshot.symbol_table.set(var_node.var_name_token.val, val)
+    return range(start, end, step), snapshot
+
+
+def optimize(node, level=1):
+    return Optimizer(level).optimize(node)
@@ -0,0 +1,439 @@
+import atexit
+import io
+import itertools
+import math
+import multiprocessing
+import os
+import pickle
+import threading
+
+import persistent_list
+from compiler import OP_CALL, OP_FOR_ITER, OP_STORE_NAME
+from lang import *
+from optimizer import HasCall, NodeWalker
+
+# PARFOR loops with fewer iterations than this run serially by default
+DEFAULT_MIN_ITERATIONS = 1000
+# Without a chunk size, each worker gets about this many chunks
+CHUNKS_PER_WORKER = 4
+
+
+class ParallelOptions:
+    """
+    How PARFOR spreads a loop over worker processes: workers of them
+    (os.cpu_count() if None), chunk_size iterations per task (enough for
+    CHUNKS_PER_WORKER tasks per worker if None). Loops of fewer than
+    min_iterations run serially, like FOR. Set on Runtime.parallel.
+    Workers run the body against copies of the values it reads, so its
+    assignments, and changes it makes to lists, would be dropped: loops
+    whose body can call anything but PURE_BUILTINS always run serially.
+    """
+    def __init__(self, workers=None, chunk_size=None, min_iterations=DEFAULT_MIN_ITERATIONS):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.min_iterations = min_iterations
+
+
+DEFAULT_OPTIONS = ParallelOptions()
+
+# Builtins that only compute a value, or print, which PARFOR carries back
+PURE_BUILTINS = frozenset(('print', 'print_ret', 'flush', 'is_num', 'is_str', 'is_list', 'is_fun', 'len',
+                           'string_builder', 'sum', 'map_add', 'map_mul', 'dot', 'min', 'max', 'range', 'sort'))
+
+
+class ReadNames(NodeWalker):
+    """Collects every name a piece of code reads, and whether it can RETURN from the enclosing function."""
+    def __init__(self, names):
+        self.names = names
+        self.has_return = False
+
+    def visit_VarAccessNode(self, node):
+        self.names.add(node.var_name_token.val)
+
+    def visit_ReturnNode(self, node):
+        self.has_return = True
+        self.visit_children(node)
+
+    def visit_FuncDefNode(self, node):
+        # A RETURN in a function defined in the body leaves only that function
+        has_return = self.has_return
+        self.visit_children(node)
+        self.has_return = has_return
+
+
+class Calls(NodeWalker):
+    """Collects the names code calls functions by (None for a function from anything else), and the names it assigns."""
+    def __init__(self):
+        self.called = set()
+        self.assigned = set()
+
+    def visit_CallNode(self, node):
+        call_node = node.call_node
+        self.called.add(call_node.var_name_token.val if isinstance(call_node, VarAccessNode) else None)
+        self.visit_children(node)
+
+    def visit_VarAssignNode(self, node):
+        self.assigned.add(node.var_name_token.val)
+        self.visit_children(node)
+
+    def visit_ForNode(self, node):
+        self.assigned.add(node.var.val)
+        self.visit_children(node)
+
+    def visit_FuncDefNode(self, node):
+        # Defining a function does not run it
+        if node.var_name_token:
+            self.assigned.add(node.var_name_token.val)
+
+
+def function_calls(function):
+    """(called, assigned) as Calls collects them for a MiniLang function, or None for any other value."""
+    code = getattr(function, 'code', None)
+    if code is not None and hasattr(code, 'callees'):
+        assigned = set(code.varnames)
+        for op, arg in code.instructions:
+            if op == OP_STORE_NAME:
+                assigned.add(code.names[arg])
+            elif op == OP_FOR_ITER and arg[2] is not None:
+                assigned.add(code.names[arg[2]])
+        return set(code.callees), assigned
+    body = getattr(function, 'body', None)
+    if not isinstance(body, NODE_TYPES):
+        return None
+    calls = Calls()
+    calls.visit(body)
+    calls.assigned.update(function.arg_names)
+    return calls.called, calls.assigned
+
+
+def calls_only_pure(called, assigned, symbol_table, seen):
+    """
+    Whether each name in called, looked up in symbol_table, is one of
+    PURE_BUILTINS or a MiniLang function that calls nothing else. A name in
+    assigned can stand for any function by the time it is called. seen
+    holds the ids of the functions already checked.
+    """
+    for name in called:
+        if name is None or name in assigned:
+            return False
+        function = symbol_table.get(name)
+        if id(function) in seen:
+            continue
+        seen.add(id(function))
+        if type(function) is BuiltInFunction:
+            if function.name not in PURE_BUILTINS:
+                return False
+            continue
+        found = function_calls(function)
+        if found is None or not calls_only_pure(*found, symbol_table, seen):
+            return False
+    return True
+
+
+def function_names(val, names):
+    """Adds the names the body of a function value reads, if val is one."""
+    body = getattr(val, 'body', None)
+    if isinstance(body, NODE_TYPES):
+        ReadNames(names).visit(body)
+    codes = [getattr(val, 'code', None)]
+    while codes:
+        code = codes.pop()
+        if code is not None and hasattr(code, 'names'):
+            # A slotted local read before it is assigned comes from the caller
+            names.update(code.names, code.varnames)
+            codes.extend(const for const in code.consts if hasattr(const, 'names'))
+
+
+def makes_calls(function):
+    """Whether function can call anything, or None if it is not a MiniLang function."""
+    code = getattr(function, 'code', None)
+    if code is not None:
+        return any(op == OP_CALL for op, _ in code.instructions)
+    body = getattr(function, 'body', None)
+    if not isinstance(body, NODE_TYPES):
+        return None
+    has_call = HasCall()
+    has_call.visit(body)
+    return has_call.found
+
+
+def snapshot(pending, context):
+    """
+    (global values, local values) of the names in pending as seen from
+    context, and of the names read by functions among them. local values
+    is None for a context outside of any function.
+    """
+    symbol_table = context.symbol_table
+    globals_table = symbol_table.globals
+    seen = set()
+    global_values, local_values = {}, {}
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        global_val = globals_table.symbols.get(name)
+        val = symbol_table.get(name)
+        if global_val is not None:
+            global_values[name] = global_val
+        if val is not None and val is not global_val:
+            local_values[name] = val
+        for found in (global_val, val):
+            if found is not None:
+                function_names(found, pending)
+    return global_values, None if symbol_table is globals_table else local_values
+
+
+def make_symbol_table(slot_names, global_values, local_values):
+    """Symbol table in a worker standing in for one snapshot() was taken in."""
+    globals_table = SymbolTable()
+    for name, val in global_values.items():
+        globals_table.set(name, val)
+    if local_values is None:
+        return globals_table
+    symbol_table = FrameSymbolTable(slot_names, globals_table) if slot_names is not None \
+        else SymbolTable(globals_table)
+    for name, val in local_values.items():
+        symbol_table.set(name, val)
+    return symbol_table
+
+
+def assign(node, symbol_table, i):
+    if node.depth == LOCAL_DEPTH:
+        symbol_table.slots[node.slot] = make_number(i)
+    else:
+        symbol_table.set(node.var.val, make_number(i))
+
+
+# Pool shared by every PARFOR in this process, made on first use
+pool = None
+pool_workers = None
+pool_lock = threading.Lock()
+# Tells apart the payloads of different loops, see run_chunk()
+payload_keys = itertools.count()
+
+
+def get_pool(workers):
+    global pool, pool_workers
+    with pool_lock:
+        if pool is None or pool_workers != workers:
+            if pool is not None:
+                pool.terminate()
+            pool = multiprocessing.Pool(workers)
+            pool_workers = workers
+        return pool
+
+
+@atexit.register
+def shutdown_pool():
+    global pool
+    with pool_lock:
+        if pool is not None:
+            pool.terminate()
+            pool = None
+
+
+def get_options(context):
+    """(options, worker count) for work started from context, or None if it has to stay in this process."""
+    options = context.runtime.parallel if context.runtime is not None else None
+    options = options or DEFAULT_OPTIONS
+    workers = options.workers or os.cpu_count() or 1
+    if workers < 2 or multiprocessing.current_process().daemon:
+        return None
+    return options, workers
+
+
+def run_tasks(func, payload, items, options, workers):
+    """
+    Results of func for each chunk of items, in order. func gets (key,
+    payload, chunk) and passes key and payload to load_payload(). payload
+    is pickled once, to bytes, and unpickled once per worker.
+    """
+    try:
+        data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError, RecursionError):
+        return None
+    chunk_size = options.chunk_size or max(1, math.ceil(len(items) / (workers * CHUNKS_PER_WORKER)))
+    key = (os.getpid(), next(payload_keys))
+    tasks = [(key, data, items[index:index + chunk_size]) for index in range(0, len(items), chunk_size)]
+    return get_pool(workers).imap(func, tasks)
+
+
+# Last payload unpickled by this worker, as (key, payload)
+worker_payload = (None, None)
+
+
+def load_payload(key, data):
+    global worker_payload
+    if worker_payload[0] != key:
+        worker_payload = (key, pickle.loads(data))
+    return worker_payload[1]
+
+
+def run_parallel(node, start, end, step, context, engine):
+    """
+    Runs the PARFOR loop node over its counter values on the process pool.
+    Returns (elements, error), or None if the loop should run serially:
+    when it is shorter than min_iterations, when there is one worker, when
+    its body can RETURN, when this process is itself a pool worker, when
+    the values the body reads cannot be sent to another process, or when
+    the body can call a function other than PURE_BUILTINS. Each chunk of
+    iterations runs against a snapshot of those values, so assignments in
+    the body, and changes to the lists it reads, are not seen by the
+    caller: without that last check, APPEND(l, i) would change l only when
+    the loop is short enough to run serially. Elements and printed text
+    come back in order, and a BREAK drops everything after it, as in FOR.
+    """
+    found = get_options(context)
+    if found is None or step == 0 or not all(isinstance(bound, (int, float)) for bound in (start, end, step)):
+        return None
+    options, workers = found
+    indices = counter_values(start, end, step)
+    if not isinstance(indices, range):
+        indices = list(indices)
+    if len(indices) < options.min_iterations:
+        return None
+    reader = ReadNames(set())
+    reader.visit(node.body)
+    if reader.has_return:
+        return None
+    calls = Calls()
+    calls.visit(node.body)
+    calls.assigned.add(node.var.val)
+    if not calls_only_pure(calls.called, calls.assigned, context.symbol_table, set()):
+        return None
+    global_values, local_values = snapshot(reader.names, context)
+    slot_names = getattr(context.symbol_table, 'slot_names', None)
+    collect = not node.ret_null and not node.discarded
+    payload = (node, engine, collect, slot_names, global_values, local_values)
+    results = run_tasks(run_chunk, payload, indices, options, workers)
+    if results is None:
+        return None
+    elements = []
+    last = indices[-1]
+    try:
+        for chunk_elements, output, error, stop in results:
+            context.output.write(output)
+            if error:
+                details, pos_start, pos_end = error
+                assign(node, context.symbol_table, stop)
+                return None, RTError(pos_start, pos_end, details, context)
+            elements.extend(chunk_elements)
+            if stop is not None:
+                # Later chunks ran for nothing: serially, they never would have
+                last = stop
+                break
+    except multiprocessing.pool.MaybeEncodingError:
+        return None, RTError(node.pos_start, node.pos_end, 'PARFOR results could not be sent back', context)
+    # The variable ends on the last counter value, as after FOR
+    assign(node, context.symbol_table, last)
+    return elements, None
+
+
+def run_chunk(task):
+    """
+    Runs one chunk of a PARFOR in a pool worker. Returns (elements, printed
+    text, error details, stop), where stop is the counter value the chunk
+    ended on early, by BREAK or an error, or None.
+    """
+    key, data, indices = task
+    node, engine, collect, slot_names, global_values, local_values = load_payload(key, data)
+    output = OutputSink(io.StringIO())
+    context = Context('<parfor>', output=output)
+    context.symbol_table = make_symbol_table(slot_names, global_values, local_values)
+    for invariant in node.invariants:
+        invariant.val = None
+    run = run_chunk_tree if engine == 'tree' else run_chunk_direct
+    elements, error, stop = run(node, indices, context, collect)
+    output.flush()
+    text = output.target.getvalue()
+    if error:
+        return None, text, (error.details, error.pos_start, error.pos_end), stop
+    return elements, text, None, stop
+
+
+def run_chunk_tree(node, indices, context, collect):
+    interpreter = Interpreter()
+    elements = []
+    for i in indices:
+        assign(node, context.symbol_table, i)
+        response = interpreter.visit(node.body, context)
+        if response.error:
+            return None, response.error, i
+        if response.loop_break:
+            return elements, None, i
+        if collect and not response.loop_continue:
+            elements.append(response.val)
+    return elements, None, None
+
+
+def run_chunk_direct(node, indices, context, collect):
+    from direct import DirectInterpreter, ErrorSignal, BreakSignal, ContinueSignal
+    visit = DirectInterpreter().visit
+    elements = []
+    for i in indices:
+        assign(node, context.symbol_table, i)
+        try:
+            val = visit(node.body, context)
+        except ContinueSignal:
+            continue
+        except BreakSignal:
+            return elements, None, i
+        except ErrorSignal as signal:
+            return None, signal.error, i
+        if collect:
+            elements.append(val)
+    return elements, None, None
+
+
+def run_map(function, list_, keep, context, pos_start, pos_end):
+    """
+    MAP, or FILTER if keep, of function over list_ on the process pool, as
+    (elements, error), or None if it should run in this process: when the
+    list is shorter than min_iterations, when there is one worker, or when
+    function is not a MiniLang function that makes no calls. Such a
+    function can change nothing but its own frame, so where it runs makes
+    no difference.
+    """
+    found = get_options(context)
+    if found is None or list_.length() < found[0].min_iterations or makes_calls(function) is not False:
+        return None
+    options, workers = found
+    names = set()
+    function_names(function, names)
+    global_values, local_values = snapshot(names, context)
+    slot_names = getattr(context.symbol_table, 'slot_names', None)
+    payload = (function, keep, pos_start, pos_end, slot_names, global_values, local_values)
+    results = run_tasks(run_map_chunk, payload, persistent_list.to_list(list_.root), options, workers)
+    if results is None:
+        return None
+    elements = []
+    try:
+        for chunk_elements, error in results:
+            if error:
+                details, error_start, error_end = error
+                # The context the error would have had here: the function's frame
+                return None, RTError(error_start, error_end, details, Context(function.name, context, pos_start))
+            elements.extend(chunk_elements)
+    except multiprocessing.pool.MaybeEncodingError:
+        return None, RTError(pos_start, pos_end, 'Results could not be sent back', context)
+    return elements, None
+
+
+def run_map_chunk(task):
+    """Runs MAP or FILTER over one chunk of items in a pool worker: (elements, error details)."""
+    key, data, items = task
+    function, keep, pos_start, pos_end, slot_names, global_values, local_values = load_payload(key, data)
+    context = Context('<map>')
+    context.symbol_table = make_symbol_table(slot_names, global_values, local_values)
+    call = function.make_caller(context, pos_start, pos_end)
+    elements = []
+    for item in items:
+        val, error = call([box(item)])
+        if error:
+            return None, (error.details, error.pos_start, error.pos_end)
+        if not keep:
+            elements.append(unbox(val))
+        elif val.is_true():
+            elements.append(item)
+    return elements, None
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+# Bumped whenever the pickled AST or bytecode layout changes, so stale files
+# in a cache directory are ignored instead of loaded
+CACHE_FORMAT = 10
+
+
+class CacheEntry:
+    """
+    Resolved AST of one source file at one optimization level, plus its
+    bytecode once the VM has asked for it. mtime_ns and size are only known
+    for files loaded from disk and let an unchanged file be recognised
+    without reading it.
+    """
+    __slots__ = ('file_name', 'opt_level', 'digest', 'mtime_ns', 'size', 'node', 'code')
+
+    def __init__(self, file_name, opt_level, digest, node, stat=None):
+        self.file_name = file_name
+        self.opt_level = opt_level
+        self.digest = digest
+        self.mtime_ns = stat.st_mtime_ns if stat else None
+        self.size = stat.st_size if stat else None
+        self.node = node
+        self.code = None
+
+    def matches_stat(self, stat):
+        return self.mtime_ns == stat.st_mtime_ns and self.size == stat.st_size
+
+
+class ParseCache:
+    """
+    Parsed programs keyed by file name and optimization level, and
+    validated by a hash of their source. Holds up to max_entries in
+    memory, least recently used first out. With a cache_dir, entries are
+    also pickled there (one file per source file and level, like
+    __pycache__) so a new process can skip parsing too.
+    """
+    def __init__(self, max_entries=64, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def digest(text):
+        return hashlib.sha256(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def get(self, file_name, text, stat=None, opt_level=0):
+        """Entry for file_name if it was built from this exact text, else None."""
+        digest = self.digest(text)
+        entry = self.entries.get((file_name, opt_level))
+        if entry is None or entry.digest != digest:
+            entry = self.load(file_name, opt_level)
+            if entry is None or entry.digest != digest:
+                return None
+        if stat and not entry.matches_stat(stat):
+            # Same contents under a new mtime: remember it so the next
+            # lookup does not need to read the file again
+            entry.mtime_ns, entry.size = stat.st_mtime_ns, stat.st_size
+            self.save(entry)
+        self.remember(entry)
+        return entry
+
+    def get_file(self, path, stat, opt_level=0):
+        """Entry for the file at path if it is unchanged since it was cached, else None."""
+        entry = self.entries.get((path, opt_level))
+        if entry is None or not entry.matches_stat(stat):
+            entry = self.load(path, opt_level)
+            if entry is None or not entry.matches_stat(stat):
+                return None
+        self.remember(entry)
+        return entry
+
+    def put(self, file_name, text, node, stat=None, opt_level=0):
+        entry = CacheEntry(file_name, opt_level, self.digest(text), node, stat)
+        self.remember(entry)
+        self.save(entry)
+        return entry
+
+    def set_code(self, entry, code):
+        entry.code = code
+        self.save(entry)
+
+    def clear(self):
+        self.entries.clear()
+
+    def remember(self, entry):
+        if self.max_entries <= 0:
+            return
+        key = (entry.file_name, entry.opt_level)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    # On-disk cache
+    def cache_path(self, file_name, opt_level):
+        name = hashlib.sha256(file_name.encode('utf-8', 'surrogatepass')).hexdigest()[:32]
+        if opt_level:
+            # Named like __pycache__'s .opt-1.pyc files
+            name += f'.opt-{opt_level}'
+        return os.path.join(self.cache_dir, f'{name}.pickle')
+
+    def load(self, file_name, opt_level):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.cache_path(file_name, opt_level), 'rb') as f:
+                cache_format, entry = pickle.load(f)
+        except (OSError, EOFError, RecursionError, pickle.UnpicklingError, AttributeError, ValueError, TypeError):
+            return None
+        if cache_format != CACHE_FORMAT or (entry.file_name, entry.opt_level) != (file_name, opt_level):
+            return None
+        return entry
+
+    def save(self, entry):
+        if not self.cache_dir:
+            return
+        path = self.cache_path(entry.file_name, entry.opt_level)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(temp_path, 'wb') as f:
+                pickle.dump((CACHE_FORMAT, entry), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except (OSError, RecursionError, pickle.PicklingError):
+            # The cache is only an optimisation; a program too deeply nested
+            # to pickle or an unwritable directory just is not cached
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
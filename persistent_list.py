@@ -0,0 +1,213 @@
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+
+# Most items in a leaf, and most children of a branch
+NODE_SIZE = 32
+
+
+class Branch:
+    """
+    Inner node of a persistent list. Leaves hold up to NODE_SIZE items
+    (see make_leaf) and all of them sit at the same depth; sizes holds the running
+    total of items under children, so nodes may be less than full (as in
+    an RRB tree) and lists of any shape can be concatenated. Nodes are
+    never changed once built, which lets any number of lists share them.
+    """
+    __slots__ = ('children', 'sizes', 'height')
+
+    def __init__(self, children, height, sizes=None):
+        self.children = children
+        self.sizes = sizes if sizes is not None else tuple(accumulate(map(node_size, children)))
+        self.height = height
+
+
+def node_size(node):
+    return node.sizes[-1] if type(node) is Branch else len(node)
+
+
+def node_height(node):
+    return node.height if type(node) is Branch else 0
+
+
+def make_leaf(items):
+    """
+    Leaf of items: an array('q') if they are all ints that fit in 64 bits,
+    an array('d') if they are all floats, otherwise a tuple. Arrays store
+    the numbers unboxed, at 8 bytes each.
+    """
+    kinds = set(map(type, items))
+    if len(kinds) == 1:
+        if int in kinds:
+            try:
+                return array('q', items)
+            except OverflowError:
+                pass
+        elif float in kinds:
+            return array('d', items)
+    return tuple(items)
+
+
+# The empty list is None; every other list is the root node holding it
+
+def from_list(items):
+    level = [make_leaf(items[index:index + NODE_SIZE]) for index in range(0, len(items), NODE_SIZE)]
+    height = 0
+    while len(level) > 1:
+        height += 1
+        level = [Branch(tuple(level[index:index + NODE_SIZE]), height)
+                 for index in range(0, len(level), NODE_SIZE)]
+    return level[0] if level else None
+
+
+def to_list(root):
+    items = []
+    if root is not None:
+        extend_with_items(items, root)
+    return items
+
+
+def extend_with_items(items, node):
+    if type(node) is Branch:
+        for child in node.children:
+            extend_with_items(items, child)
+    else:
+        items.extend(node)
+
+
+def iterate(root):
+    for leaf in leaves(root):
+        yield from leaf
+
+
+def leaves(root):
+    """Leaves of the list in order, for walking a whole list a leaf at a time."""
+    if root is None:
+        return
+    if type(root) is not Branch:
+        yield root
+        return
+    for child in root.children:
+        yield from leaves(child)
+
+
+def size(root):
+    return 0 if root is None else node_size(root)
+
+
+def normalize_index(root, index):
+    """index with Python's negative index convention applied, or IndexError."""
+    length = size(root)
+    if index < 0:
+        index += length
+    if not 0 <= index < length:
+        raise IndexError('list index out of range')
+    return index
+
+
+def get(root, index):
+    node = root
+    index = normalize_index(root, index)
+    while type(node) is Branch:
+        child_index = bisect_right(node.sizes, index)
+        if child_index:
+            index -= node.sizes[child_index - 1]
+        node = node.children[child_index]
+    return node[index]
+
+
+def append(root, item):
+    return concat(root, make_leaf((item,)))
+
+
+def concat(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    left_height, right_height = node_height(left), node_height(right)
+    if left_height >= right_height:
+        node, extra = insert_right(left, right, right_height)
+    else:
+        node, extra = insert_left(right, left, left_height)
+    if extra is None:
+        return node
+    return Branch((node, extra), node_height(node) + 1)
+
+
+# insert_right(), insert_left(), merge() and split_children() all return
+# the resulting node, plus a sibling to its right (of the same height) if
+# the items did not fit in one node
+
+def insert_right(node, other, other_height):
+    """Adds other, a node of other_height, after the last item under node."""
+    height = node_height(node)
+    if height == other_height:
+        return merge(node, other)
+    if height == other_height + 1:
+        last, extra = merge(node.children[-1], other)
+    else:
+        last, extra = insert_right(node.children[-1], other, other_height)
+    # Only the running totals from the last child on need working out again
+    sizes = node.sizes[:-1]
+    total = (sizes[-1] if sizes else 0) + node_size(last)
+    if extra is None:
+        children, sizes = node.children[:-1] + (last,), sizes + (total,)
+    else:
+        children, sizes = node.children[:-1] + (last, extra), sizes + (total, total + node_size(extra))
+    return split_children(children, height, sizes)
+
+
+def insert_left(node, other, other_height):
+    """Adds other, a node of other_height, before the first item under node."""
+    height = node_height(node)
+    if height == other_height + 1:
+        first, extra = merge(other, node.children[0])
+    else:
+        first, extra = insert_left(node.children[0], other, other_height)
+    children = ((first,) if extra is None else (first, extra)) + node.children[1:]
+    return split_children(children, height)
+
+
+def merge(left, right):
+    """Joins two nodes of the same height into one, or two if they do not fit."""
+    if type(left) is Branch:
+        return split_children(left.children + right.children, left.height)
+    if type(left) is type(right) and (type(left) is tuple or left.typecode == right.typecode):
+        items = left + right
+    else:
+        # Items of different kinds only share a tuple
+        items = tuple(left) + tuple(right)
+    if len(items) <= NODE_SIZE:
+        return items, None
+    return items[:NODE_SIZE], items[NODE_SIZE:]
+
+
+def split_children(children, height, sizes=None):
+    if len(children) <= NODE_SIZE:
+        return Branch(children, height, sizes), None
+    return Branch(children[:NODE_SIZE], height), Branch(children[NODE_SIZE:], height)
+
+
+def delete(root, index):
+    """Root of the list without the item at index (which may be negative)."""
+    node = remove(root, normalize_index(root, index))
+    # A root left with one child gives way to it, keeping lookups short
+    while type(node) is Branch and len(node.children) == 1:
+        node = node.children[0]
+    return node
+
+
+def remove(node, index):
+    if type(node) is not Branch:
+        items = node[:index] + node[index + 1:]
+        return items or None
+    child_index = bisect_right(node.sizes, index)
+    if child_index:
+        index -= node.sizes[child_index - 1]
+    child = remove(node.children[child_index], index)
+    if child is None:
+        children = node.children[:child_index] + node.children[child_index + 1:]
+    else:
+        children = node.children[:child_index] + (child,) + node.children[child_index + 1:]
+    return Branch(children, node.height) if children else None
@@ -0,0 +1,155 @@
+from node_types import *
+from symbol_table import FrameTemplate
+
+# Depth values stored on resolved nodes alongside their slot
+LOCAL_DEPTH = 0
+GLOBAL_DEPTH = -1
+
+
+class Scope:
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.slot_names = {}
+
+    def declare(self, name):
+        slot = self.slot_names.get(name)
+        if slot is None:
+            slot = len(self.slot_names)
+            self.slot_names[name] = slot
+        return slot
+
+
+class Resolver:
+    """
+    Assigns each variable reference a (depth, slot) address ahead of time:
+
+    - (LOCAL_DEPTH, slot): bound in the enclosing function, read from the
+      call frame's slot list.
+    - (GLOBAL_DEPTH, None): never bound by any function of the program, so
+      no frame of the program between the reader and the globals can hold
+      it. Frames of other programs can, which is why FrameSymbolTable
+      tracks the program its callers come from.
+    - (None, None): bound by some other function; since MiniLang scopes are
+      dynamic (a call's parent scope is the caller's) it is looked up by name.
+
+    Top-level code runs directly against the global table and gets
+    GLOBAL_DEPTH throughout.
+    """
+    def __init__(self):
+        self.scope = None
+        # Tells the frames of this program's functions apart from others'
+        self.program = object()
+        self.function_bound = set()
+        self.reads = []
+        # FOR loops whose body is being visited, see touch()
+        self.loops = []
+
+    def resolve(self, node):
+        self.visit(node)
+        for read_node, scope in self.reads:
+            name = read_node.var_name_token.val
+            if scope is None:
+                read_node.depth, read_node.slot = GLOBAL_DEPTH, None
+            elif name in scope.slot_names:
+                read_node.depth, read_node.slot = LOCAL_DEPTH, scope.slot_names[name]
+            elif name in self.function_bound:
+                read_node.depth, read_node.slot = None, None
+            else:
+                read_node.depth, read_node.slot = GLOBAL_DEPTH, None
+        self.reads = []
+        return node
+
+    def declare(self, node, name):
+        if self.scope is None:
+            node.depth, node.slot = GLOBAL_DEPTH, None
+        else:
+            node.depth, node.slot = LOCAL_DEPTH, self.scope.declare(name)
+            self.function_bound.add(name)
+
+    def visit(self, node):
+        method = getattr(self, f'visit_{type(node).__name__}', self.visit_leaf)
+        method(node)
+
+    def visit_leaf(self, node):
+        pass
+
+    def visit_ListNode(self, node):
+        for element in node.elements:
+            self.visit(element)
+
+    def touch(self, name=None):
+        """
+        Notes that code in the loops being visited uses name, or with no
+        name, makes a call that could use any variable (scopes are dynamic).
+        """
+        for loop in self.loops:
+            if name is None or loop.var.val == name:
+                loop.var_in_body = True
+
+    def visit_VarAccessNode(self, node):
+        self.reads.append((node, self.scope))
+        self.touch(node.var_name_token.val)
+
+    def visit_VarAssignNode(self, node):
+        self.visit(node.val_node)
+        self.declare(node, node.var_name_token.val)
+        self.touch(node.var_name_token.val)
+
+    def visit_BinOpNode(self, node):
+        self.visit(node.left_node)
+        self.visit(node.right_node)
+
+    def visit_UnaryOpNode(self, node):
+        self.visit(node.node)
+
+    def visit_IfNode(self, node):
+        for condition, expression, _ in node.cases:
+            self.visit(condition)
+            self.visit(expression)
+        if node.else_case:
+            self.visit(node.else_case[0])
+
+    def visit_ForNode(self, node):
+        self.visit(node.start)
+        self.visit(node.end)
+        if node.step:
+            self.visit(node.step)
+        self.declare(node, node.var.val)
+        self.touch(node.var.val)
+        node.var_in_body = False
+        self.loops.append(node)
+        self.visit(node.body)
+        self.loops.pop()
+
+    def visit_WhileNode(self, node):
+        self.visit(node.condition)
+        self.visit(node.body)
+
+    def visit_FuncDefNode(self, node):
+        if node.var_name_token:
+            self.declare(node, node.var_name_token.val)
+            self.touch(node.var_name_token.val)
+        self.scope = Scope(self.scope)
+        for arg in node.args:
+            self.scope.declare(arg.val)
+            self.function_bound.add(arg.val)
+        # The body runs when called, which touch() covers at the call
+        loops, self.loops = self.loops, []
+        self.visit(node.body)
+        self.loops = loops
+        node.slot_names = self.scope.slot_names
+        node.frame = FrameTemplate(node.slot_names, [arg.val for arg in node.args], self.program)
+        self.scope = self.scope.parent
+
+    def visit_CallNode(self, node):
+        self.touch()
+        self.visit(node.call_node)
+        for arg in node.args:
+            self.visit(arg)
+
+    def visit_ReturnNode(self, node):
+        if node.ret_node:
+            self.visit(node.ret_node)
+
+    def visit_InvariantNode(self, node):
+        self.visit(node.node)
@@ -2,6 +2,8 @@ class SymbolTable:
     def __init__(self, parent=None):
         self.symbols = {}
         self.parent = parent
+        self.globals = parent.globals if parent else self
+        self.program = None
 
     def get(self, name):
         val = self.symbols.get(name, None)
@@ -17,3 +19,74 @@ class SymbolTable:
 
     def to_string(self):
         return self.symbols
+
+
+class FrameSymbolTable(SymbolTable):
+    """
+    Symbol table for a function call whose locals were given slot indexes
+    by the Resolver. Slotted names live in a fixed-size list; anything else
+    (and name-based access from builtins) still goes through the dict.
+    program identifies the resolved program the function belongs to, and
+    is kept only if every frame between this one and the globals belongs
+    to the same program.
+    """
+    def __init__(self, slot_names, parent=None, slots=None, program=None):
+        self.symbols = {}
+        self.parent = parent
+        self.globals = parent.globals if parent else self
+        if parent is not None and parent.parent is not None and parent.program is not program:
+            program = None
+        self.program = program
+        self.slot_names = slot_names
+        self.slots = slots if slots is not None else [None] * len(slot_names)
+
+    def get(self, name):
+        slot = self.slot_names.get(name)
+        val = self.slots[slot] if slot is not None else self.symbols.get(name, None)
+        if val is None and self.parent:
+            return self.parent.get(name)
+        return val
+
+    def set(self, name, val):
+        slot = self.slot_names.get(name)
+        if slot is not None:
+            self.slots[slot] = val
+        else:
+            self.symbols[name] = val
+
+    def remove(self, name):
+        slot = self.slot_names.get(name)
+        if slot is not None:
+            self.slots[slot] = None
+        else:
+            del self.symbols[name]
+
+    def to_string(self):
+        symbols = {name: self.slots[slot] for name, slot in self.slot_names.items()
+                   if self.slots[slot] is not None}
+        symbols.update(self.symbols)
+        return symbols
+
+
+class FrameTemplate:
+    """
+    How a call of one function binds its arguments, worked out once when
+    the function is resolved. The Resolver gives argument i slot i unless
+    two arguments share a name, so a call's slot list is normally just its
+    argument list padded with None for the other locals. program is shared
+    by the templates of every function resolved together.
+    """
+    __slots__ = ('slot_names', 'arg_count', 'padding', 'in_order', 'program')
+
+    def __init__(self, slot_names, arg_names, program=None):
+        self.slot_names = slot_names
+        self.program = program
+        self.arg_count = len(arg_names)
+        self.padding = [None] * (len(slot_names) - len(arg_names))
+        self.in_order = all(slot_names.get(name) == index for index, name in enumerate(arg_names))
+
+    def new_table(self, args, parent):
+        """FrameSymbolTable with args bound, or None if they are the wrong number or cannot go straight into slots."""
+        if self.in_order and len(args) == self.arg_count:
+            return FrameSymbolTable(self.slot_names, parent, args + self.padding, self.program)
+        return None
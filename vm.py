@@ -0,0 +1,254 @@
+from compiler import *
+
+
+class LoopExit:
+    """What VM.execute() returns for a BREAK or CONTINUE that left the code it ran."""
+    def __init__(self, is_break):
+        self.is_break = is_break
+
+    def __repr__(self):
+        return 'BREAK' if self.is_break else 'CONTINUE'
+
+
+LOOP_BREAK = LoopExit(True)
+LOOP_CONTINUE = LoopExit(False)
+
+
+class CompiledFunction(BaseFunction):
+    def __init__(self, code):
+        super().__init__(code.name)
+        self.code = code
+        self.arg_names = code.arg_names
+
+    def execute(self, args, context, pos_start, pos_end):
+        response = RTResult()
+        val, error = VM().call(self, args, context, pos_start, pos_end)
+        if error:
+            return response.failure(error)
+        if type(val) is LoopExit:
+            return response.success_break() if val.is_break else response.success_continue()
+        return response.success(val)
+
+    def make_caller(self, context, pos_start, pos_end):
+        vm = VM()
+
+        def call(args):
+            val, error = vm.call(self, args, context, pos_start, pos_end)
+            if type(val) is LoopExit:
+                # A BREAK or CONTINUE that left the function has no loop to end here
+                return Number.null, None
+            return val, error
+        return call
+
+    def copy(self):
+        return CompiledFunction(self.code)
+
+    def __repr__(self):
+        return f"<function {self.name}>"
+
+
+class VM:
+    """
+    Stack machine for CodeObjects produced by the Compiler. Each call to
+    execute() runs one frame with its own operand stack; calls between
+    compiled functions recurse into execute() directly instead of going
+    through RTResult. A BREAK or CONTINUE that leaves a function comes back
+    from its call as a LoopExit, which ends the loop around the call, or
+    the calling frame if the call is not in one.
+    """
+    def execute(self, code, context):
+        instructions = code.instructions
+        consts = code.consts
+        names = code.names
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        symbol_table = context.symbol_table
+        fast = symbol_table.slots if code.slot_names is not None else None
+        pc = 0
+
+        while True:
+            op, arg = instructions[pc]
+            pc += 1
+
+            if op == OP_LOAD_FAST:
+                val = fast[arg]
+                if val is None:
+                    # Not yet bound in this frame: dynamic lookup in the caller chain
+                    name = code.varnames[arg]
+                    val = symbol_table.parent.get(name) if symbol_table.parent else None
+                    if not val:
+                        pos_start, pos_end = code.positions[pc - 1]
+                        return None, RTError(pos_start, pos_end, f"'{name}' is not defined", context)
+                push(val)
+
+            elif op == OP_LOAD_GLOBAL:
+                name = names[arg]
+                if symbol_table.program is not None:
+                    val = symbol_table.globals.symbols.get(name) or symbol_table.get(name)
+                else:
+                    # Frames of other programs may sit in between, see FrameSymbolTable
+                    val = symbol_table.get(name)
+                if not val:
+                    pos_start, pos_end = code.positions[pc - 1]
+                    return None, RTError(pos_start, pos_end, f"'{name}' is not defined", context)
+                push(val)
+
+            elif op == OP_STORE_FAST:
+                fast[arg] = stack[-1]
+
+            elif op == OP_LOAD_NAME:
+                name = names[arg]
+                val = symbol_table.get(name)
+                if not val:
+                    pos_start, pos_end = code.positions[pc - 1]
+                    return None, RTError(pos_start, pos_end, f"'{name}' is not defined", context)
+                push(val)
+
+            elif op == OP_LOAD_CONST:
+                push(consts[arg])
+
+            elif op == OP_BINARY_OP:
+                right = pop()
+                left = pop()
+                result, error = getattr(left, arg)(right)
+                if error:
+                    pos_start, pos_end = code.positions[pc - 1]
+                    return None, error.set_pos(pos_start, pos_end, context)
+                push(result)
+
+            elif op == OP_STORE_NAME:
+                symbol_table.set(names[arg], stack[-1])
+
+            elif op == OP_POP:
+                pop()
+
+            elif op == OP_POP_JUMP_IF_FALSE:
+                if not pop().is_true():
+                    pc = arg
+
+            elif op == OP_JUMP:
+                pc = arg
+
+            elif op == OP_FOR_ITER:
+                state = stack[-1]
+                i, end, step = state
+                if (i < end) if step >= 0 else (i > end):
+                    exit_target, slot, name_index = arg
+                    if slot is not None:
+                        fast[slot] = make_number(i)
+                    else:
+                        symbol_table.set(names[name_index], make_number(i))
+                    state[0] = i + step
+                else:
+                    pop()
+                    pc = arg[0]
+
+            elif op == OP_LIST_APPEND:
+                val = pop()
+                stack[-arg].append(val)
+
+            elif op == OP_CALL:
+                args = stack[len(stack) - arg:]
+                del stack[len(stack) - arg:]
+                callee = pop()
+                pos_start, pos_end = code.positions[pc - 1]
+                if isinstance(callee, CompiledFunction):
+                    val, error = self.call(callee, args, context, pos_start, pos_end)
+                else:
+                    response = callee.execute(args, context, pos_start, pos_end)
+                    val, error = response.val, response.error
+                    if response.loop_break or response.loop_continue:
+                        val = LOOP_BREAK if response.loop_break else LOOP_CONTINUE
+                if error:
+                    return None, error
+                if type(val) is LoopExit:
+                    for body_start, body_end, break_target, break_depth, continue_target, continue_depth in code.loops:
+                        if body_start < pc <= body_end:
+                            if val.is_break:
+                                del stack[break_depth:]
+                                pc = break_target
+                            else:
+                                del stack[continue_depth:]
+                                pc = continue_target
+                            break
+                    else:
+                        return val, None
+                    continue
+                push(val)
+
+            elif op == OP_RETURN_VALUE:
+                return pop(), None
+
+            elif op == OP_UNARY_OP:
+                result, error = getattr(pop(), arg)()
+                if error:
+                    pos_start, pos_end = code.positions[pc - 1]
+                    return None, error.set_pos(pos_start, pos_end, context)
+                push(result)
+
+            elif op == OP_BUILD_LIST:
+                if arg:
+                    elements = stack[len(stack) - arg:]
+                    del stack[len(stack) - arg:]
+                else:
+                    elements = []
+                push(List(elements))
+
+            elif op == OP_FOR_PREP:
+                step = pop() if arg else None
+                end = pop()
+                start = pop()
+                for bound in (start, end, step):
+                    if bound is not None and not isinstance(bound, Number):
+                        pos_start, pos_end = code.positions[pc - 1]
+                        return None, RTError(pos_start, pos_end, "FOR bounds must be type 'Number'", context)
+                push([start.val, end.val, step.val if step else 1])
+
+            elif op == OP_PARFOR:
+                node_index, has_step, exit_target = arg
+                bounds = stack[-3:] if has_step else stack[-2:]
+                # Bounds of the wrong type are left for FOR_PREP to report
+                if all(isinstance(bound, Number) for bound in bounds):
+                    node = consts[node_index]
+                    start, end, step = [bound.val for bound in bounds] + ([] if has_step else [1])
+                    result = self.parallel_for(node, start, end, step, context)
+                    if result is not None:
+                        elements, error = result
+                        if error:
+                            return None, error
+                        del stack[len(stack) - len(bounds):]
+                        if not node.ret_null and not node.discarded:
+                            # In place of the list BUILD_LIST made for the serial loop
+                            stack[-1] = List(elements)
+                        else:
+                            push(Number.null)
+                        pc = exit_target
+
+            elif op == OP_MAKE_FUNCTION:
+                push(CompiledFunction(consts[arg]))
+
+            elif op == OP_POP_TO:
+                del stack[arg:]
+
+            elif op == OP_EXIT_LOOP:
+                return LOOP_BREAK if arg else LOOP_CONTINUE, None
+
+            else:
+                raise Exception(f'Unknown opcode {op}')
+
+    # noinspection PyMethodMayBeStatic
+    def parallel_for(self, node, start, end, step, context):
+        # Workers run the loop body with the DirectInterpreter: it evaluates
+        # the AST, which unlike this frame's bytecode stands on its own
+        return load_parallel().run_parallel(node, start, end, step, context, 'direct')
+
+    def call(self, function, args, context, pos_start, pos_end):
+        """
+        Enters a compiled function from the caller's frame. Like
+        Function.execute the new scope's parent is the calling context.
+        """
+        new_context, error = function.new_frame(args, context, pos_start, function.code.frame)
+        if error:
+            return None, error.set_pos(pos_start, pos_end, context)
+        return self.execute(function.code, new_context)